@@ -5,6 +5,7 @@ from pathlib import Path
 import click
 
 from photomanip.averager import Averager, ConstructMetadata
+from photomanip.metrics import UPLOAD
 from photomanip.uploader import FlickrUploader
 
 
@@ -29,7 +30,8 @@ from photomanip.uploader import FlickrUploader
     help="""either 'crop' (all images are cropped to smallest dimension) \
 or 'pad' (all images are padded to largest dimension) \
 or 'resize' (images are resized to the same dimension as the largest image \
-WARNING: this option is very slow and uses a large amount of memory!).""",
+WARNING: with the 'skimage' resampler this option is very slow and uses a \
+large amount of memory!).""",
     show_default=True,
     required=True,
     type=click.Choice(["crop", "pad", "resize"], case_sensitive=False),
@@ -70,15 +72,36 @@ specified flickr set.""",
 @click.option(
     "-k",
     "--cache",
-    help="""keep a length 2 cache of previously generated monthly and \
-yearly averages. depending on image size, cache may use a significant \
-amount of storage space (500 MB - 1.5 GB), but greatly decreases \
-processing time when generating averages with many images.""",
+    help="""keep a cache of previously generated monthly and yearly \
+averages, shared by both. averages that start with the same images as a \
+cached one pick up from it, which greatly decreases processing time when \
+generating averages with many images. cached images can be large, see \
+--cache_size.""",
     show_default=True,
     required=False,
     type=click.BOOL,
     default=True
 )
+@click.option(
+    "--cache_size",
+    help="""size limit in MB of the cache of averages. when it's full, \
+the averages that were used least recently and are quickest to recompute \
+are removed first.""",
+    show_default=True,
+    required=False,
+    type=click.IntRange(min=1),
+    default=4096
+)
+@click.option(
+    "--cache_content_hash",
+    help="""also check the contents of the photos, not just their paths, \
+sizes and modification times, before a cached average is used. photos \
+are read in full once per run to hash them.""",
+    show_default=True,
+    required=False,
+    type=click.BOOL,
+    default=False
+)
 @click.option(
     "-p",
     "--progressive",
@@ -90,6 +113,165 @@ accumulate information/data over time.""",
     type=click.BOOL,
     default=True
 )
+@click.option(
+    "-w",
+    "--workers",
+    help="""number of processes used to read and combine the images \
+of each average. the partial sums from each process are added together, \
+so the result is the same as with a single process.""",
+    show_default=True,
+    required=False,
+    type=click.IntRange(min=1),
+    default=1
+)
+@click.option(
+    "-m",
+    "--max_dimension",
+    help="""largest width and height of the averages in 'resize' mode. \
+large photos are decoded at a reduced scale when this is much smaller than \
+their size, which saves a lot of time and memory.""",
+    show_default=True,
+    required=False,
+    type=click.IntRange(min=2),
+    default=None
+)
+@click.option(
+    "-s",
+    "--sum_type",
+    help="""data type used to sum the images. 'float64' is the most \
+accurate. 'uint32' (exact for unscaled images) needs half the memory. \
+'float32' also needs half the memory: it sums a few images at a time in \
+float32 and adds them to a float64 sum kept on disk (in memmap_dir). \
+'memmap' keeps a float64 sum on disk and works through it in strips, so \
+memory use doesn't grow with the output size.""",
+    show_default=True,
+    required=False,
+    type=click.Choice(
+        ["float64", "float32", "uint32", "memmap"],
+        case_sensitive=False
+    ),
+    default="float64"
+)
+@click.option(
+    "-r",
+    "--resampler",
+    help="""resampling backend for 'resize' mode. 'pillow' is fast and \
+works on 8 bit images, 'skimage' works in floating point and has the \
+highest fidelity but is slow and uses a lot of memory.""",
+    show_default=True,
+    required=False,
+    type=click.Choice(["pillow", "skimage"], case_sensitive=False),
+    default="pillow"
+)
+@click.option(
+    "--memmap_dir",
+    help="""directory for the temporary files of the 'memmap' sum type. \
+defaults to the system temporary directory.""",
+    show_default=True,
+    required=False,
+    type=click.STRING,
+    default=None
+)
+@click.option(
+    "-x",
+    "--exact_stretch",
+    help="""find the contrast stretch bounds of each average exactly, by \
+sorting all of its pixels. by default they're estimated from a fine \
+histogram, which is much faster for large images and at most one grey \
+level off.""",
+    show_default=True,
+    required=False,
+    type=click.BOOL,
+    default=False
+)
+@click.option(
+    "-z",
+    "--prepared_cache_size",
+    help="""size limit in MB of a cache of decoded and cropped, padded or \
+resized images, kept in .avg_cache/prepared. images used again, by \
+another average or a later run, are then loaded without decoding them. \
+0 disables the cache.""",
+    show_default=True,
+    required=False,
+    type=click.IntRange(min=0),
+    default=0
+)
+@click.option(
+    "--prefetch",
+    help="""number of images read and prepared in background threads while \
+the current one is added to the average. 0 reads one image at a time.""",
+    show_default=True,
+    required=False,
+    type=click.IntRange(min=0),
+    default=4
+)
+@click.option(
+    "--prefetch_memory",
+    help="""limit in MB on the memory held by prefetched images.""",
+    show_default=True,
+    required=False,
+    type=click.IntRange(min=1),
+    default=1024
+)
+@click.option(
+    "--memory_budget",
+    help="""memory in MB the sums of a run should fit in. when the \
+estimated memory of a year or an average is over it, fewer processes are \
+used, then the 'uint32' sum type for 8 bit images, then the 'memmap' sum \
+type, and the chosen way is printed.""",
+    show_default=True,
+    required=False,
+    type=click.IntRange(min=1),
+    default=4096
+)
+@click.option(
+    "--dry_run",
+    help="""print the plan of the run, every average that would be \
+written or skipped, the number of photos to decode, the cached sums used \
+and the estimated memory, without reading any photos or creating, changing \
+or deleting anything on disk.""",
+    show_default=True,
+    required=False,
+    type=click.BOOL,
+    default=False
+)
+@click.option(
+    "--plan_json",
+    help="""also write the plan of the run to this file as json.""",
+    show_default=True,
+    required=False,
+    type=click.STRING,
+    default=None
+)
+@click.option(
+    "--manifest",
+    help="""record the photos every average is made from in the output \
+directory, and make an existing average again when its photos have \
+changed. otherwise existing averages are always skipped.""",
+    show_default=True,
+    required=False,
+    type=click.BOOL,
+    default=True
+)
+@click.option(
+    "--embed_metadata",
+    help="""write the tags of each average along with the jpeg, in one \
+pass. otherwise, or for tags this can't write, exiftool adds them once the \
+image is written.""",
+    show_default=True,
+    required=False,
+    type=click.BOOL,
+    default=True
+)
+@click.option(
+    "--metadata_index",
+    help="""keep the metadata of every photo in .avg_cache/metadata.sqlite, \
+so later runs only read new or changed photos with exiftool.""",
+    show_default=True,
+    required=False,
+    type=click.BOOL,
+    default=True
+)
 def main(
     image_path,
     output_path,
@@ -98,7 +280,24 @@ def main(
     author,
     flickr_set_id,
     cache,
-    progressive
+    cache_size,
+    cache_content_hash,
+    progressive,
+    workers,
+    max_dimension,
+    sum_type,
+    resampler,
+    memmap_dir,
+    exact_stretch,
+    prepared_cache_size,
+    prefetch,
+    prefetch_memory,
+    memory_budget,
+    dry_run,
+    plan_json,
+    manifest,
+    embed_metadata,
+    metadata_index
 ):
     """
     Main function to parse commandline arguments and start the averaging
@@ -108,32 +307,67 @@ def main(
         author,
         "all rights reserved"
     )
+    cwd = os.getcwd()
+    default_cache_path = Path(cwd) / '.avg_cache'
+    if prepared_cache_size:
+        prepared_cache = default_cache_path / "prepared"
+    else:
+        prepared_cache = None
+    if metadata_index:
+        metadata_index_file = default_cache_path / "metadata.sqlite"
+    else:
+        metadata_index_file = None
     photo_averager = Averager(
         Path(image_path),
         Path(output_path),
         metadata_generator,
         grouping_tag=grouping_tag,
-        comb_method=combination_method
+        comb_method=combination_method,
+        num_workers=workers,
+        max_dimension=max_dimension,
+        accumulator_type=sum_type,
+        resampler=resampler,
+        memmap_dir=memmap_dir,
+        exact_stretch=exact_stretch,
+        prepared_cache_dir=prepared_cache,
+        prepared_cache_bytes=prepared_cache_size * 2 ** 20,
+        prefetch_depth=prefetch,
+        prefetch_bytes=prefetch_memory * 2 ** 20,
+        memory_budget=memory_budget * 2 ** 20,
+        average_cache_bytes=cache_size * 2 ** 20,
+        average_cache_content_hash=cache_content_hash,
+        use_manifest=manifest,
+        embed_metadata=embed_metadata,
+        metadata_index_file=metadata_index_file,
+        # a dry run plans without creating or changing anything on disk
+        read_only=dry_run
     )
     if cache:
-        cwd = os.getcwd()
-        default_cache_path = Path(cwd) / '.avg_cache'
-        default_cache_path.mkdir(exist_ok=True)
-        month_cache = default_cache_path / "monthly"
-        year_cache = default_cache_path / "yearly"
+        # months and years share their cached averages
+        month_cache = default_cache_path / "averages"
+        year_cache = month_cache
     else:
         month_cache = None
         year_cache = None
-    # dailies
-    daily_average_list = photo_averager.average_by_day()
+    plan = photo_averager.plan_all(month_cache, year_cache, progressive)
+    if plan_json:
+        plan.write_json(plan_json)
+    if dry_run:
+        print(plan.describe())
+        return
+    # dailies, monthlies and yearlies in one pass over the images
+    daily_average_list, _, _ = photo_averager.average_all(
+        month_cache,
+        year_cache,
+        progressive,
+        plan
+    )
     if flickr_set_id:
         flickr_uploader = FlickrUploader("./config.yaml")
         for fname in daily_average_list:
-            flickr_uploader.upload(fname, flickr_set_id)
-    # monthlies
-    photo_averager.average_by_month(month_cache, progressive)
-    # yearly
-    photo_averager.average_by_year(year_cache, progressive)
+            with photo_averager.metrics.stage(UPLOAD, fname.stat().st_size):
+                flickr_uploader.upload(fname, flickr_set_id)
+        photo_averager.write_metrics()
 
 
 if __name__ == "__main__":
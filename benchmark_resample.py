@@ -0,0 +1,70 @@
+from pathlib import Path
+from timeit import default_timer as timer
+
+import click
+import numpy as np
+
+from photomanip import RESIZE, SKIMAGE
+from photomanip.manipulator import ImageManipulatorSKI, RESAMPLERS
+
+
+@click.command()
+@click.option(
+    "-i",
+    "--image_path",
+    help="path of a directory of images to resize",
+    required=True,
+    type=click.STRING
+)
+@click.option(
+    "-d",
+    "--dimension",
+    help="dimension the images are resized to",
+    show_default=True,
+    required=False,
+    type=click.IntRange(min=2),
+    default=1024
+)
+@click.option(
+    "-n",
+    "--num_images",
+    help="maximum number of images to use",
+    show_default=True,
+    required=False,
+    type=click.IntRange(min=1),
+    default=20
+)
+def main(image_path, dimension, num_images):
+    """
+    Resizes the same images with every resampling backend and reports how
+    long each one took and how far its pixels are from the skimage backend.
+    """
+    image_list = sorted(Path(image_path).glob('**/*.jpg'))[:num_images]
+    if not image_list:
+        raise click.UsageError(f"no .jpg files found in {image_path}")
+    reader = ImageManipulatorSKI()
+    decoded = [reader._even_image(reader._read_image(fname))
+               for fname in image_list]
+
+    results = {}
+    for name in RESAMPLERS:
+        manipulator = ImageManipulatorSKI(resampler=name)
+        start = timer()
+        resized = [manipulator._prepare_image(image, RESIZE, dimension)
+                   for image in decoded]
+        results[name] = (timer() - start, resized)
+
+    reference = results[SKIMAGE][1]
+    print(f"{len(decoded)} images resized to {dimension}px")
+    for name, (elapsed, resized) in results.items():
+        errors = [np.abs(image.astype(float) - ref_image)
+                  for image, ref_image in zip(resized, reference)]
+        mean_error = np.mean([np.mean(error) for error in errors])
+        max_error = np.max([np.max(error) for error in errors])
+        print(f"{name:>8}: {elapsed:8.3f} s "
+              f"({len(decoded) / elapsed:7.1f} images/s), "
+              f"mean abs error {mean_error:.3f}, max abs error {max_error:.1f}")
+
+
+if __name__ == "__main__":
+    main()
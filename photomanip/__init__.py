@@ -4,3 +4,9 @@ SQUARE = 'square'
 PAD = 'pad'
 CROP = 'crop'
 RESIZE = 'resize'
+FLOAT64 = 'float64'
+FLOAT32 = 'float32'
+UINT32 = 'uint32'
+PILLOW = 'pillow'
+SKIMAGE = 'skimage'
+MEMMAP = 'memmap'
@@ -0,0 +1,326 @@
+import os
+import tempfile
+import weakref
+
+import numpy as np
+
+from photomanip import FLOAT64, FLOAT32, UINT32, MEMMAP
+
+# rows per strip for accumulators that work through the image in pieces
+STRIP_ROWS = 256
+
+
+class Accumulator:
+    """keeps a running sum of prepared images so they can be averaged with a
+    single division at the end."""
+    dtype = None
+    # the name `make_accumulator` knows the class by
+    accumulator_type = None
+
+    def __init__(self, dimension, depth=3, strip_rows=None):
+        self.dimension = dimension
+        self.depth = depth
+        # in-memory accumulators add whole images at once
+        self.strip_rows = strip_rows or dimension
+        self.sum = self._allocate()
+
+    def _allocate(self):
+        return np.zeros((self.dimension, self.dimension, self.depth),
+                        dtype=self.dtype)
+
+    @property
+    def nbytes(self):
+        """memory of every array the accumulator holds"""
+        return self.sum.nbytes
+
+    @classmethod
+    def estimate_nbytes(cls, dimension, depth=3):
+        """memory an accumulator of this type holds for an image of the given
+        size, before it's built"""
+        return dimension * dimension * depth * np.dtype(cls.dtype).itemsize
+
+    def strips(self):
+        """yields (start, stop) row ranges covering the accumulator"""
+        for start in range(0, self.dimension, self.strip_rows):
+            yield start, min(start + self.strip_rows, self.dimension)
+
+    def _add_rows(self, start, stop, rows, weight):
+        """adds `rows`, multiplied by `weight`, to rows `start:stop` of the
+        sum in place."""
+        raise NotImplementedError()
+
+    def add(self, image, weight=1):
+        """adds `image`, multiplied by `weight`, to the sum in place."""
+        for start, stop in self.strips():
+            self._add_rows(start, stop, image[start:stop], weight)
+
+    def add_padded(self, image, weight=1, fill=255):
+        """adds `image` centred in a square of `fill` values the size of the
+        accumulator (see `ImageManipulatorSKI._pad_image`), one strip at a
+        time so the padded image is never built in full."""
+        height, width, _ = image.shape
+        top = (self.dimension - height) // 2
+        left = (self.dimension - width) // 2
+        for start, stop in self.strips():
+            padded_rows = np.full(
+                (stop - start, self.dimension, image.shape[2]),
+                fill,
+                dtype=image.dtype
+            )
+            image_start = max(start, top)
+            image_stop = min(stop, top + height)
+            if image_start < image_stop:
+                padded_rows[image_start - start:image_stop - start,
+                            left:left + width] = \
+                    image[image_start - top:image_stop - top]
+            self._add_rows(start, stop, padded_rows, weight)
+
+    def start_from(self, total):
+        """starts an empty accumulator from the sum `total`, e.g. a cached
+        partial sum."""
+        self.add(total)
+
+    def merge(self, other):
+        """adds the sum held by another accumulator to this one."""
+        raise NotImplementedError()
+
+    def total(self):
+        """returns the sum as a float array."""
+        raise NotImplementedError()
+
+    def mean(self, num_images):
+        """returns the sum divided by `num_images`, leaving the sum intact."""
+        return self.total() / num_images
+
+    def finalize(self, num_images):
+        """returns the sum divided by `num_images`. the accumulator may reuse
+        its own memory for the result, so it can't be added to afterwards."""
+        return self.mean(num_images)
+
+
+class Float64Accumulator(Accumulator):
+    """plain float64 sum. the most accurate option, but uses 8 bytes per
+    sample."""
+    dtype = np.float64
+    accumulator_type = FLOAT64
+
+    def _add_rows(self, start, stop, rows, weight):
+        if weight != 1:
+            rows = rows * weight
+        target = self.sum[start:stop]
+        np.add(target, rows, out=target)
+
+    def merge(self, other):
+        for start, stop in self.strips():
+            target = self.sum[start:stop]
+            np.add(target, other.sum[start:stop], out=target)
+
+    def total(self):
+        return self.sum
+
+    def finalize(self, num_images):
+        for start, stop in self.strips():
+            target = self.sum[start:stop]
+            np.divide(target, num_images, out=target)
+        return self.sum
+
+
+class Float32Accumulator(Accumulator):
+    """float32 sum of the last few images, flushed into a float64 sum on disk
+    (a `MemmapAccumulator`, in `directory`) every `flush_images` images, so
+    only 4 bytes per sample are held in memory, half of
+    `Float64Accumulator`. 8 bit images add up exactly in float32 between
+    flushes, and other images lose no more than `flush_images` roundings
+    before they reach float64."""
+    dtype = np.float32
+    accumulator_type = FLOAT32
+    # images added between flushes
+    FLUSH_IMAGES = 64
+
+    def __init__(self, dimension, depth=3, strip_rows=None, directory=None,
+                 flush_images=FLUSH_IMAGES):
+        super().__init__(dimension, depth, strip_rows)
+        self.flush_images = flush_images
+        # images added since the last flush
+        self.pending = 0
+        self.flushed = MemmapAccumulator(
+            dimension,
+            depth,
+            directory=directory
+        )
+
+    @property
+    def nbytes(self):
+        # the flushed sum is worked on a strip at a time
+        return self.sum.nbytes + \
+            MemmapAccumulator.estimate_nbytes(self.dimension, self.depth)
+
+    @classmethod
+    def estimate_nbytes(cls, dimension, depth=3):
+        return super().estimate_nbytes(dimension, depth) + \
+            MemmapAccumulator.estimate_nbytes(dimension, depth)
+
+    def _add_rows(self, start, stop, rows, weight):
+        if weight != 1:
+            rows = rows * weight
+        target = self.sum[start:stop]
+        np.add(target, rows, out=target, casting='unsafe')
+
+    def _count(self):
+        self.pending += 1
+        if self.pending >= self.flush_images:
+            self.flush()
+
+    def add(self, image, weight=1):
+        super().add(image, weight)
+        self._count()
+
+    def add_padded(self, image, weight=1, fill=255):
+        super().add_padded(image, weight, fill)
+        self._count()
+
+    def flush(self):
+        """adds the float32 sum to the float64 one and empties it"""
+        if not self.pending:
+            return
+        self.flushed.add(self.sum)
+        self.sum.fill(0)
+        self.pending = 0
+
+    def start_from(self, total):
+        # straight into the float64 sum, a strip at a time
+        self.flushed.add(total)
+
+    def __getstate__(self):
+        # a worker's partial sum is handed over as the file of its flushed
+        # sum, without the float32 one
+        self.flush()
+        state = self.__dict__.copy()
+        state['sum'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.sum = self._allocate()
+
+    def merge(self, other):
+        other.flush()
+        self.flushed.merge(other.flushed)
+
+    def total(self):
+        self.flush()
+        return self.flushed.total()
+
+    def mean(self, num_images):
+        self.flush()
+        return self.flushed.mean(num_images)
+
+    def finalize(self, num_images):
+        self.flush()
+        return self.flushed.finalize(num_images)
+
+
+class UInt32Accumulator(Accumulator):
+    """exact integer sum of uint8 images, good for more than 16 million
+    images. images that aren't integers (resized or cached averages) are
+    rounded before they're added."""
+    dtype = np.uint32
+    accumulator_type = UINT32
+
+    def _add_rows(self, start, stop, rows, weight):
+        if weight != 1 or rows.dtype.kind == 'f':
+            rows = np.rint(rows * weight)
+        target = self.sum[start:stop]
+        np.add(target, rows, out=target, casting='unsafe')
+
+    def merge(self, other):
+        np.add(self.sum, other.sum, out=self.sum)
+
+    def total(self):
+        return self.sum.astype(np.float64)
+
+    def mean(self, num_images):
+        # the same float64 mean as `Float64Accumulator`, so the average of
+        # 8 bit images is identical whichever of the two summed them
+        return np.divide(self.sum, num_images, dtype=np.float64)
+
+
+class MemmapAccumulator(Float64Accumulator):
+    """float64 sum kept in a `numpy.memmap` and processed in strips of
+    `strip_rows` rows, so memory use doesn't grow with the output size.
+    `mean` and `finalize` return memmaps as well."""
+    accumulator_type = MEMMAP
+
+    def __init__(self, dimension, depth=3, strip_rows=STRIP_ROWS,
+                 directory=None):
+        self.directory = directory
+        super().__init__(dimension, depth, strip_rows)
+
+    @classmethod
+    def estimate_nbytes(cls, dimension, depth=3):
+        # the sum lives in the page cache, only a strip is in memory at once
+        strip_rows = min(STRIP_ROWS, dimension)
+        return strip_rows * dimension * depth * np.dtype(cls.dtype).itemsize
+
+    def _allocate(self):
+        file_descriptor, filename = tempfile.mkstemp(
+            suffix='.sum',
+            dir=self.directory
+        )
+        os.close(file_descriptor)
+        return self._open_memmap(filename, 'w+')
+
+    def _open_memmap(self, filename, mode):
+        array = np.memmap(
+            filename,
+            dtype=self.dtype,
+            mode=mode,
+            shape=(self.dimension, self.dimension, self.depth)
+        )
+        # the file goes away with the last reference to the array
+        self._remove_file = weakref.finalize(array, os.remove, filename)
+        return array
+
+    def __getstate__(self):
+        # hand the file over instead of pickling the whole sum, e.g. when a
+        # worker process returns its partial sum
+        self.sum.flush()
+        self._remove_file.detach()
+        state = self.__dict__.copy()
+        state['sum'] = self.sum.filename
+        del state['_remove_file']
+        return state
+
+    def __setstate__(self, state):
+        filename = state['sum']
+        self.__dict__.update(state)
+        self.sum = self._open_memmap(filename, 'r+')
+
+    def mean(self, num_images):
+        mean_accumulator = MemmapAccumulator(
+            self.dimension,
+            self.depth,
+            self.strip_rows,
+            self.directory
+        )
+        mean_image = mean_accumulator.sum
+        for start, stop in self.strips():
+            np.divide(self.sum[start:stop], num_images,
+                      out=mean_image[start:stop])
+        return mean_image
+
+
+ACCUMULATORS = {
+    FLOAT64: Float64Accumulator,
+    FLOAT32: Float32Accumulator,
+    UINT32: UInt32Accumulator,
+    MEMMAP: MemmapAccumulator,
+}
+
+
+def make_accumulator(accumulator_type, dimension, depth=3, **kwargs):
+    """builds an empty accumulator of type `accumulator_type`. any keyword
+    arguments are passed on to the accumulator class."""
+    if accumulator_type not in ACCUMULATORS:
+        raise ValueError('invalid value for accumulator_type')
+    return ACCUMULATORS[accumulator_type](dimension, depth, **kwargs)
@@ -1,24 +1,48 @@
-import hashlib
 import json
-import skimage
+import os
+import tempfile
 
-from collections import OrderedDict
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
+from itertools import accumulate, groupby
 from pathlib import Path
 from timeit import default_timer as timer
 
-from photomanip import PAD, CROP
+import numpy as np
+
+from photomanip import PAD, CROP, RESIZE, FLOAT64, PILLOW
+from photomanip.accumulator import STRIP_ROWS
+from photomanip.cache import (
+    DEFAULT_CACHE_BYTES,
+    PreparedImageCache,
+    prefix_hashes
+)
 from photomanip.grouper import (
     DAILY_DATETIME_FMT,
     MONTHLY_DATETIME_FMT,
     YEARLY_DATETIME_FMT,
-    FileSystemGrouper
+    FileSystemGrouper,
+    PrefixView
 )
+from photomanip.manifest import OutputManifest
 from photomanip.manipulator import ImageManipulatorSKI
 from photomanip.metadata import ImageExif
+from photomanip.metrics import (
+    CACHE_WRITE,
+    EXIF_WRITE,
+    METRICS_NAME,
+    RunMetrics
+)
+from photomanip.prefetch import PREFETCH_BYTES, PREFETCH_DEPTH
 
 SOFTWARE_NAME = "photomanip v.0.3.0"
 DATETIME_FMT = "%Y:%m:%d %H:%M:%S"
+# default size limit of the images in an `AverageCache`, in bytes
+AVERAGE_CACHE_BYTES = 4 * 2 ** 30
+# default memory that groups averaged side by side may use, in bytes
+MEMORY_BUDGET = 4 * 2 ** 30
 
 
 class ConstructMetadata:
@@ -156,46 +180,130 @@ class ConstructMetadata:
 
 
 class AverageCache:
+    """stores the sums of the prepared images of metadata lists, so later
+    averages that start with the same images can pick up from them. each
+    entry is a float32 `.npy` file that is memory mapped into the starting
+    sum on a hit, along with the number of images and the exposure time.
+
+    entries are indexed by a rolling hash of the fingerprints (path, size,
+    modification time and optionally content hash) of the files in their
+    metadata list, so an edited or replaced photo invalidates every entry it
+    is part of. the hash of every prefix of the reference list is computed
+    once, and `search` looks up the prefixes that have a cached length,
+    longest first. that's one dict lookup for every distinct cached length
+    up to the length of the list, not a single lookup: which prefixes are
+    cached isn't ordered by length, so the lengths can't be bisected. one
+    cache directory can be shared by monthly and yearly averages; daily
+    averages aren't cached.
+
+    entries are evicted once their files take up more than `max_bytes`,
+    lowest greedy-dual-size priority first: an entry's priority is the
+    cache's clock when it was last used plus its number of images per MB,
+    and the clock advances to the priority of every evicted entry, so
+    entries that are cheap to recompute and haven't been used in a while go
+    first. sums that no entry points to, left by a run that stopped between
+    writing a sum and adding its entry, are deleted when a cache is opened,
+    so they don't escape the budget.
+
+    a `read_only` cache can only be searched, e.g. to plan a dry run: its
+    directory isn't created, and nothing in it is deleted or written."""
     CACHE_NAME = "average_cache.json"
+    # changes whenever entries are hashed or stored differently
+    INDEX_VERSION = 3
 
-    def __init__(self, metalist, cache_path, fs_grouper, cache_size=2):
+    def __init__(self, metalist, cache_path, fs_grouper,
+                 max_bytes=AVERAGE_CACHE_BYTES, content_hash=False,
+                 read_only=False):
         self.reference_metalist = metalist
         self.cache_path = Path(cache_path)
-        self.cache_path.mkdir(exist_ok=True, parents=True)
-        self.cache_file = cache_path / self.CACHE_NAME
+        self.read_only = read_only
+        if not read_only:
+            self.cache_path.mkdir(exist_ok=True, parents=True)
+        self.cache_file = self.cache_path / self.CACHE_NAME
         self.fs_grouper = fs_grouper
-        self.cache_size = cache_size
-        self.cache_info = self._read_cache(self.cache_file)
-
-    def _sort_cache(self, cache_info):
-        return OrderedDict(
-                sorted(
-                    cache_info.items(),
-                    key=lambda item:
-                        item[1][self.fs_grouper.exif_datetime_key],
-                    reverse=True
-                )
-            )
+        self.max_bytes = max_bytes
+        # also fingerprint photos by a hash of their contents
+        self.content_hash = content_hash
+        self._prefix_hashes = None
+        self._read_cache(self.cache_file)
+        if not read_only:
+            self._delete_unindexed()
 
     def _read_cache(self, cache_file):
         # read a json file
+        self.cache_info = dict()
+        self.usage = dict()
+        self.clock = 0.0
         if cache_file.exists():
             with open(cache_file) as json_fp:
-                cache_info = json.load(json_fp)
-            # sort cache_info by created date
-            cache_info = self._sort_cache(cache_info)
-            return cache_info
-        else:
-            return dict()
+                cache_json = json.load(json_fp)
+            if cache_json.get("version") == self.INDEX_VERSION:
+                self.cache_info = cache_json["entries"]
+                self.usage = cache_json["usage"]
+                self.clock = cache_json["clock"]
+            elif not self.read_only:
+                # entries from other versions can't be used
+                self._delete_images(cache_json.get("entries", cache_json))
+        # forget entries whose image has been deleted
+        for cache_hash, cache_item in list(self.cache_info.items()):
+            if not Path(cache_item["SourceFile"]).exists():
+                del self.cache_info[cache_hash]
+                del self.usage[cache_hash]
+        self._index_lengths()
+
+    def _index_lengths(self):
+        # distinct cached lengths, sorted so the ones longer than a metalist
+        # can be cut off
+        self.cached_lengths = sorted({
+            cache_item["num_images"]
+            for cache_item in self.cache_info.values()
+        })
+
+    def _write_index(self):
+        # replace the index in one go so readers never see half of it
+        file_descriptor, temp_name = tempfile.mkstemp(
+            suffix=".tmp",
+            dir=self.cache_path
+        )
+        with os.fdopen(file_descriptor, "w") as json_fp:
+            json.dump({
+                "version": self.INDEX_VERSION,
+                "clock": self.clock,
+                "usage": self.usage,
+                "entries": self.cache_info
+            }, json_fp)
+        os.replace(temp_name, self.cache_file)
 
-    def _hash_from_metalist(self, metalist):
-        # just make a giant string with all the filenames and hash it?
-        filenames = [Path(item['SourceFile']).name for item in metalist]
-        name_string = ",".join(filenames)
-        return hashlib.sha1(name_string.encode()).hexdigest()
+    def _delete_unindexed(self):
+        # sums are only written once a cache is open, so any sum that isn't
+        # in the index by now never will be
+        indexed = {Path(cache_item["SourceFile"]).name
+                   for cache_item in self.cache_info.values()}
+        for pattern in ["*.npy", "*.npy.tmp"]:
+            for image_path in self.cache_path.glob(pattern):
+                if image_path.name not in indexed:
+                    image_path.unlink()
+
+    @staticmethod
+    def _delete_images(cache_info):
+        for cache_item in cache_info.values():
+            image_path = Path(cache_item["SourceFile"])
+            if image_path.exists():
+                image_path.unlink()
+
+    @property
+    def prefix_hashes(self):
+        """rolling hashes of the reference metalist: item i is the hash of its
+        first i + 1 photos. computed once, in a single pass."""
+        if self._prefix_hashes is None:
+            self._prefix_hashes = prefix_hashes(
+                self.reference_metalist,
+                self.content_hash
+            )
+        return self._prefix_hashes
 
     def _calculate_image_filepath(self, hash):
-        return self.cache_path / f"{hash[:13]}.tif"
+        return self.cache_path / f"{hash[:13]}.npy"
 
     def _generate_metalist_entry(
         self,
@@ -215,61 +323,671 @@ class AverageCache:
             "cached": True,
         }
 
-    def _prune_cache(self, cache_info):
-        # delete old cache images
-        for cache_item in list(cache_info.keys())[self.cache_size:]:
-            image_path = Path(cache_info[cache_item]["SourceFile"])
-            image_path.unlink()
-        # only store the most recent N caches
-        return {k: cache_info[k]
-                for k in list(cache_info.keys())[:self.cache_size]}
-
-    def _write_image(self, filename, image):
-        skimage.io.imsave(filename, image, check_contrast=False)
-
-    def search(self):
-        # want to get the latest match for this metalist, if any
-        for cache_hash, cache_item in self.cache_info.items():
-            # prune the metalist
-            images_in_cache = cache_item["num_images"]
-            pruned_metalist = self.reference_metalist[:images_in_cache]
-            # generate the hash for the pruned metalist
-            pruned_hash = self._hash_from_metalist(pruned_metalist)
-            if pruned_hash == cache_hash:
-                modified_metalist = [cache_item]
-                modified_metalist.extend(
-                    self.reference_metalist[images_in_cache:]
-                )
-                return modified_metalist
+    def _compatible(self, cache_item, comb_method, dimension):
+        """whether a cached average can be prepared to `dimension`: crops can
+        only shrink an image and padding can only grow it"""
+        cached_dimension = cache_item[self.fs_grouper.exif_height_key]
+        if dimension is None or comb_method == RESIZE:
+            return True
+        if comb_method == CROP:
+            return cached_dimension >= dimension
+        return cached_dimension <= dimension
+
+    def _touch(self, cache_hash):
+        """marks an entry as used"""
+        usage = self.usage[cache_hash]
+        num_images = self.cache_info[cache_hash]["num_images"]
+        usage["priority"] = \
+            self.clock + num_images / max(usage["bytes"] / 2 ** 20, 1e-6)
+
+    def _prune_cache(self):
+        # delete the lowest priority entries until the images fit the budget
+        total_bytes = sum(usage["bytes"] for usage in self.usage.values())
+        while total_bytes > self.max_bytes and self.usage:
+            cache_hash = min(
+                self.usage,
+                key=lambda item: self.usage[item]["priority"]
+            )
+            usage = self.usage.pop(cache_hash)
+            cache_item = self.cache_info.pop(cache_hash)
+            self.clock = usage["priority"]
+            total_bytes -= usage["bytes"]
+            image_path = Path(cache_item["SourceFile"])
+            if image_path.exists():
+                image_path.unlink()
+
+    @staticmethod
+    def write_sum(filename, cache_sum):
+        """writes a sum to the file of a cache entry. with `add_entry` this
+        splits `write_cache` in two, so the sum can be written by another
+        process."""
+        # write strip by strip into a temporary memory map, so neither the
+        # float32 copy nor a memory mapped sum is ever held in full
+        file_descriptor, temp_name = tempfile.mkstemp(
+            suffix=".npy.tmp",
+            dir=Path(filename).parent
+        )
+        os.close(file_descriptor)
+        stored_sum = np.lib.format.open_memmap(
+            temp_name,
+            mode="w+",
+            dtype=np.float32,
+            shape=cache_sum.shape
+        )
+        for start in range(0, cache_sum.shape[0], STRIP_ROWS):
+            stored_sum[start:start + STRIP_ROWS] = \
+                cache_sum[start:start + STRIP_ROWS]
+        stored_sum.flush()
+        del stored_sum
+        os.replace(temp_name, filename)
+
+    def search(self, prefix_lengths=None, comb_method=None, dimension=None,
+               touch=True):
+        """returns the reference metalist with its longest cached prefix
+        replaced by the cached sum. `prefix_lengths` restricts the
+        prefixes considered, and entries that can't be prepared to
+        `dimension` with `comb_method` are skipped. unless `touch` is false,
+        the entry found is marked as used, otherwise that's left to
+        `mark_used`."""
+        stop = bisect_right(self.cached_lengths, len(self.reference_metalist))
+        lengths = self.cached_lengths[:stop]
+        if prefix_lengths is not None:
+            prefix_lengths = set(prefix_lengths)
+            lengths = [length for length in lengths
+                       if length in prefix_lengths]
+        for images_in_cache in reversed(lengths):
+            cache_hash = self.prefix_hashes[images_in_cache - 1]
+            cache_item = self.cache_info.get(cache_hash)
+            if cache_item is None or \
+                    cache_item["num_images"] != images_in_cache or \
+                    not self._compatible(cache_item, comb_method, dimension):
+                continue
+            if touch:
+                self.mark_used(images_in_cache)
+            modified_metalist = [cache_item]
+            modified_metalist.extend(
+                self.reference_metalist[images_in_cache:]
+            )
+            return modified_metalist
         # empty cache
         return self.reference_metalist
 
+    def mark_used(self, num_images):
+        """marks the entry for the first `num_images` photos of the reference
+        metalist as used"""
+        if self.read_only:
+            return
+        cache_hash = self.prefix_hashes[num_images - 1]
+        # pick up entries written since this cache was opened
+        self._read_cache(self.cache_file)
+        if cache_hash in self.usage:
+            self._touch(cache_hash)
+            self._write_index()
+
     def write_cache(
         self,
-        cache_image,
+        cache_sum,
         common_dimension,
         time_exposed,
         num_images
     ):
-        new_hash = self._hash_from_metalist(self.reference_metalist)
-        # write the image to disk
-        cache_image_filename = self._calculate_image_filepath(new_hash)
-        self._write_image(cache_image_filename, cache_image)
+        """stores `cache_sum`, the sum (not the average) of the
+        `num_images` prepared images of the reference metalist"""
+        # write the sum to disk
+        self.write_sum(self.entry_filename, cache_sum)
+        self.add_entry(common_dimension, time_exposed, num_images)
+
+    @property
+    def entry_filename(self):
+        """file of the entry for the whole reference metalist"""
+        return self._calculate_image_filepath(self.prefix_hashes[-1])
+
+    def add_entry(self, common_dimension, time_exposed, num_images):
+        """adds the entry for the reference metalist, whose sum has been
+        written to `entry_filename`, to the index"""
+        new_hash = self.prefix_hashes[-1]
+        cache_image_filename = self.entry_filename
+        # pick up entries written since this cache was opened
+        self._read_cache(self.cache_file)
         # add the item to the cache
-        new_entry = self._generate_metalist_entry(
+        self.cache_info[new_hash] = self._generate_metalist_entry(
             common_dimension,
             time_exposed,
             num_images,
             str(cache_image_filename)
         )
-        self.cache_info[new_hash] = new_entry
-        # sort by datetime
-        self.cache_info = self._sort_cache(self.cache_info)
-        # prune old entries
-        pruned_cache = self._prune_cache(self.cache_info)
-        # write pruned cache to disk
-        with open(self.cache_file, "w") as json_fp:
-            json.dump(pruned_cache, json_fp)
+        self.usage[new_hash] = {
+            "bytes": cache_image_filename.stat().st_size,
+            "priority": self.clock
+        }
+        self._touch(new_hash)
+        # evict entries over the byte budget
+        self._prune_cache()
+        self._write_index()
+        self._index_lengths()
+
+
+class GroupAverage:
+    """one average of `Averager.average_photos`, worked out before any
+    photos are read so groups can be averaged in any process"""
+
+    def __init__(self, date_key, meta_list, output_name, dimension,
+                 num_images, exposure_time, cache_filename=None,
+                 inputs_hash=None, metadata=None, jpeg_metadata=None,
+                 period_name=None, supersedes=()):
+        self.date_key = date_key
+        self.meta_list = meta_list
+        self.output_name = output_name
+        self.dimension = dimension
+        self.num_images = num_images
+        self.exposure_time = exposure_time
+        # where the sum goes if the group is cached
+        self.cache_filename = cache_filename
+        # hash of the photos, for the manifest
+        self.inputs_hash = inputs_hash
+        # the period the average is of and the older averages of it that it
+        # replaces, see `OutputManifest.superseded`
+        self.period_name = period_name
+        self.supersedes = supersedes
+        # tags of the average, and the same as jpeg segments if they can be
+        # written with it
+        self.metadata = metadata
+        self.jpeg_metadata = jpeg_metadata
+        # how it's summed, see `Averager._choose_strategy`
+        self.strategy = None
+
+
+def average_group(manipulator, group, comb_method):
+    """sums the photos of a `GroupAverage`, writes the average and, if the
+    group is cached, its sum. the cache index is left to the caller, so this
+    can run in a worker process. returns the manipulator's metrics and
+    prepared image cache, see `ImageManipulatorSKI.merge_worker`."""
+    if group.strategy:
+        manipulator = manipulator.with_strategy(
+            group.strategy.accumulator_type,
+            group.strategy.num_workers
+        )
+    accumulator = manipulator.accumulate_images(
+        group.meta_list,
+        group.dimension,
+        group.num_images,
+        comb_method
+    )
+    # store the sum before it's turned into the average
+    if group.cache_filename:
+        with manipulator.metrics.stage(CACHE_WRITE) as counts:
+            AverageCache.write_sum(group.cache_filename, accumulator.total())
+            counts["bytes"] = Path(group.cache_filename).stat().st_size
+    group.output_name.parent.mkdir(exist_ok=True)
+    manipulator.save_composite(
+        accumulator.finalize(group.num_images),
+        group.output_name,
+        group.jpeg_metadata
+    )
+    return manipulator.metrics, manipulator.prepared_cache
+
+
+def _average_group_worker(manipulator, group, comb_method):
+    """`average_group` in a worker process"""
+    manipulator.start_worker()
+    return average_group(manipulator, group, comb_method)
+
+
+class DayTask:
+    """a day of a `MonthTask`: its photos, the day indices they are added to
+    the month's and the year's sums at (None for a sum that doesn't need
+    them) and the day's own average as a `GroupAverage`, or None if it isn't
+    written"""
+
+    def __init__(self, day_key, day_list, name, exposure_time, month_day=None,
+                 year_day=None, average=None, accumulator_type=None):
+        self.day_key = day_key
+        self.day_list = day_list
+        # the metrics group of the day
+        self.name = name
+        self.exposure_time = exposure_time
+        self.month_day = month_day
+        self.year_day = year_day
+        self.average = average
+        # type of the day's sum
+        self.accumulator_type = accumulator_type
+
+
+class MonthTask:
+    """a month of `Averager.average_all`, worked out before any photos are
+    read so a whole month can be summed in any process: the month's sum and
+    the averages written from it, keyed by the day index they end on, its
+    `DayTask`s, and the share of the year's sum its photos go into. the
+    share is handed over on each of `year_splits`, as year day indices."""
+
+    def __init__(self, month_key, days, dimension=None, accumulator_type=None,
+                 cached_item=None, first_day=0, outputs=None,
+                 cache_filename=None, year_dimension=None,
+                 year_accumulator_type=None, year_splits=(), memory=0):
+        self.month_key = month_key
+        self.days = days
+        # the month's sum, None if nothing is written from it
+        self.dimension = dimension
+        self.accumulator_type = accumulator_type
+        self.cached_item = cached_item
+        self.first_day = first_day
+        self.outputs = outputs or dict()
+        # where the month's sum goes if it's cached
+        self.cache_filename = cache_filename
+        self.year_dimension = year_dimension
+        self.year_accumulator_type = year_accumulator_type
+        self.year_splits = year_splits
+        # estimated memory of summing the month
+        self.memory = memory
+
+
+def _write_average(manipulator, accumulator, average, finalize=False):
+    """writes a `GroupAverage` from the sum of its photos"""
+    average.output_name.parent.mkdir(exist_ok=True)
+    if finalize:
+        composite_image = accumulator.finalize(average.num_images)
+    else:
+        composite_image = accumulator.mean(average.num_images)
+    manipulator.save_composite(
+        composite_image,
+        average.output_name,
+        average.jpeg_metadata
+    )
+
+
+def average_month(manipulator, task, comb_method, year_sum=None,
+                  hand_over=None):
+    """sums the photos of a `MonthTask` day by day into the month's sum,
+    their day's sum and the year's sum, reading each photo once, and writes
+    the daily and monthly averages as soon as the day they end on is done.
+    if the month is cached its sum is stored, the cache index is left to
+    the caller.
+
+    photos go into `year_sum`, or into a partial sum of the year made here
+    in a worker process. on each day of `task.year_splits`,
+    `hand_over(year day index, partial, num_images, exposure_time)` is called
+    with the partial (None if the photos went into `year_sum`) and the
+    photos and exposure time it holds, and a new partial is started if the
+    year needs later days. returns the daily and monthly averages written,
+    as lists of `GroupAverage`s, to be tagged and recorded by the caller."""
+    month_sum = None
+    if task.dimension is not None:
+        if task.cached_item:
+            month_sum = manipulator.load_cached_sum(
+                task.cached_item,
+                task.dimension,
+                comb_method,
+                accumulator_type=task.accumulator_type
+            )
+        else:
+            month_sum = manipulator.new_accumulator(
+                task.dimension,
+                task.accumulator_type
+            )
+    daily = []
+    monthly = []
+    # a cached sum may already cover the first average
+    for average in task.outputs.get(task.first_day - 1, []):
+        _write_average(manipulator, month_sum, average)
+        monthly.append(average)
+    partial = year_sum is None
+    num_images = 0
+    exposure_time = 0
+    for day in task.days:
+        with manipulator.metrics.group(day.name):
+            print(f"working on photos from {day.day_key}")
+            accumulators = []
+            if day.month_day is not None:
+                accumulators.append(month_sum)
+            if day.year_day is not None:
+                if year_sum is None:
+                    year_sum = manipulator.new_accumulator(
+                        task.year_dimension,
+                        task.year_accumulator_type
+                    )
+                accumulators.append(year_sum)
+            day_sum = None
+            if day.average is not None:
+                day_sum = manipulator.new_accumulator(
+                    day.average.dimension,
+                    day.accumulator_type
+                )
+                accumulators.append(day_sum)
+            manipulator.accumulate_images_multi(
+                day.day_list,
+                accumulators,
+                len(day.day_list),
+                comb_method
+            )
+            if day_sum is not None:
+                _write_average(manipulator, day_sum, day.average,
+                               finalize=True)
+                daily.append(day.average)
+            for average in task.outputs.get(day.month_day, []):
+                _write_average(manipulator, month_sum, average)
+                monthly.append(average)
+            if day.year_day is None:
+                continue
+            num_images += len(day.day_list)
+            exposure_time += day.exposure_time
+            if day.year_day in task.year_splits:
+                hand_over(
+                    day.year_day,
+                    year_sum if partial else None,
+                    num_images,
+                    exposure_time
+                )
+                num_images = 0
+                exposure_time = 0
+                if partial:
+                    year_sum = None
+    if task.cache_filename:
+        with manipulator.metrics.stage(CACHE_WRITE) as counts:
+            AverageCache.write_sum(task.cache_filename, month_sum.total())
+            counts["bytes"] = Path(task.cache_filename).stat().st_size
+    return daily, monthly
+
+
+def _average_month_worker(manipulator, task, comb_method):
+    """`average_month` in a worker process. returns the daily and monthly
+    averages written, the partial sums of the year as
+    (year day index, partial, num_images, exposure_time) and the
+    manipulator's metrics and prepared image cache."""
+    manipulator.start_worker()
+    year_parts = []
+    daily, monthly = average_month(
+        manipulator,
+        task,
+        comb_method,
+        hand_over=lambda *year_part: year_parts.append(year_part)
+    )
+    return (daily, monthly, year_parts, manipulator.metrics,
+            manipulator.prepared_cache)
+
+
+class Strategy:
+    """how a group is summed to fit in `Averager.memory_budget`: the type of
+    its accumulators, the number of processes and the estimated memory.
+    `fits` is false if even the leanest way is over the budget."""
+
+    def __init__(self, accumulator_type, num_workers, memory, fits=True):
+        self.accumulator_type = accumulator_type
+        self.num_workers = num_workers
+        self.memory = memory
+        self.fits = fits
+
+    def to_dict(self):
+        return {
+            "accumulator": self.accumulator_type,
+            "workers": self.num_workers,
+            "memory": self.memory,
+            "fits": self.fits,
+        }
+
+    def describe(self):
+        if self.num_workers == 1:
+            processes = "1 process"
+        else:
+            processes = f"{self.num_workers} processes"
+        text = f"{self.accumulator_type} sum, {processes}, " \
+            f"~{self.memory / 2 ** 20:.0f} MB"
+        if not self.fits:
+            text += ", over the memory budget"
+        return text
+
+
+class DayPlan:
+    """a day in `Averager.plan_all`: its photos, its own average and the
+    month and year sums its photos go into, as (period, day index) pairs"""
+
+    def __init__(self, day_key, day_list, output_name, periods,
+                 skip_reason=None, inputs_hash=None):
+        self.day_key = day_key
+        self.day_list = day_list
+        self.output_name = output_name
+        # why the day's average isn't written, None if it is
+        self.skip_reason = skip_reason
+        self.pending = skip_reason is None
+        self.inputs_hash = inputs_hash
+        self.periods = periods
+        self.dimension = None
+        # type of the day's sum, see `Averager._choose_year_strategy`
+        self.accumulator_type = None
+        # estimated memory to sum the day
+        self.memory = 0
+
+    @property
+    def decoded(self):
+        """whether the day's photos have to be read"""
+        return self.pending or bool(self.periods)
+
+
+class PeriodSum:
+    """running sum of a month or a year in `Averager.average_all`, along with
+    the averages it still has to write. `outputs` holds one
+    (last day index, date key, metadata list, output name) tuple per
+    average: just one for the whole period, or one per day if progressive.
+    `skip_reasons`, `input_hashes` and `supersedes` go along with `outputs`.
+    """
+
+    def __init__(self, period_key, outputs, skip_reasons, metadata_calculator,
+                 input_hashes=None, period_name=None, supersedes=None):
+        self.period_key = period_key
+        self.outputs = outputs
+        # why each average isn't written, None for those that are
+        self.skip_reasons = skip_reasons
+        # indices into `outputs` of the averages that need writing
+        self.pending = [index for index, reason in enumerate(skip_reasons)
+                        if reason is None]
+        self.input_hashes = input_hashes or [None] * len(outputs)
+        # the name of the period, if its averages are renamed as it grows,
+        # and the older averages each of them replaces
+        self.period_name = period_name
+        self.supersedes = supersedes or [[] for _ in outputs]
+        self.metadata_calculator = metadata_calculator
+        self.dimension = None
+        self.accumulator = None
+        self.num_images = 0
+        self.exposure_time = 0
+        # first day not covered by a cached sum
+        self.first_day = 0
+        # the cache entry the sum starts from, and the cache it's in
+        self.cached_item = None
+        self.avg_cacher = None
+        # the months of a year or the days of a month, see
+        # `Averager.plan_all`
+        self.parts = []
+        # type of the sum and its estimated memory
+        self.accumulator_type = None
+        self.memory = 0
+        # estimated memory of summing a month on its own, see
+        # `Averager._size_year`
+        self.task_memory = 0
+        # how the sums of a year are run, see `Averager.plan_all`
+        self.strategy = None
+
+    @property
+    def last_day(self):
+        """last day the sum has to include, -1 if nothing needs writing"""
+        if not self.pending:
+            return -1
+        return self.outputs[self.pending[-1]][0]
+
+    def needs_day(self, day_index):
+        return self.first_day <= day_index <= self.last_day
+
+
+class AveragePlan:
+    """what `Averager.average_all` will do, from `Averager.plan_all`: a
+    `PeriodSum` per year, with its months in `parts`, each with its days
+    (`DayPlan`s) in `parts`."""
+
+    def __init__(self, years):
+        self.years = years
+
+    @staticmethod
+    def _period_outputs(period, kind):
+        cached_images = 0
+        if period.cached_item:
+            cached_images = period.cached_item["num_images"]
+        outputs = []
+        for index, (_, date_key, meta_list, output_name) in \
+                enumerate(period.outputs):
+            output = {
+                "kind": kind,
+                "date": date_key.date().isoformat(),
+                "path": str(output_name),
+                "num_images": len(meta_list),
+            }
+            if index in period.pending:
+                output["action"] = "write"
+                output["dimension"] = period.dimension
+                # photos this average would read if it was made on its own
+                output["decodes"] = len(meta_list) - cached_images
+                if output_name.exists():
+                    output["reason"] = "photos changed"
+                if period.supersedes[index]:
+                    output["replaces"] = [
+                        str(stale_name)
+                        for stale_name in period.supersedes[index]
+                    ]
+            else:
+                output["action"] = "skip"
+                output["reason"] = period.skip_reasons[index]
+            outputs.append(output)
+        return outputs
+
+    @staticmethod
+    def _group(kind, date_key, sum_plan):
+        return {
+            "kind": kind,
+            "date": date_key.date().isoformat(),
+            "dimension": sum_plan.dimension,
+            "accumulator": sum_plan.accumulator_type,
+            "memory": sum_plan.memory,
+        }
+
+    def summary(self):
+        """the plan as a json serialisable dict: every average written or
+        skipped, every group summed with its dimension and estimated memory,
+        the cached sums used, the number of photos decoded and how many
+        decodes are saved by sharing them between averages, and the
+        estimated peak memory."""
+        outputs = []
+        groups = []
+        cache_hits = []
+        strategies = []
+        decodes = 0
+        peak_memory = 0
+        for year in self.years:
+            strategy = {
+                "kind": "yearly",
+                "date": year.period_key.date().isoformat(),
+            }
+            strategy.update(year.strategy.to_dict())
+            strategies.append(strategy)
+            peak_memory = max(peak_memory, year.strategy.memory)
+            outputs.extend(self._period_outputs(year, "yearly"))
+            for month in year.parts:
+                outputs.extend(self._period_outputs(month, "monthly"))
+                for day in month.parts:
+                    output = {
+                        "kind": "daily",
+                        "date": day.day_key.date().isoformat(),
+                        "path": str(day.output_name),
+                        "num_images": len(day.day_list),
+                    }
+                    if day.pending:
+                        output["action"] = "write"
+                        output["dimension"] = day.dimension
+                        output["decodes"] = len(day.day_list)
+                        if day.output_name.exists():
+                            output["reason"] = "photos changed"
+                    else:
+                        output["action"] = "skip"
+                        output["reason"] = day.skip_reason
+                    outputs.append(output)
+                    if not day.decoded:
+                        continue
+                    decodes += len(day.day_list)
+                    groups.append(self._group("daily", day.day_key, day))
+            for period, kind in [(year, "yearly")] + \
+                    [(month, "monthly") for month in year.parts]:
+                if period.pending:
+                    groups.append(self._group(
+                        kind,
+                        period.period_key,
+                        period
+                    ))
+                if period.cached_item:
+                    cache_hits.append({
+                        "kind": kind,
+                        "date": period.period_key.date().isoformat(),
+                        "num_images": period.cached_item["num_images"],
+                    })
+        separate_decodes = sum(output.get("decodes", 0) for output in outputs)
+        return {
+            "outputs": outputs,
+            "written": sum(output["action"] == "write" for output in outputs),
+            "skipped": sum(output["action"] == "skip" for output in outputs),
+            "decodes": decodes,
+            "shared_decodes": max(separate_decodes - decodes, 0),
+            "cache_hits": cache_hits,
+            "groups": groups,
+            "strategies": strategies,
+            "peak_memory": peak_memory,
+        }
+
+    def describe(self):
+        """the plan as readable text"""
+        summary = self.summary()
+        lines = []
+        for output in summary["outputs"]:
+            if output["action"] == "write":
+                replaced = ""
+                if "reason" in output:
+                    replaced = f", {output['reason']}"
+                if "replaces" in output:
+                    replaced += f", replaces {', '.join(output['replaces'])}"
+                lines.append(
+                    f"write {output['kind']} {output['date']}: "
+                    f"{output['path']} ({output['num_images']} photos, "
+                    f"{output['dimension']} px{replaced})"
+                )
+            else:
+                lines.append(
+                    f"skip {output['kind']} {output['date']}: "
+                    f"{output['path']} ({output['reason']})"
+                )
+        for group in summary["groups"]:
+            lines.append(
+                f"{group['kind']} sum {group['date']}: "
+                f"{group['dimension']} px, {group['accumulator']}, "
+                f"~{group['memory'] / 2 ** 20:.0f} MB"
+            )
+        for year, strategy in zip(self.years, summary["strategies"]):
+            lines.append(
+                f"{strategy['kind']} {strategy['date']}: "
+                f"{year.strategy.describe()}"
+            )
+        cached_images = sum(hit["num_images"]
+                            for hit in summary["cache_hits"])
+        lines.extend([
+            f"{summary['written']} averages to write, "
+            f"{summary['skipped']} skipped",
+            f"{summary['decodes']} photos to decode, "
+            f"{summary['shared_decodes']} decodes saved by sharing them "
+            "between averages",
+            f"{len(summary['cache_hits'])} cached sums used, covering "
+            f"{cached_images} photos",
+            f"estimated peak memory: "
+            f"~{summary['peak_memory'] / 2 ** 20:.0f} MB",
+        ])
+        return "\n".join(lines)
+
+    def write_json(self, filename):
+        with open(filename, "w") as json_fp:
+            json.dump(self.summary(), json_fp, indent=2)
 
 
 class Averager:
@@ -280,26 +998,96 @@ class Averager:
         output_path: Path,
         metadata_generator: ConstructMetadata,
         grouping_tag=None,
-        comb_method=CROP
+        comb_method=CROP,
+        num_workers=1,
+        max_dimension=None,
+        accumulator_type=FLOAT64,
+        resampler=PILLOW,
+        memmap_dir=None,
+        exact_stretch=False,
+        prepared_cache_dir=None,
+        prepared_cache_bytes=DEFAULT_CACHE_BYTES,
+        prefetch_depth=PREFETCH_DEPTH,
+        prefetch_bytes=PREFETCH_BYTES,
+        average_cache_bytes=AVERAGE_CACHE_BYTES,
+        average_cache_content_hash=False,
+        memory_budget=MEMORY_BUDGET,
+        use_manifest=True,
+        metrics=None,
+        embed_metadata=True,
+        metadata_index_file=None,
+        read_only=False
     ):
         self.output_path = output_path
-        self.output_path.mkdir(exist_ok=True)
+        # a read only averager is only for `plan_all`, e.g. for a dry run:
+        # it creates, deletes and writes nothing
+        self.read_only = read_only
+        if not read_only:
+            self.output_path.mkdir(exist_ok=True)
+        # times every stage of the run, see `photomanip.metrics`. hooks can
+        # be added to it to follow a run as it happens.
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        # photos each average was made from, so averages whose photos have
+        # changed are made again
+        if use_manifest:
+            self.manifest = OutputManifest(output_path)
+        else:
+            self.manifest = None
         self.comb_method = comb_method
+        # largest output dimension in resize mode
+        self.max_dimension = max_dimension
         self.metadata_generator = metadata_generator
         # make an exif setter
         self.exiftool = ImageExif()
-        # build grouper
+        # write tags along with the jpeg where possible, instead of with
+        # exiftool once it's written
+        self.embed_metadata = embed_metadata
+        # build grouper, reading only new or changed photos with exiftool
+        # if there's an index
         self.grouping_tag = grouping_tag
-        self.fs_grouper = FileSystemGrouper(grouping_path, grouping_tag)
+        self.fs_grouper = FileSystemGrouper(
+            grouping_path,
+            grouping_tag,
+            metrics=self.metrics,
+            index_file=metadata_index_file,
+            lazy=True,
+            read_only=read_only
+        )
+        # processes used for the groups in `average_photos`, which are
+        # passed on to the manipulator for single groups
+        self.num_workers = num_workers
+        # estimated memory the groups running at once may use
+        self.memory_budget = memory_budget
+        # size limit of each directory of cached averages
+        self.average_cache_bytes = average_cache_bytes
+        # whether cached averages also check the contents of the photos
+        self.average_cache_content_hash = average_cache_content_hash
+        # keep prepared images around for other averages and later runs
+        if prepared_cache_dir and not read_only:
+            self.prepared_cache = PreparedImageCache(
+                prepared_cache_dir,
+                prepared_cache_bytes
+            )
+        else:
+            self.prepared_cache = None
         # instantiate manipulator
-        self.manipulator = ImageManipulatorSKI()
+        self.manipulator = ImageManipulatorSKI(
+            num_workers=num_workers,
+            accumulator_type=accumulator_type,
+            resampler=resampler,
+            memmap_dir=memmap_dir,
+            exact_stretch=exact_stretch,
+            prepared_cache=self.prepared_cache,
+            prefetch_depth=prefetch_depth,
+            prefetch_bytes=prefetch_bytes,
+            metrics=self.metrics
+        )
 
     def _calculate_day_avg_path(self, date_key, meta_list=None):
         date = date_key.strftime(DAILY_DATETIME_FMT)
         fname = f"{date}.jpg"
         month_number = date_key.strftime('%m')
         month_path = self.output_path / month_number
-        month_path.mkdir(exist_ok=True)
         return month_path / fname
 
     def _calculate_month_avg_path(self, date_key, meta_list=None):
@@ -346,6 +1134,120 @@ class Averager:
         fname = f"{fname_stem}{suffix}.jpg"
         return self.output_path / fname
 
+    def _average_cache(self, meta_list, cache_path):
+        return AverageCache(
+            meta_list,
+            cache_path,
+            self.fs_grouper,
+            self.average_cache_bytes,
+            self.average_cache_content_hash,
+            self.read_only
+        )
+
+    def _input_hashes(self, meta_list):
+        """hashes of the prefixes of `meta_list` for the manifest, see
+        `photomanip.cache.prefix_hashes`"""
+        if self.manifest is None:
+            return [None] * len(meta_list)
+        return prefix_hashes(meta_list, self.average_cache_content_hash)
+
+    def _skip_reason(self, meta_list, output_name, inputs_hash=None):
+        """why an average won't be written, or None if it will"""
+        if len(meta_list) == 1:
+            return "only one photo"
+        if self.manifest is None:
+            if output_name.exists():
+                return "already generated"
+        elif self.manifest.is_current(output_name, inputs_hash):
+            return "already generated"
+        return None
+
+    def _print_skip(self, date_key, output_name, reason):
+        if reason == "only one photo":
+            print(f"only one photo for {date_key}, skipping")
+        elif reason:
+            print(f"file {output_name} already generated, skipping")
+
+    def _superseded(self, output_name, period_name, input_hashes):
+        """older averages of the same month or year that `output_name`
+        replaces, see `OutputManifest.superseded`"""
+        if self.manifest is None:
+            return []
+        return self.manifest.superseded(
+            output_name,
+            period_name,
+            input_hashes
+        )
+
+    def _record_output(self, output_name, inputs_hash, num_images,
+                       period_name=None, supersedes=()):
+        """notes an average that was just written and removes the older
+        averages it replaces"""
+        if self.manifest is None:
+            return
+        self.manifest.record(output_name, inputs_hash, num_images,
+                             period_name)
+        for stale_name in supersedes:
+            print(f"removing {stale_name}, replaced by {output_name}")
+            self.manifest.remove(stale_name)
+
+    def _save_manifest(self):
+        if self.manifest is not None:
+            self.manifest.save()
+
+    def _jpeg_metadata(self, calculated_meta):
+        """the tags of an average as jpeg segments, or None if they have to
+        be written with exiftool"""
+        if not self.embed_metadata:
+            return None
+        with self.metrics.stage(EXIF_WRITE) as counts:
+            jpeg_metadata = self.exiftool.jpeg_metadata(calculated_meta)
+            if jpeg_metadata is not None:
+                counts["bytes"] = sum(
+                    len(segment) for segment in jpeg_metadata.values()
+                )
+        return jpeg_metadata
+
+    def _save_average(self, composite_image, output_name, calculated_meta):
+        """writes an average with its tags, in the same pass as the jpeg if
+        possible and otherwise with exiftool afterwards"""
+        jpeg_metadata = self._jpeg_metadata(calculated_meta)
+        self.manipulator.save_composite(
+            composite_image,
+            output_name,
+            jpeg_metadata
+        )
+        if jpeg_metadata is None:
+            self._set_metadata(output_name, calculated_meta)
+
+    def _set_metadata(self, output_name, calculated_meta):
+        with self.metrics.stage(EXIF_WRITE):
+            self.exiftool.set_image_metadata(
+                str(output_name),
+                calculated_meta
+            )
+
+    def _write_cache(self, avg_cacher, cache_sum, common_dimension,
+                     time_exposed, num_images):
+        # sums are stored as float32
+        with self.metrics.stage(CACHE_WRITE, 4 * cache_sum.size):
+            avg_cacher.write_cache(
+                cache_sum,
+                common_dimension,
+                time_exposed,
+                num_images
+            )
+
+    def write_metrics(self):
+        """writes the metrics of the run so far next to the averages, see
+        `photomanip.metrics.RunMetrics.report`"""
+        self.metrics.write_json(self.output_path / METRICS_NAME)
+
+    def _print_cache_stats(self):
+        if self.prepared_cache:
+            print(f"prepared image cache: {self.prepared_cache.hits} hits, "
+                  f"{self.prepared_cache.misses} misses")
+
     def _calculate_num_images(self, metalist):
         count = 0
         for item in metalist:
@@ -355,6 +1257,68 @@ class Averager:
                 count += 1
         return count
 
+    def _split_by_day(self, meta_list):
+        """splits a date-sorted metadata list into (day, metadata list) pairs"""
+        def day_key(metadata):
+            date = self.fs_grouper.date_extractor(
+                metadata,
+                self.grouping_tag,
+                DAILY_DATETIME_FMT
+            )
+            return datetime(date.year, date.month, date.day)
+        return [(day, list(day_list))
+                for day, day_list in groupby(meta_list, key=day_key)]
+
+    def _finish_group(self, group):
+        """tags the average of a group once it's been written, unless its
+        tags were written with it"""
+        if group.jpeg_metadata is None:
+            self._set_metadata(group.output_name, group.metadata)
+        self._record_output(
+            group.output_name,
+            group.inputs_hash,
+            group.num_images,
+            group.period_name,
+            group.supersedes
+        )
+
+    def _average_groups_parallel(self, groups):
+        """averages `groups` in `self.num_workers` processes, one group per
+        process. groups are started in order as long as their estimated
+        memory fits in `self.memory_budget` next to the groups already
+        running; one group is always admitted. tagging happens in this
+        process."""
+        worker_manipulator = self.manipulator
+        waiting = deque(groups)
+        running = {}
+        running_bytes = 0
+        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            while waiting or running:
+                while waiting and len(running) < self.num_workers:
+                    group_bytes = waiting[0].strategy.memory
+                    if running and \
+                            running_bytes + group_bytes > self.memory_budget:
+                        break
+                    group = waiting.popleft()
+                    print(f"working on photos from {group.date_key}")
+                    future = executor.submit(
+                        _average_group_worker,
+                        worker_manipulator,
+                        group,
+                        self.comb_method
+                    )
+                    running[future] = (group, group_bytes)
+                    running_bytes += group_bytes
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    group, group_bytes = running.pop(future)
+                    running_bytes -= group_bytes
+                    self.manipulator.merge_worker(
+                        *future.result(),
+                        group=group.output_name.name
+                    )
+                    self._finish_group(group)
+
     def average_photos(
         self,
         meta_dict,
@@ -362,68 +1326,252 @@ class Averager:
         metadata_calculator,
         cache_path=None
     ):
+        """averages each group of photos in `meta_dict`, a dict or an
+        iterable of (date key, metadata list) pairs, into its own image.
+
+        with `cache_path`, the sums of the groups are only added to the cache
+        once every group is done, so pruning the cache can't delete a sum a
+        group is still reading. a group can't start from the sum of another
+        group of the same run; it's there for the next run."""
         average_images = []
         start = timer()
-        for date_key, meta_list in meta_dict.items():
-            if len(meta_list) == 1:
-                print(f"only one photo for {date_key}, skipping")
-                continue
+        groups = []
+        cached_groups = []
+        if isinstance(meta_dict, dict):
+            meta_dict = meta_dict.items()
+        for date_key, meta_list in meta_dict:
             # calculate output name
             output_name = path_calculator(date_key, meta_list)
-            # has this image already been generated?
-            if output_name.exists():
-                print(f"file {output_name} already generated, skipping")
+            input_hashes = self._input_hashes(meta_list)
+            inputs_hash = input_hashes[-1]
+            # has this image already been generated from these photos?
+            reason = self._skip_reason(meta_list, output_name, inputs_hash)
+            if reason:
+                self._print_skip(date_key, output_name, reason)
                 continue
+            # the name without the photos is the same however many days the
+            # average covers
+            period_name = path_calculator(date_key)
+            supersedes = self._superseded(
+                output_name,
+                period_name,
+                input_hashes
+            )
             # store filename for bookkeeping
             average_images.append(output_name)
-            print(f"working on photos from {date_key}")
+            avg_cacher = None
             if cache_path:
                 # check if we have a valid cache entry
-                avg_cacher = AverageCache(
+                avg_cacher = self._average_cache(
                     meta_list,
-                    cache_path,
-                    self.fs_grouper
+                    cache_path
                 )
                 meta_list = avg_cacher.search()
             # calculate output dimension
             common_dimension = self.fs_grouper.get_common_dimension(
                 self.comb_method,
-                meta_list
+                meta_list,
+                self.max_dimension
             )
             num_images = self._calculate_num_images(meta_list)
             exposure_time = self.fs_grouper.get_total_exposure(meta_list)
-            # combine the images, write the result
-            combined = self.manipulator.combine_images(
-                meta_list,
-                common_dimension,
-                num_images,
-                output_name,
-                self.comb_method
-            )
-            # add metadata as appropriate
             calculated_meta = metadata_calculator(
                 date_key,
                 num_images,
                 exposure_time
             )
-            # add this item to our cache, if there's a cache dir
-            if cache_path:
-                avg_cacher.write_cache(
-                    combined,
+            group = GroupAverage(
+                date_key,
+                meta_list,
+                output_name,
+                common_dimension,
+                num_images,
+                exposure_time,
+                inputs_hash=inputs_hash,
+                metadata=calculated_meta,
+                jpeg_metadata=self._jpeg_metadata(calculated_meta),
+                period_name=period_name,
+                supersedes=supersedes
+            )
+            if avg_cacher:
+                group.cache_filename = avg_cacher.entry_filename
+                cached_groups.append((group, avg_cacher))
+            groups.append(group)
+        # many groups are run side by side, each in a single process, and a
+        # single group is split across the workers instead
+        side_by_side = self.num_workers > 1 and len(groups) > 1
+        for group in groups:
+            group.strategy = self._choose_strategy(
+                lambda accumulator_type, num_workers:
+                    self.manipulator.estimate_memory(
+                        group.dimension,
+                        accumulator_type,
+                        num_workers
+                    ),
+                serial=side_by_side
+            )
+            print(f"{group.output_name.name}: {group.strategy.describe()}")
+        if side_by_side:
+            self._average_groups_parallel(groups)
+        else:
+            # a group split across the workers reuses one pool of them
+            with self.manipulator.worker_pool(self.num_workers):
+                for group in groups:
+                    print(f"working on photos from {group.date_key}")
+                    with self.metrics.group(group.output_name.name):
+                        average_group(
+                            self.manipulator,
+                            group,
+                            self.comb_method
+                        )
+                        # add metadata as appropriate
+                        self._finish_group(group)
+        # cache entries are only added once nothing is reading cached sums
+        # any more, so making room for them can't delete a sum still in use
+        for group, avg_cacher in cached_groups:
+            avg_cacher.add_entry(
+                group.dimension,
+                group.exposure_time,
+                group.num_images
+            )
+        self._save_manifest()
+        self.write_metrics()
+        end = timer()
+        self._print_cache_stats()
+        return end - start, average_images
+
+    def average_photos_progressive(
+        self,
+        meta_dict,
+        path_calculator,
+        metadata_calculator,
+        cache_path=None
+    ):
+        """like `average_photos`, but writes one average for every day of each
+        group in `meta_dict`, covering all photos from the start of the group
+        up to and including that day. each group keeps a single running sum,
+        so every photo is decoded once no matter how many averages it is
+        part of."""
+        average_images = []
+        start = timer()
+        if isinstance(meta_dict, dict):
+            meta_dict = meta_dict.items()
+        for period_key, period_list in meta_dict:
+            # work out every progressive average this group would produce
+            outputs = []
+            input_hashes = self._input_hashes(period_list)
+            stop = 0
+            for day_key, day_list in self._split_by_day(period_list):
+                stop += len(day_list)
+                # a view of the group's list, not a copy per day
+                meta_list = PrefixView(period_list, period_key, 0, stop)
+                output_name = path_calculator(day_key, meta_list)
+                outputs.append(
+                    (day_key, meta_list, output_name, input_hashes[stop - 1])
+                )
+            pending = []
+            for index, (day_key, meta_list, output_name, inputs_hash) in \
+                    enumerate(outputs):
+                reason = self._skip_reason(meta_list, output_name, inputs_hash)
+                if reason:
+                    self._print_skip(day_key, output_name, reason)
+                else:
+                    pending.append(index)
+            if not pending:
+                continue
+            # the stages of the group are reported under its longest average
+            with self.metrics.group(outputs[pending[-1]][2].name):
+                print(f"working on photos from {period_key}")
+                # the whole group shares one dimension so the running sum can
+                # be reused from day to day
+                common_dimension = self.fs_grouper.get_common_dimension(
+                    self.comb_method,
+                    period_list,
+                    self.max_dimension
+                )
+                strategy = self._choose_strategy(
+                    lambda accumulator_type, num_workers:
+                        self.manipulator.estimate_memory(
+                            common_dimension,
+                            accumulator_type,
+                            num_workers
+                        )
+                )
+                print(strategy.describe())
+                manipulator = self.manipulator.with_strategy(
+                    strategy.accumulator_type,
+                    strategy.num_workers
+                )
+                # start the running sum from the first average we need,
+                # picking up a cached average of its earliest photos if
+                # possible
+                first_list = outputs[pending[0]][1]
+                if cache_path:
+                    avg_cacher = self._average_cache(
+                        first_list,
+                        cache_path
+                    )
+                    first_list = avg_cacher.search(
+                        comb_method=self.comb_method,
+                        dimension=common_dimension
+                    )
+                num_images = self._calculate_num_images(first_list)
+                total_images = len(outputs[pending[-1]][1])
+                accumulator = manipulator.accumulate_images(
+                    first_list,
                     common_dimension,
-                    exposure_time,
-                    num_images
+                    total_images,
+                    self.comb_method
                 )
-            self.exiftool.set_image_metadata(
-                str(output_name),
-                calculated_meta
-            )
+                exposure_time = self.fs_grouper.get_total_exposure(first_list)
+                for index in range(pending[0], pending[-1] + 1):
+                    day_key, meta_list, output_name, inputs_hash = \
+                        outputs[index]
+                    new_items = meta_list[num_images:]
+                    if new_items:
+                        manipulator.accumulate_images(
+                            new_items,
+                            common_dimension,
+                            total_images,
+                            self.comb_method,
+                            accumulator=accumulator
+                        )
+                        exposure_time += \
+                            self.fs_grouper.get_total_exposure(new_items)
+                        num_images = len(meta_list)
+                    if index not in pending:
+                        continue
+                    average_images.append(output_name)
+                    combined = accumulator.mean(num_images)
+                    calculated_meta = metadata_calculator(
+                        day_key,
+                        num_images,
+                        exposure_time
+                    )
+                    self._save_average(combined, output_name, calculated_meta)
+                    self._record_output(output_name, inputs_hash, num_images)
+                # cache the longest average of this group for the next run
+                if cache_path:
+                    avg_cacher = self._average_cache(
+                        meta_list,
+                        cache_path
+                    )
+                    self._write_cache(
+                        avg_cacher,
+                        accumulator.total(),
+                        common_dimension,
+                        exposure_time,
+                        num_images
+                    )
+        self._save_manifest()
+        self.write_metrics()
         end = timer()
+        self._print_cache_stats()
         return end - start, average_images
 
     def average_by_day(self, cache_dir=None):
         print("now processing daily images")
-        meta_dict = self.fs_grouper.group_by_day()
+        meta_dict = self.fs_grouper.iter_by_day()
         elapsed, image_list = self.average_photos(
             meta_dict,
             self._calculate_day_avg_path,
@@ -435,11 +1583,12 @@ class Averager:
 
     def average_by_month(self, cache_dir=None, progressive=False):
         print("now processing monthly images")
+        meta_dict = self.fs_grouper.iter_by_month()
         if progressive:
-            meta_dict = self.fs_grouper.group_by_month_progressive()
+            average_photos = self.average_photos_progressive
         else:
-            meta_dict = self.fs_grouper.group_by_month()
-        elapsed, image_list = self.average_photos(
+            average_photos = self.average_photos
+        elapsed, image_list = average_photos(
             meta_dict,
             self._calculate_month_avg_path,
             self.metadata_generator.generate_monthly_metadata,
@@ -450,11 +1599,12 @@ class Averager:
 
     def average_by_year(self, cache_dir=None, progressive=False):
         print("now processing yearly images")
+        meta_dict = self.fs_grouper.iter_by_year()
         if progressive:
-            meta_dict = self.fs_grouper.group_by_year_progressive()
+            average_photos = self.average_photos_progressive
         else:
-            meta_dict = self.fs_grouper.group_by_year()
-        elapsed, image_list = self.average_photos(
+            average_photos = self.average_photos
+        elapsed, image_list = average_photos(
             meta_dict,
             self._calculate_year_avg_path,
             self.metadata_generator.generate_yearly_metadata,
@@ -463,5 +1613,702 @@ class Averager:
         print(f"seconds elapsed processing yearly images: {elapsed}")
         return image_list
 
-    def average_all(self):
-        raise NotImplementedError()
+    def _plan_period(
+        self,
+        period_key,
+        day_lists,
+        path_calculator,
+        metadata_calculator,
+        cache_path=None,
+        progressive=False
+    ):
+        """works out which averages of a month or year need writing and
+        returns a `PeriodSum` for them, starting from a cached sum of its
+        first days if there is one. nothing is read or loaded yet."""
+        period_list = [item for _, day_list in day_lists for item in day_list]
+        period_hashes = self._input_hashes(period_list)
+        outputs = []
+        input_hashes = []
+        # progressive averages each keep their name, one average of the
+        # whole period is renamed as days are added to it
+        period_name = None
+        if progressive:
+            stop = 0
+            for day_index, (day_key, day_list) in enumerate(day_lists):
+                stop += len(day_list)
+                meta_list = PrefixView(period_list, period_key, 0, stop)
+                output_name = path_calculator(day_key, meta_list)
+                outputs.append((day_index, day_key, meta_list, output_name))
+                input_hashes.append(period_hashes[stop - 1])
+        else:
+            period_name = path_calculator(period_key)
+            output_name = path_calculator(period_key, period_list)
+            outputs.append(
+                (len(day_lists) - 1, period_key, period_list, output_name)
+            )
+            input_hashes.append(period_hashes[-1])
+        skip_reasons = [
+            self._skip_reason(meta_list, output_name, inputs_hash)
+            for (_, _, meta_list, output_name), inputs_hash in
+            zip(outputs, input_hashes)
+        ]
+        supersedes = [
+            self._superseded(output_name, period_name, period_hashes)
+            if period_name is not None and reason is None else []
+            for (_, _, _, output_name), reason in zip(outputs, skip_reasons)
+        ]
+        period = PeriodSum(
+            period_key,
+            outputs,
+            skip_reasons,
+            metadata_calculator,
+            input_hashes,
+            period_name,
+            supersedes
+        )
+        if not period.pending:
+            return period
+        period.dimension = self.fs_grouper.get_common_dimension(
+            self.comb_method,
+            period_list,
+            self.max_dimension
+        )
+        if cache_path:
+            # cached sums can only stand in for whole days, up to the first
+            # average we need
+            avg_cacher = self._average_cache(
+                outputs[period.pending[0]][2],
+                cache_path
+            )
+            day_ends = list(accumulate(
+                len(day_list) for _, day_list in day_lists
+            ))
+            cached_list = avg_cacher.search(
+                day_ends,
+                self.comb_method,
+                period.dimension,
+                touch=False
+            )
+            if cached_list[0].get("cached", False):
+                period.avg_cacher = avg_cacher
+                period.cached_item = cached_list[0]
+                period.num_images = period.cached_item["num_images"]
+                period.exposure_time = \
+                    self.fs_grouper.get_total_exposure(cached_list[:1])
+                period.first_day = day_ends.index(period.num_images) + 1
+        return period
+
+    def _start_period(self, period, manipulator):
+        """reports the averages of a planned period that are skipped and sets
+        up its running sum with `manipulator`, from its cached sum if it has
+        one"""
+        for (_, date_key, _, output_name), reason in \
+                zip(period.outputs, period.skip_reasons):
+            self._print_skip(date_key, output_name, reason)
+        if not period.pending:
+            return
+        if period.cached_item:
+            period.accumulator = manipulator.load_cached_sum(
+                period.cached_item,
+                period.dimension,
+                self.comb_method,
+                accumulator_type=period.accumulator_type
+            )
+            period.avg_cacher.mark_used(period.num_images)
+        else:
+            period.accumulator = manipulator.new_accumulator(
+                period.dimension,
+                period.accumulator_type
+            )
+
+    def _add_to_period(self, period, day_index, num_images, exposure_time,
+                       partial=None):
+        """counts `num_images` photos up to `day_index`, which have been added
+        to the running sum of a period or to `partial`, a partial sum of it
+        that is merged in, and writes any of the period's averages that end
+        on that day. returns the filenames written."""
+        if partial is not None:
+            period.accumulator.merge(partial)
+        period.num_images += num_images
+        period.exposure_time += exposure_time
+        return self._write_period_outputs(period, day_index)
+
+    def _period_averages(self, period, day_index):
+        """the pending averages of a planned period that end on `day_index`,
+        as `GroupAverage`s of the photos counted in the period so far"""
+        averages = []
+        for index in period.pending:
+            output_day, date_key, _, output_name = period.outputs[index]
+            if output_day != day_index:
+                continue
+            calculated_meta = period.metadata_calculator(
+                date_key,
+                period.num_images,
+                period.exposure_time
+            )
+            averages.append(GroupAverage(
+                date_key,
+                None,
+                output_name,
+                period.dimension,
+                period.num_images,
+                period.exposure_time,
+                inputs_hash=period.input_hashes[index],
+                metadata=calculated_meta,
+                jpeg_metadata=self._jpeg_metadata(calculated_meta),
+                period_name=period.period_name,
+                supersedes=period.supersedes[index]
+            ))
+        return averages
+
+    def _month_task(self, year, month, cache_path=None):
+        """works out the `MonthTask` of a planned month of `year`, reporting
+        the averages it skips and marking its cached sum as used. returns
+        the task and the `AverageCache` the month's sum goes into, or
+        None."""
+        for (_, date_key, _, output_name), reason in \
+                zip(month.outputs, month.skip_reasons):
+            self._print_skip(date_key, output_name, reason)
+        if month.cached_item:
+            month.avg_cacher.mark_used(month.num_images)
+        outputs = dict()
+        averages = self._period_averages(month, month.first_day - 1)
+        if averages:
+            outputs[month.first_day - 1] = averages
+        days = []
+        for day in month.parts:
+            self._print_skip(day.day_key, day.output_name, day.skip_reason)
+            if not day.decoded:
+                continue
+            month_day = None
+            year_day = None
+            for period, day_index in day.periods:
+                if period is month:
+                    month_day = day_index
+                else:
+                    year_day = day_index
+            exposure_time = self.fs_grouper.get_total_exposure(day.day_list)
+            average = None
+            if day.pending:
+                calculated_meta = \
+                    self.metadata_generator.generate_daily_metadata(
+                        day.day_key,
+                        len(day.day_list),
+                        exposure_time
+                    )
+                average = GroupAverage(
+                    day.day_key,
+                    day.day_list,
+                    day.output_name,
+                    day.dimension,
+                    len(day.day_list),
+                    exposure_time,
+                    inputs_hash=day.inputs_hash,
+                    metadata=calculated_meta,
+                    jpeg_metadata=self._jpeg_metadata(calculated_meta)
+                )
+            if month_day is not None:
+                month.num_images += len(day.day_list)
+                month.exposure_time += exposure_time
+                averages = self._period_averages(month, month_day)
+                if averages:
+                    outputs[month_day] = averages
+            days.append(DayTask(
+                day.day_key,
+                day.day_list,
+                day.output_name.name,
+                exposure_time,
+                month_day,
+                year_day,
+                average,
+                day.accumulator_type
+            ))
+        avg_cacher = None
+        if cache_path and month.pending:
+            avg_cacher = self._average_cache(
+                month.outputs[month.pending[-1]][2],
+                cache_path
+            )
+        task = MonthTask(
+            month.period_key,
+            days,
+            month.dimension,
+            month.accumulator_type,
+            month.cached_item,
+            month.first_day,
+            outputs,
+            avg_cacher.entry_filename if avg_cacher else None,
+            year.dimension,
+            year.accumulator_type,
+            self._year_splits(year, month),
+            month.task_memory
+        )
+        return task, avg_cacher
+
+    def _finish_month(self, daily, monthly):
+        """tags and records the daily and monthly averages of a month once
+        they've been written"""
+        for average in daily + monthly:
+            self._finish_group(average)
+        # a run stopped part way through keeps what it has done
+        self._save_manifest()
+
+    def _average_months_serial(self, year, tasks, manipulator):
+        """sums the `MonthTask`s of a year one after the other in this
+        process with `manipulator`, which splits each day across its worker
+        processes if it has several, adding the photos straight to the
+        year's running sum. yields the daily, monthly and yearly averages
+        written in each month."""
+        for task in tasks:
+            yearly = []
+            daily, monthly = average_month(
+                manipulator,
+                task,
+                self.comb_method,
+                year.accumulator,
+                lambda day_index, _, num_images, exposure_time:
+                    yearly.extend(self._add_to_period(
+                        year,
+                        day_index,
+                        num_images,
+                        exposure_time
+                    ))
+            )
+            self._finish_month(daily, monthly)
+            yield daily, monthly, yearly
+
+    def _average_months_parallel(self, year, tasks, num_workers):
+        """sums the `MonthTask`s of a year side by side, a whole month in each
+        of `num_workers` processes of the pool opened by
+        `ImageManipulatorSKI.worker_pool`. months are started in order as
+        long as their estimated memory fits in `self.memory_budget` next to
+        the year's sum and the months running or waiting to be added; one
+        month is always admitted. each month's share of the year's sum is
+        merged once, in month order, so the yearly averages don't depend on
+        which month finishes first. yields the daily, monthly and yearly
+        averages written in each month."""
+        worker_manipulator = self.manipulator.with_strategy(
+            self.manipulator.accumulator_type,
+            1
+        )
+        budget = self.memory_budget - year.memory
+        waiting = deque(enumerate(tasks))
+        running = {}
+        finished = {}
+        held_bytes = 0
+        next_index = 0
+        while next_index < len(tasks):
+            while waiting and len(running) < num_workers:
+                index, task = waiting[0]
+                if held_bytes and held_bytes + task.memory > budget:
+                    break
+                waiting.popleft()
+                future = self.manipulator.executor.submit(
+                    _average_month_worker,
+                    worker_manipulator,
+                    task,
+                    self.comb_method
+                )
+                running[future] = index
+                held_bytes += task.memory
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished[running.pop(future)] = future.result()
+            # months that finish early wait for the ones before them
+            while next_index in finished:
+                daily, monthly, year_parts, metrics, prepared_cache = \
+                    finished.pop(next_index)
+                self.manipulator.merge_worker(metrics, prepared_cache)
+                yearly = []
+                for day_index, partial, num_images, exposure_time in \
+                        year_parts:
+                    yearly.extend(self._add_to_period(
+                        year,
+                        day_index,
+                        num_images,
+                        exposure_time,
+                        partial
+                    ))
+                self._finish_month(daily, monthly)
+                held_bytes -= tasks[next_index].memory
+                next_index += 1
+                yield daily, monthly, yearly
+
+    def _write_period_outputs(self, period, day_index):
+        """writes the pending averages of a period that end on `day_index`
+        from its running sum. returns the filenames written."""
+        written = []
+        for index in period.pending:
+            output_day, date_key, _, output_name = period.outputs[index]
+            if output_day != day_index:
+                continue
+            calculated_meta = period.metadata_calculator(
+                date_key,
+                period.num_images,
+                period.exposure_time
+            )
+            self._save_average(
+                period.accumulator.mean(period.num_images),
+                output_name,
+                calculated_meta
+            )
+            self._record_output(
+                output_name,
+                period.input_hashes[index],
+                period.num_images,
+                period.period_name,
+                period.supersedes[index]
+            )
+            written.append(output_name)
+        return written
+
+    def _finish_period(self, period, cache_path=None):
+        """caches the sum of a period for the next run"""
+        if not cache_path or not period.pending:
+            return
+        meta_list = period.outputs[period.pending[-1]][2]
+        avg_cacher = self._average_cache(meta_list, cache_path)
+        self._write_cache(
+            avg_cacher,
+            period.accumulator.total(),
+            period.dimension,
+            period.exposure_time,
+            period.num_images
+        )
+
+    def plan_all(
+        self,
+        month_cache_dir=None,
+        year_cache_dir=None,
+        progressive=False
+    ):
+        """works out everything `average_all` will do, without reading any
+        photos: which daily, monthly and yearly averages get written or
+        skipped, which photos are decoded, which cached sums are used and
+        roughly how much memory each group takes. returns an
+        `AveragePlan`."""
+        years = []
+        for year_key, year_list in self.fs_grouper.iter_by_year():
+            year_days = self._split_by_day(year_list)
+            year = self._plan_period(
+                year_key,
+                year_days,
+                self._calculate_year_avg_path,
+                self.metadata_generator.generate_yearly_metadata,
+                year_cache_dir,
+                progressive
+            )
+            year_day_index = 0
+            month_groups = groupby(
+                year_days,
+                key=lambda item: datetime(item[0].year, item[0].month, 1)
+            )
+            for month_key, month_days in month_groups:
+                month_days = list(month_days)
+                month = self._plan_period(
+                    month_key,
+                    month_days,
+                    self._calculate_month_avg_path,
+                    self.metadata_generator.generate_monthly_metadata,
+                    month_cache_dir,
+                    progressive
+                )
+                for month_day_index, (day_key, day_list) in \
+                        enumerate(month_days):
+                    periods = [
+                        (period, day_index)
+                        for period, day_index in (
+                            (month, month_day_index),
+                            (year, year_day_index)
+                        )
+                        if period.needs_day(day_index)
+                    ]
+                    year_day_index += 1
+                    output_name = self._calculate_day_avg_path(day_key)
+                    inputs_hash = self._input_hashes(day_list)[-1]
+                    day = DayPlan(
+                        day_key,
+                        day_list,
+                        output_name,
+                        periods,
+                        self._skip_reason(day_list, output_name, inputs_hash),
+                        inputs_hash
+                    )
+                    if day.decoded:
+                        day.dimension = self.fs_grouper.get_common_dimension(
+                            self.comb_method,
+                            day_list,
+                            self.max_dimension
+                        )
+                    month.parts.append(day)
+                year.parts.append(month)
+            year.strategy = self._choose_year_strategy(year)
+            years.append(year)
+        return AveragePlan(years)
+
+    @staticmethod
+    def _year_sums(year):
+        """the sums of a planned year: the year's and months' that have
+        averages to write and the days' that do"""
+        return [period for period in [year] + year.parts
+                if period.pending] + \
+            [day for month in year.parts for day in month.parts
+             if day.pending]
+
+    @staticmethod
+    def _year_splits(year, month):
+        """the days of a planned month, as year day indices, on which the
+        photos the month adds to the year's sum are handed over: the days
+        yearly averages end on and the last day of the month the year's sum
+        needs"""
+        year_days = [day_index for day in month.parts
+                     for period, day_index in day.periods if period is year]
+        if not year_days:
+            return []
+        output_days = {year.outputs[index][0] for index in year.pending}
+        return sorted({day_index for day_index in year_days
+                       if day_index in output_days} | {year_days[-1]})
+
+    def _months_side_by_side(self, year, num_workers):
+        """whether the months of a planned year are summed side by side, a
+        whole month in each of `num_workers` processes. a month can only
+        hand its share of the year's sum over once, so months with several
+        yearly averages ending in them, as in progressive runs, are summed
+        one after the other with each day split across the processes."""
+        return num_workers > 1 and all(
+            len(self._year_splits(year, month)) <= 1 for month in year.parts
+        )
+
+    def _size_year(self, year, num_workers):
+        """sets the estimated memory of the sums of a planned year, each made
+        with its own accumulator type, in `num_workers` processes, and
+        returns its peak. months summed side by side each hold their sum, a
+        day's and their share of the year's, and the year's sum waits for
+        the `num_workers` months that need the most. otherwise the peak is
+        the year's sum, a month's and a day's split across the processes."""
+        manipulator = self.manipulator
+        side_by_side = self._months_side_by_side(year, num_workers)
+        day_workers = 1 if side_by_side else num_workers
+        peak_memory = 0
+        for period in [year] + year.parts:
+            period.memory = 0
+            if period.pending:
+                period.memory = manipulator.estimate_sum_memory(
+                    period.dimension,
+                    period.accumulator_type
+                )
+        for month in year.parts:
+            peak_memory = max(peak_memory, year.memory + month.memory)
+            month.task_memory = month.memory
+            for day in month.parts:
+                if not day.decoded:
+                    continue
+                day.memory = manipulator.estimate_memory(
+                    day.dimension,
+                    day.accumulator_type,
+                    day_workers
+                )
+                if not day.pending:
+                    # there's no day sum, only the images being read
+                    day.memory -= manipulator.estimate_accumulator_memory(
+                        day.dimension,
+                        day.accumulator_type
+                    ) * (day_workers + 1 if day_workers > 1 else 1)
+                if day_workers > 1:
+                    # each worker sums its share into its own month and
+                    # year sums too
+                    day.memory += day_workers * sum(
+                        manipulator.estimate_accumulator_memory(
+                            period.dimension,
+                            period.accumulator_type
+                        )
+                        for period, _ in day.periods
+                    )
+                month.task_memory = max(month.task_memory,
+                                        month.memory + day.memory)
+                peak_memory = max(
+                    peak_memory,
+                    year.memory + month.memory + day.memory
+                )
+            if side_by_side and self._year_splits(year, month):
+                month.task_memory += manipulator.estimate_accumulator_memory(
+                    year.dimension,
+                    year.accumulator_type
+                )
+        if side_by_side:
+            task_memory = sorted(
+                (month.task_memory for month in year.parts),
+                reverse=True
+            )
+            peak_memory = year.memory + sum(task_memory[:num_workers])
+        return peak_memory
+
+    def _leaner_type(self, sum_plan, sum_types):
+        """the next of `sum_types` after the type of a planned sum that needs
+        less memory at its dimension, or None"""
+        index = sum_types.index(sum_plan.accumulator_type)
+        memory = self.manipulator.estimate_accumulator_memory(
+            sum_plan.dimension,
+            sum_plan.accumulator_type
+        )
+        for accumulator_type in sum_types[index + 1:]:
+            if self.manipulator.estimate_accumulator_memory(
+                    sum_plan.dimension, accumulator_type) < memory:
+                return accumulator_type
+        return None
+
+    def _choose_year_strategy(self, year):
+        """picks the number of processes and the accumulator type of every
+        sum of a planned year so its peak memory fits in
+        `self.memory_budget`, and sizes the year's sums with them. every sum
+        starts with the configured type, in `self.num_workers` processes and
+        then in one. if that's over the budget, the sum holding the most
+        memory moves on to the next of `ImageManipulatorSKI.sum_types`, one
+        at a time until the year fits, so sums that are small enough stay in
+        memory. returns a `Strategy` with the type of the year's sum."""
+        sum_types = self.manipulator.sum_types(self.comb_method)
+        sums = self._year_sums(year)
+        worker_counts = sorted({self.num_workers, 1}, reverse=True)
+        for downgrade in [False, True]:
+            for num_workers in worker_counts:
+                for sum_plan in [year] + year.parts + \
+                        [day for month in year.parts for day in month.parts]:
+                    # days that are only read have no sum of their own
+                    sum_plan.accumulator_type = \
+                        sum_types[0] if sum_plan.pending else None
+                while True:
+                    memory = self._size_year(year, num_workers)
+                    if memory <= self.memory_budget:
+                        return Strategy(year.accumulator_type, num_workers,
+                                        memory)
+                    leaner = [
+                        sum_plan for sum_plan in sums
+                        if self._leaner_type(sum_plan, sum_types)
+                    ]
+                    if not downgrade or not leaner:
+                        break
+                    biggest = max(
+                        leaner,
+                        key=lambda sum_plan:
+                            self.manipulator.estimate_accumulator_memory(
+                                sum_plan.dimension,
+                                sum_plan.accumulator_type
+                            )
+                    )
+                    biggest.accumulator_type = \
+                        self._leaner_type(biggest, sum_types)
+        return Strategy(year.accumulator_type, num_workers, memory,
+                        fits=False)
+
+    def _choose_strategy(self, estimate, serial=False):
+        """picks the first of `ImageManipulatorSKI.strategies` whose memory,
+        from `estimate(accumulator_type, num_workers)`, fits in
+        `self.memory_budget`, or the leanest one if none do. `serial` only
+        considers a single process. returns a `Strategy`."""
+        strategies = self.manipulator.strategies(self.comb_method)
+        if serial:
+            strategies = [(accumulator_type, 1)
+                          for accumulator_type, _ in strategies]
+        for accumulator_type, num_workers in strategies:
+            memory = estimate(accumulator_type, num_workers)
+            if memory <= self.memory_budget:
+                return Strategy(accumulator_type, num_workers, memory)
+        return Strategy(accumulator_type, num_workers, memory, fits=False)
+
+    def average_all(
+        self,
+        month_cache_dir=None,
+        year_cache_dir=None,
+        progressive=False,
+        plan=None
+    ):
+        """writes the daily, monthly and yearly averages in a single pass,
+        decoding each photo at most once, following `plan` (see `plan_all`)
+        or a new plan.
+
+        the photos are streamed in date order. each one is read once,
+        prepared at the common dimensions of its day, month and year, and
+        added to all three running sums. every average is written as soon as
+        the day it ends on is done, so only the current day, month and year
+        sums are kept in memory, and the monthly and yearly averages are
+        exactly what they'd be if they were made on their own. with several
+        workers, whole months are summed side by side, each worker keeping
+        its month's sums across the days and handing its share of the year's
+        sum over once (see `_average_months_parallel`), and one pool of
+        worker processes is kept for the whole run.
+
+        returns the lists of daily, monthly and yearly averages written."""
+        print("now processing daily, monthly and yearly images")
+        start = timer()
+        if plan is None:
+            plan = self.plan_all(month_cache_dir, year_cache_dir, progressive)
+        daily_images = []
+        monthly_images = []
+        yearly_images = []
+        # one pool of worker processes sums every month of the run
+        with self.manipulator.worker_pool(self.num_workers):
+            for year in plan.years:
+                # the year's sums are made in the number of processes the
+                # plan found fits in memory, each with its own type, see
+                # `_choose_year_strategy`
+                num_workers = year.strategy.num_workers
+                manipulator = self.manipulator.with_strategy(
+                    self.manipulator.accumulator_type,
+                    num_workers
+                )
+                print(f"{year.period_key.year}: {year.strategy.describe()}")
+                self._start_period(year, manipulator)
+                # a cached sum may already cover the first average
+                yearly_images.extend(
+                    self._write_period_outputs(year, year.first_day - 1)
+                )
+                # every month is worked out before any is summed, as
+                # opening a cache deletes the sums that aren't in its index
+                # yet
+                month_tasks = []
+                for month in year.parts:
+                    task, avg_cacher = self._month_task(
+                        year,
+                        month,
+                        month_cache_dir
+                    )
+                    if task.days or task.outputs:
+                        month_tasks.append((month, task, avg_cacher))
+                tasks = [task for _, task, _ in month_tasks]
+                if self._months_side_by_side(year, num_workers):
+                    months = self._average_months_parallel(
+                        year,
+                        tasks,
+                        num_workers
+                    )
+                else:
+                    months = self._average_months_serial(
+                        year,
+                        tasks,
+                        manipulator
+                    )
+                for daily, monthly, yearly in months:
+                    daily_images.extend(
+                        average.output_name for average in daily
+                    )
+                    monthly_images.extend(
+                        average.output_name for average in monthly
+                    )
+                    yearly_images.extend(yearly)
+                # the months' sums are only added to their caches once no
+                # month is reading a cached sum any more
+                for month, _, avg_cacher in month_tasks:
+                    if avg_cacher:
+                        avg_cacher.add_entry(
+                            month.dimension,
+                            month.exposure_time,
+                            month.num_images
+                        )
+                self._finish_period(year, year_cache_dir)
+                year.accumulator = None
+        self._save_manifest()
+        self.write_metrics()
+        end = timer()
+        self._print_cache_stats()
+        print(f"seconds elapsed processing all images: {end - start}")
+        return daily_images, monthly_images, yearly_images
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+# default size limit of the prepared image cache, in bytes
+DEFAULT_CACHE_BYTES = 10 * 2 ** 30
+# share of the size limit the prepared image cache is evicted down to, so
+# the directory isn't scanned again for every image added
+LOW_WATER_MARK = 0.9
+# bytes read at a time when hashing file contents
+HASH_CHUNK_BYTES = 2 ** 20
+
+
+@lru_cache(maxsize=None)
+def _content_hash(filename, size, mtime_ns):
+    """sha1 of a file's contents. size and mtime are part of the memo key, so
+    a changed file is hashed again."""
+    content_hash = hashlib.sha1()
+    with open(filename, "rb") as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_BYTES), b""):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def file_fingerprint(filename, content_hash=False):
+    """identifies a version of a file by resolved path, size and mtime, and
+    optionally by a hash of its contents"""
+    filepath = Path(filename).resolve()
+    file_stat = filepath.stat()
+    fingerprint = [str(filepath), file_stat.st_size, file_stat.st_mtime_ns]
+    if content_hash:
+        fingerprint.append(_content_hash(
+            str(filepath),
+            file_stat.st_size,
+            file_stat.st_mtime_ns
+        ))
+    return fingerprint
+
+
+def prefix_hashes(metalist, content_hash=False):
+    """rolling hashes of the fingerprints of the photos in a metadata list:
+    item i is the hash of the first i + 1 photos, so every prefix of the
+    list is identified in a single pass."""
+    hashes = []
+    digest = b""
+    for item in metalist:
+        fingerprint = file_fingerprint(item["SourceFile"], content_hash)
+        digest = hashlib.sha1(
+            digest + json.dumps(fingerprint).encode()
+        ).digest()
+        hashes.append(digest.hex())
+    return hashes
+
+
+class PreparedImageCache:
+    """on-disk store of prepared (evened and cropped, padded or resized)
+    images, so an image used by several averages or runs is only decoded and
+    prepared once.
+
+    entries are keyed by the source file's fingerprint (resolved path, size
+    and modification time), the combination method, the output dimension
+    and a variant string (e.g. the resampler), and stored as `.npy` files
+    that are memory mapped on a hit. the least recently used entries are
+    deleted once the files take up more than `max_bytes`, until they fit in
+    `LOW_WATER_MARK` of it. the store keeps no index of its own, file sizes
+    and modification times are the index, so several processes can share
+    it.
+
+    a copy in a worker process counts hits and misses from zero after
+    `reset_counts`; they're added back with `merge`, along with the bytes
+    it wrote."""
+    SUFFIX = ".npy"
+
+    def __init__(self, cache_path, max_bytes=DEFAULT_CACHE_BYTES):
+        self.cache_path = Path(cache_path)
+        self.cache_path.mkdir(exist_ok=True, parents=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = sum(size for _, _, size in self._entries())
+        # bytes added (or removed) by this copy, for `merge`
+        self.bytes_added = 0
+        # prefetch threads share the counters
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks don't cross process boundaries
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset_counts(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.bytes_added = 0
+
+    def merge(self, other):
+        """adds the hits, misses and bytes of `other`, a copy used in a
+        worker process"""
+        with self._lock:
+            self.hits += other.hits
+            self.misses += other.misses
+            self.total_bytes += other.bytes_added
+
+    def _entry_path(self, filename, comb_method, dimension, variant):
+        key = json.dumps([
+            file_fingerprint(filename),
+            comb_method,
+            dimension,
+            variant
+        ])
+        key_hash = hashlib.sha1(key.encode()).hexdigest()
+        return self.cache_path / f"{key_hash}{self.SUFFIX}"
+
+    def _entries(self):
+        """yields (path, mtime, size) for every entry"""
+        with os.scandir(self.cache_path) as dir_entries:
+            for dir_entry in dir_entries:
+                if not dir_entry.name.endswith(self.SUFFIX):
+                    continue
+                try:
+                    file_stat = dir_entry.stat()
+                except FileNotFoundError:
+                    # evicted by another process
+                    continue
+                yield (Path(dir_entry.path), file_stat.st_mtime_ns,
+                       file_stat.st_size)
+
+    def _evict(self):
+        """deletes the least recently used entries until the cache fits in
+        `LOW_WATER_MARK` of `self.max_bytes`. called with the lock held."""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total_bytes = sum(size for _, _, size in entries)
+        self.bytes_added += total_bytes - self.total_bytes
+        self.total_bytes = total_bytes
+        for entry_path, _, size in entries:
+            if self.total_bytes <= LOW_WATER_MARK * self.max_bytes:
+                break
+            try:
+                entry_path.unlink()
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+            self.bytes_added -= size
+
+    def get(self, filename, comb_method, dimension, variant=""):
+        """returns the cached prepared image as a read-only memory map, or
+        None if it isn't cached"""
+        entry_path = self._entry_path(filename, comb_method, dimension,
+                                      variant)
+        try:
+            image = np.load(entry_path, mmap_mode='r')
+            # mark as recently used
+            os.utime(entry_path)
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return image
+
+    def put(self, filename, comb_method, dimension, image, variant=""):
+        """stores a prepared image"""
+        entry_path = self._entry_path(filename, comb_method, dimension,
+                                      variant)
+        # write to a temporary file first so readers never see half an entry
+        file_descriptor, temp_name = tempfile.mkstemp(
+            suffix=".tmp",
+            dir=self.cache_path
+        )
+        with os.fdopen(file_descriptor, "wb") as fp:
+            np.save(fp, np.ascontiguousarray(image))
+        with self._lock:
+            # an entry written over doesn't add its whole size
+            try:
+                replaced_bytes = entry_path.stat().st_size
+            except FileNotFoundError:
+                replaced_bytes = 0
+            os.replace(temp_name, entry_path)
+            added_bytes = entry_path.stat().st_size - replaced_bytes
+            self.total_bytes += added_bytes
+            self.bytes_added += added_bytes
+            if self.total_bytes > self.max_bytes:
+                self._evict()
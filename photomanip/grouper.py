@@ -1,9 +1,13 @@
 from collections import defaultdict, OrderedDict
+from collections.abc import Sequence
 from datetime import datetime
+from itertools import groupby
 from pathlib import Path
 
 from photomanip import PAD, CROP, RESIZE
-from photomanip.metadata import ImageExif
+from photomanip.index import MetadataIndex
+from photomanip.metadata import ERROR_KEY, ImageExif
+from photomanip.metrics import EXIF_READ, INDEX_READ, SCAN, RunMetrics
 
 DATETIME_FMT = "%Y:%m:%d %H:%M:%S"
 DAILY_DATETIME_FMT = "%Y%m%d"
@@ -11,6 +15,45 @@ MONTHLY_DATETIME_FMT = "%Y%m"
 YEARLY_DATETIME_FMT = "%Y"
 
 
+class PrefixView(Sequence):
+    """the photos of a progressive group: the items of one date-sorted
+    metadata list from `start`, the first photo of `period`, up to but not
+    including `stop`. groups ending on every day of a period share the list
+    instead of each holding a copy. slices are plain lists, and so is a
+    pickled view."""
+    __slots__ = ("metadata", "period", "start", "stop")
+
+    def __init__(self, metadata, period, start, stop):
+        self.metadata = metadata
+        self.period = period
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        indices = range(self.start, self.stop)[index]
+        if isinstance(index, slice):
+            return [self.metadata[item] for item in indices]
+        return self.metadata[indices]
+
+    def __iter__(self):
+        # index straight into the list, rather than walking up to `start`
+        return map(self.metadata.__getitem__, range(self.start, self.stop))
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+    def __repr__(self):
+        return f"PrefixView({self.period!r}, {self.start}, {self.stop})"
+
+
 class Grouper:
     def __init__(self, *args, **kwargs):
         self.metadata_list = None
@@ -39,23 +82,106 @@ class Grouper:
 
 class FileSystemGrouper(Grouper):
     def __init__(self, image_directory, grouping_tag=None,
-                 grouping_fmt=DAILY_DATETIME_FMT, *args, **kwargs):
+                 grouping_fmt=DAILY_DATETIME_FMT, *args, metrics=None,
+                 index_file=None, lazy=False, read_only=False, **kwargs):
+        self._photo_list = None
+        self._datetime_dict = None
         super().__init__(*args, **kwargs)
         self.image_folder_path = Path(image_directory)
+        # metadata already read from the photos, see
+        # `photomanip.index.MetadataIndex`. a read only grouper doesn't add
+        # to it
+        if index_file:
+            self.metadata_index = MetadataIndex(index_file, read_only)
+        else:
+            self.metadata_index = None
+        # dates the photos were taken, by path, parsed when they were indexed
+        self.exif_dates = dict()
+        # times the scan and the exif read, see `photomanip.metrics`
+        self.metrics = metrics if metrics is not None else RunMetrics()
         self.exif_reader = ImageExif()
         self.exif_datetime_key = self.exif_reader.metadata_map["date_created"]
         self.exif_keywords_key = self.exif_reader.metadata_map["keywords"]
         self.exif_height_key = self.exif_reader.metadata_map["image_height"]
         self.exif_width_key = self.exif_reader.metadata_map["image_width"]
         self.exp_time_key = self.exif_reader.metadata_map["exposure_time"]
-        self.photo_list = self.get_photo_list()
-        self.metadata_list = \
-            self.exif_reader.get_metadata_batch(self.photo_list)
+        # photos whose metadata couldn't be read are left out, and their
+        # errors kept by path
+        self.read_errors = dict()
         self.grouping_tag = grouping_tag
-        self.datetime_dict = self.build_datetime_dict(
-            grouping_tag,
-            grouping_fmt
-        )
+        self.grouping_fmt = grouping_fmt
+        # a lazy grouper scans the folder and reads the metadata the first
+        # time `photo_list`, `metadata_list` or `datetime_dict` is used
+        if not lazy:
+            self.load()
+
+    def load(self):
+        """scans the folder and reads the metadata, if that hasn't happened
+        yet"""
+        return self.datetime_dict
+
+    @property
+    def photo_list(self):
+        if self._photo_list is None:
+            with self.metrics.stage(SCAN) as counts:
+                self._photo_list = self.get_photo_list()
+                counts["items"] = len(self._photo_list)
+        return self._photo_list
+
+    @photo_list.setter
+    def photo_list(self, photo_list):
+        self._photo_list = photo_list
+
+    @property
+    def metadata_list(self):
+        if self._metadata_list is None:
+            metadata_list = []
+            for metadata in self.read_metadata(self.photo_list):
+                if ERROR_KEY in metadata:
+                    print(f"can't read metadata of "
+                          f"{metadata['SourceFile']}: {metadata[ERROR_KEY]}")
+                    self.read_errors[metadata["SourceFile"]] = \
+                        metadata[ERROR_KEY]
+                else:
+                    metadata_list.append(metadata)
+            self._metadata_list = metadata_list
+        return self._metadata_list
+
+    @metadata_list.setter
+    def metadata_list(self, metadata_list):
+        self._metadata_list = metadata_list
+
+    @property
+    def datetime_dict(self):
+        if self._datetime_dict is None:
+            self._datetime_dict = self.build_datetime_dict(
+                self.grouping_tag,
+                self.grouping_fmt
+            )
+        return self._datetime_dict
+
+    @datetime_dict.setter
+    def datetime_dict(self, datetime_dict):
+        self._datetime_dict = datetime_dict
+
+    def _read_exif(self, photo_list):
+        with self.metrics.stage(EXIF_READ, items=len(photo_list)):
+            return self.exif_reader.get_metadata_batch(photo_list)
+
+    def read_metadata(self, photo_list):
+        """reads the metadata of `photo_list` with exiftool, or from the
+        index for the photos that haven't changed since they were indexed"""
+        if self.metadata_index is None:
+            return self._read_exif(photo_list)
+        with self.metrics.stage(INDEX_READ, items=len(photo_list)):
+            metadata_list, self.exif_dates = self.metadata_index.lookup(
+                photo_list,
+                self._read_exif,
+                self.exif_reader.get_list,
+                self.exif_datetime_key,
+                root=self.image_folder_path
+            )
+        return metadata_list
 
     def date_extractor(
         self,
@@ -75,6 +201,10 @@ class FileSystemGrouper(Grouper):
                     # convert to datetime
                     matches = matches.replace(keyword_grouper, '')
                     return datetime.strptime(matches, grouping_fmt)
+        # parsed when the photo was indexed?
+        exif_datetime = self.exif_dates.get(metadata["SourceFile"])
+        if exif_datetime is not None:
+            return exif_datetime
         # get the date created from exif and gooooo
         exif_datetime = metadata[self.exif_datetime_key]
         return datetime.strptime(exif_datetime, DATETIME_FMT)
@@ -140,53 +270,98 @@ class FileSystemGrouper(Grouper):
                 grouped[new_key].append(meta[0])
         return grouped
 
+    def _iter_groups(self, group_key):
+        """yields (key, metadata list) for the groups of photos with the same
+        `group_key(date)`, in date order, without building a dict of them"""
+        groups = groupby(
+            self.datetime_dict.items(),
+            key=lambda item: group_key(item[0])
+        )
+        for key, items in groups:
+            yield key, [meta for _, meta_list in items for meta in meta_list]
+
+    def iter_by_day(self):
+        """like `group_by_day`, as a generator in date order"""
+        return self._iter_groups(
+            lambda date: datetime(date.year, date.month, date.day)
+        )
+
+    def iter_by_month(self):
+        """like `group_by_month`, as a generator in date order"""
+        return self._iter_groups(
+            lambda date: datetime(date.year, date.month, 1)
+        )
+
+    def iter_by_year(self):
+        """like `group_by_year`, as a generator in date order"""
+        return self._iter_groups(lambda date: datetime(date.year, 1, 1))
+
+    @property
+    def sorted_metadata(self):
+        """every photo's metadata in date order, in one list"""
+        return [meta for meta_list in self.datetime_dict.values()
+                for meta in meta_list]
+
+    def _progressive_views(self, period_key):
+        """for every day, a `PrefixView` of the photos from the start of its
+        period, as given by `period_key(date)`, up to and including that
+        day. made in one pass over the photos."""
+        metadata = self.sorted_metadata
+        views = OrderedDict()
+        period = None
+        start = 0
+        stop = 0
+        for date, meta_list in self.datetime_dict.items():
+            if period_key(date) != period:
+                period = period_key(date)
+                start = stop
+            stop += len(meta_list)
+            day = datetime(date.year, date.month, date.day)
+            # a later photo of the same day extends its view
+            views[day] = PrefixView(metadata, period, start, stop)
+        return views
+
+    def progressive_by_month(self):
+        """`PrefixView`s by day of the photos of each day's month up to and
+        including that day"""
+        return self._progressive_views(
+            lambda date: datetime(date.year, date.month, 1)
+        )
+
+    def progressive_by_year(self):
+        """`PrefixView`s by day of the photos of each day's year up to and
+        including that day"""
+        return self._progressive_views(
+            lambda date: datetime(date.year, 1, 1)
+        )
+
     def group_by_month_progressive(self):
+        """`progressive_by_month` as a dict of lists"""
         grouped = defaultdict(list)
-        start_date = next(iter(self.datetime_dict.keys()))
-        # scary time complex loop, but we have a cache for the image processing
-        # operations
-        for stop_date in self.datetime_dict.keys():
-            current_month = stop_date.month
-            new_key = datetime(stop_date.year, stop_date.month, stop_date.day)
-            # if we've moved on to the next month, update start date
-            if not start_date.month == current_month:
-                start_date = stop_date
-            for date, meta in self.datetime_dict.items():
-                if date >= start_date and date <= stop_date:
-                    if len(meta) > 1:
-                        grouped[new_key].extend(meta)
-                    else:
-                        grouped[new_key].append(meta[0])
+        for day, view in self.progressive_by_month().items():
+            grouped[day] = list(view)
         return grouped
 
     def group_by_year_progressive(self):
+        """`progressive_by_year` as a dict of lists"""
         grouped = defaultdict(list)
-        start_date = next(iter(self.datetime_dict.keys()))
-        # scary time complex loop, but we have a cache for the image processing
-        # operations
-        for stop_date in self.datetime_dict.keys():
-            current_year = stop_date.year
-            new_key = datetime(stop_date.year, stop_date.month, stop_date.day)
-            # if we've moved on to the next year, update start date
-            if not start_date.year == current_year:
-                start_date = stop_date
-            for date, meta in self.datetime_dict.items():
-                if date >= start_date and date <= stop_date:
-                    if len(meta) > 1:
-                        grouped[new_key].extend(meta)
-                    else:
-                        grouped[new_key].append(meta[0])
+        for day, view in self.progressive_by_year().items():
+            grouped[day] = list(view)
         return grouped
 
-    def get_common_dimension(self, comb_method, metadata_list):
+    def get_common_dimension(self, comb_method, metadata_list,
+                             max_dimension=None):
         """Computes the dimensions of the final output image based on specified
-        combination method and lists of images widths and heights."""
+        combination method and lists of images widths and heights. In resize
+        mode the dimension is limited to `max_dimension`, if given."""
         image_heights, image_widths = \
             self._height_width_extractor(metadata_list)
         if comb_method == PAD or comb_method == RESIZE:
             max_w = max(image_widths)
             max_h = max(image_heights)
             expand_to = max(max_w, max_h)
+            if comb_method == RESIZE and max_dimension:
+                expand_to = min(expand_to, max_dimension)
             if (expand_to % 2) == 1:
                 expand_to -= 1
             return expand_to
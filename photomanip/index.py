@@ -0,0 +1,167 @@
+import json
+import os
+import sqlite3
+
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+
+from photomanip.metadata import ERROR_KEY
+
+# how exiftool writes dates, see `photomanip.grouper.DATETIME_FMT`
+EXIF_DATETIME_FMT = "%Y:%m:%d %H:%M:%S"
+
+
+class MetadataIndex:
+    """sqlite file of the metadata exiftool read from every photo, keyed by
+    resolved path, size and modification time, so only new or changed photos
+    are read again. the date each photo was taken is stored parsed next to
+    its metadata. photos exiftool failed on aren't stored, so they're read
+    again next time.
+
+    the index remembers the exiftool tags it holds; asking for other tags
+    starts it over.
+
+    a `read_only` index is only looked up, e.g. to plan a dry run: it isn't
+    created if it doesn't exist, and photos read with exiftool aren't
+    stored."""
+
+    def __init__(self, index_file, read_only=False):
+        self.index_file = Path(index_file)
+        self.read_only = read_only
+        # number of photos found in the index and read with exiftool by the
+        # last `lookup`
+        self.hits = 0
+        self.misses = 0
+        if read_only:
+            return
+        self.index_file.parent.mkdir(exist_ok=True, parents=True)
+        with closing(self._connect()) as connection, connection:
+            self._create_tables(connection)
+
+    @staticmethod
+    def _create_tables(connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS settings "
+            "(name TEXT PRIMARY KEY, value TEXT)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS photos ("
+            "path TEXT PRIMARY KEY, "
+            "size INTEGER, "
+            "mtime_ns INTEGER, "
+            "date_created TEXT, "
+            "metadata TEXT)"
+        )
+
+    def _connect(self):
+        if not self.read_only:
+            return sqlite3.connect(str(self.index_file))
+        if not self.index_file.exists():
+            # nothing is indexed yet, and nothing will be
+            connection = sqlite3.connect(":memory:")
+            self._create_tables(connection)
+            return connection
+        return sqlite3.connect(
+            f"{self.index_file.resolve().as_uri()}?mode=ro",
+            uri=True
+        )
+
+    @staticmethod
+    def _parse_date(text):
+        try:
+            return datetime.strptime(text, EXIF_DATETIME_FMT)
+        except (TypeError, ValueError):
+            return None
+
+    def _check_tags(self, connection, tags):
+        """empties the index if it was built for other tags. returns whether
+        it was built for `tags`."""
+        tags = json.dumps(sorted(tags))
+        row = connection.execute(
+            "SELECT value FROM settings WHERE name = 'tags'"
+        ).fetchone()
+        if row is not None and row[0] == tags:
+            return True
+        if self.read_only:
+            return False
+        connection.execute("DELETE FROM photos")
+        connection.execute(
+            "INSERT OR REPLACE INTO settings VALUES ('tags', ?)",
+            (tags,)
+        )
+
+    def lookup(self, photo_list, read_metadata, tags, date_key, root=None):
+        """the metadata of every photo in `photo_list`, in order, and a dict
+        of the dates they were taken by path.
+
+        photos that aren't in the index, or have changed since, are read
+        with `read_metadata(photos)` in one batch and stored, unless the
+        index is read only. `tags` are
+        the exiftool tags read and `date_key` the one holding the date the
+        photo was taken. photos under `root` that are indexed but no longer
+        in `photo_list` are removed."""
+        paths = [str(Path(photo).resolve()) for photo in photo_list]
+        stats = [os.stat(path) for path in paths]
+        with closing(self._connect()) as connection, connection:
+            indexed = dict()
+            if self._check_tags(connection, tags):
+                indexed = {
+                    path: (size, mtime_ns, date_created, metadata)
+                    for path, size, mtime_ns, date_created, metadata in
+                    connection.execute(
+                        "SELECT path, size, mtime_ns, date_created, "
+                        "metadata FROM photos"
+                    )
+                }
+            metadata_list = [None] * len(paths)
+            dates = dict()
+            stale = []
+            for index, (path, stat) in enumerate(zip(paths, stats)):
+                row = indexed.get(path)
+                if row is None or \
+                        (row[0], row[1]) != (stat.st_size, stat.st_mtime_ns):
+                    stale.append(index)
+                    continue
+                metadata_list[index] = json.loads(row[3])
+                date_created = self._parse_date(row[2])
+                if date_created is not None:
+                    dates[path] = date_created
+            self.hits = len(paths) - len(stale)
+            self.misses = len(stale)
+            rows = []
+            if stale:
+                read_list = read_metadata([paths[index] for index in stale])
+                for index, metadata in zip(stale, read_list):
+                    metadata_list[index] = metadata
+                    if ERROR_KEY in metadata:
+                        continue
+                    date_created = self._parse_date(metadata.get(date_key))
+                    if date_created is not None:
+                        dates[paths[index]] = date_created
+                    rows.append((
+                        paths[index],
+                        stats[index].st_size,
+                        stats[index].st_mtime_ns,
+                        date_created.strftime(EXIF_DATETIME_FMT)
+                        if date_created else None,
+                        json.dumps(metadata)
+                    ))
+            if self.read_only:
+                return metadata_list, dates
+            connection.executemany(
+                "INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            if root is not None:
+                prefix = str(Path(root).resolve()) + os.sep
+                current = set(paths)
+                removed = [
+                    (path,) for path in indexed
+                    if path.startswith(prefix) and path not in current
+                ]
+                connection.executemany(
+                    "DELETE FROM photos WHERE path = ?",
+                    removed
+                )
+        return metadata_list, dates
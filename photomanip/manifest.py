@@ -0,0 +1,91 @@
+import json
+import os
+import tempfile
+
+from pathlib import Path
+
+
+class OutputManifest:
+    """records which photos went into every average written to a directory,
+    as a hash of their fingerprints (see `photomanip.cache.prefix_hashes`),
+    so a rerun can tell an average that's up to date from one whose photos
+    have changed since it was written.
+
+    averages written before there was a manifest have no entry and are taken
+    to be up to date.
+
+    a monthly or yearly average is named after the days it covers, so when a
+    later run adds days to it the average gets a new name. entries note the
+    month or year they average, so the old average can be found and removed
+    once the new one is written."""
+    MANIFEST_NAME = ".avg_manifest.json"
+
+    def __init__(self, output_path):
+        self.output_path = Path(output_path)
+        self.manifest_file = self.output_path / self.MANIFEST_NAME
+        if self.manifest_file.exists():
+            with open(self.manifest_file) as json_fp:
+                self.entries = json.load(json_fp)
+        else:
+            self.entries = dict()
+
+    def _key(self, output_name):
+        output_name = Path(output_name)
+        try:
+            return str(output_name.relative_to(self.output_path))
+        except ValueError:
+            return str(output_name)
+
+    def is_current(self, output_name, inputs_hash):
+        """whether `output_name` exists and was made from the photos
+        identified by `inputs_hash`"""
+        if not Path(output_name).exists():
+            return False
+        entry = self.entries.get(self._key(output_name))
+        return entry is None or entry["inputs"] == inputs_hash
+
+    def record(self, output_name, inputs_hash, num_images, period_name=None):
+        """notes the photos an average was just written from, and the name
+        of the month or year it averages if its name depends on the days it
+        covers"""
+        entry = {
+            "inputs": inputs_hash,
+            "num_images": num_images,
+        }
+        if period_name is not None:
+            entry["period"] = self._key(period_name)
+        self.entries[self._key(output_name)] = entry
+
+    def superseded(self, output_name, period_name, input_hashes):
+        """averages of `period_name` under other names than `output_name`
+        that were made from the first photos of `input_hashes`, the prefix
+        hashes of the photos `output_name` is made from, so it replaces
+        them"""
+        key = self._key(output_name)
+        period = self._key(period_name)
+        stale = []
+        for other_key, entry in self.entries.items():
+            num_images = entry["num_images"]
+            if other_key == key or entry.get("period") != period or \
+                    not 0 < num_images <= len(input_hashes):
+                continue
+            if entry["inputs"] == input_hashes[num_images - 1]:
+                stale.append(self.output_path / other_key)
+        return stale
+
+    def remove(self, output_name):
+        """deletes an average and its entry"""
+        self.entries.pop(self._key(output_name), None)
+        output_name = Path(output_name)
+        if output_name.exists():
+            output_name.unlink()
+
+    def save(self):
+        # replace the manifest in one go so it's never left half written
+        file_descriptor, temp_name = tempfile.mkstemp(
+            suffix=".tmp",
+            dir=self.output_path
+        )
+        with os.fdopen(file_descriptor, "w") as json_fp:
+            json.dump(self.entries, json_fp)
+        os.replace(temp_name, self.manifest_file)
@@ -1,9 +1,102 @@
+import copy
+import tempfile
+
+from contextlib import contextmanager
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 import numpy as np
-from skimage import exposure, io, transform
+from PIL import Image
+from skimage import io, transform
+
+from photomanip import (
+    LANDSCAPE,
+    PORTRAIT,
+    SQUARE,
+    PAD,
+    CROP,
+    RESIZE,
+    FLOAT64,
+    FLOAT32,
+    PILLOW,
+    SKIMAGE,
+    UINT32,
+    MEMMAP
+)
+from photomanip.accumulator import (
+    ACCUMULATORS,
+    STRIP_ROWS,
+    Accumulator,
+    make_accumulator
+)
+from photomanip.metrics import (
+    ACCUMULATE,
+    CACHE_READ,
+    CACHE_WRITE,
+    CONTRAST_STRETCH,
+    DECODE,
+    JPEG_ENCODE,
+    PREPARE,
+    RunMetrics
+)
+from photomanip.prefetch import PREFETCH_BYTES, PREFETCH_DEPTH, prefetch
+
+JPEG_SUFFIXES = {'.jpg', '.jpeg'}
+# resolution of the histogram used to find contrast stretch bounds
+HISTOGRAM_BINS = 2 ** 16
+
+
+class Resampler:
+    """resizes images to an exact height and width"""
+
+    def resize(self, image, height, width, anti_aliasing=False):
+        raise NotImplementedError()
+
+
+class SKIResampler(Resampler):
+    """resamples with `skimage.transform.resize`. works on float64 copies of
+    the image, so it's slow and memory hungry, but has the highest
+    fidelity."""
+
+    def resize(self, image, height, width, anti_aliasing=False):
+        depth = image.shape[2]
+        return transform.resize(
+            image,
+            (height, width, depth),
+            preserve_range=True,
+            anti_aliasing=anti_aliasing
+        )
+
+
+class PillowResampler(Resampler):
+    """resamples uint8 images with Pillow: large reductions are done with a
+    fast box filter (`Image.reduce`) and the remainder with Lanczos. images
+    that aren't uint8 (e.g. cached averages) go through skimage instead."""
 
-from photomanip import LANDSCAPE, PORTRAIT, SQUARE, PAD, CROP, RESIZE
+    def __init__(self):
+        self.fallback = SKIResampler()
+
+    def resize(self, image, height, width, anti_aliasing=False):
+        # lanczos always filters when downscaling, `anti_aliasing` is implied
+        if image.dtype != np.uint8 or image.shape[2] not in (1, 3):
+            return self.fallback.resize(image, height, width, anti_aliasing)
+        pil_image = Image.fromarray(np.squeeze(image, axis=2)
+                                    if image.shape[2] == 1 else image)
+        # box reduce by an integer factor, leaving at least a factor of two
+        # for lanczos so the result stays sharp
+        factor = min(pil_image.height // height, pil_image.width // width)
+        factor //= 2
+        if factor > 1:
+            pil_image = pil_image.reduce(factor)
+        pil_image = pil_image.resize((width, height), Image.LANCZOS)
+        return np.atleast_3d(np.asarray(pil_image))
+
+
+RESAMPLERS = {
+    PILLOW: PillowResampler,
+    SKIMAGE: SKIResampler,
+}
 
 
 class ImageManipulator:
@@ -62,8 +155,43 @@ class ImageManipulator:
 
 
 class ImageManipulatorSKI(ImageManipulator):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, num_workers=1, accumulator_type=FLOAT64,
+                 resampler=PILLOW, memmap_dir=None, exact_stretch=False,
+                 prepared_cache=None, prefetch_depth=PREFETCH_DEPTH,
+                 prefetch_bytes=PREFETCH_BYTES, metrics=None, **kwargs):
         super().__init__(*args, **kwargs)
+        # number of processes used to read and accumulate images in
+        # `combine_images`. 1 means everything happens in this process.
+        self.num_workers = num_workers
+        # data type of the running sum, see `photomanip.accumulator`
+        self.accumulator_type = accumulator_type
+        # where memmap accumulators keep their files, None for the default
+        # temporary directory
+        self.memmap_dir = memmap_dir
+        # find contrast stretch bounds with np.percentile instead of a
+        # histogram estimate
+        self.exact_stretch = exact_stretch
+        # a `photomanip.cache.PreparedImageCache` consulted before images
+        # are read and prepared, or None
+        self.prepared_cache = prepared_cache
+        # number of images read and prepared in background threads while
+        # the current one is accumulated, and the memory they may hold. a
+        # depth of 0 reads every image in turn.
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_bytes = prefetch_bytes
+        # times every stage of reading, preparing, summing and writing, see
+        # `photomanip.metrics`
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        # a process pool kept open by `worker_pool` for the parallel sums,
+        # None to start one for each
+        self.executor = None
+        # used in resize mode, either a name from RESAMPLERS or a Resampler
+        if isinstance(resampler, Resampler):
+            self.resampler = resampler
+        elif resampler in RESAMPLERS:
+            self.resampler = RESAMPLERS[resampler]()
+        else:
+            raise ValueError('invalid value for resampler')
 
     @staticmethod
     def __ensure_3_dims(image):
@@ -95,9 +223,17 @@ class ImageManipulatorSKI(ImageManipulator):
         # you did it
         return tuple(image_size)
 
-    def _read_image(self, filename):
+    def _read_image(self, filename, min_dimension=None):
+        """Reads an image. If `min_dimension` is given, JPEGs are decoded at the
+        smallest DCT scale (1/2, 1/4 or 1/8) that keeps both sides at least
+        `min_dimension` pixels long."""
         filepath = Path(filename)
-        return io.imread(filepath)
+        if min_dimension is None or \
+                filepath.suffix.lower() not in JPEG_SUFFIXES:
+            return io.imread(filepath)
+        with Image.open(filepath) as image:
+            image.draft(image.mode, (min_dimension, min_dimension))
+            return np.asarray(image)
 
     def _even_image(self, image):
         """Ensures an image has even dimensions."""
@@ -127,7 +263,8 @@ class ImageManipulatorSKI(ImageManipulator):
         """Pads an image to a specified dimension."""
         image = self.__ensure_3_dims(image)
         height, width, dim = image.shape
-        padded_image = 255 * np.ones((expand_to, expand_to, dim))
+        padded_image = np.full((expand_to, expand_to, dim), 255,
+                               dtype=image.dtype)
         upper_left = (((expand_to - height) // 2),
                       ((expand_to - width) // 2))
         lower_right = ((upper_left[0] + height),
@@ -155,7 +292,7 @@ class ImageManipulatorSKI(ImageManipulator):
     def _resize_image(self, image, resize_to):
         # resizes image to requested dimension
         image = self.__ensure_3_dims(image)
-        height, width, depth = image.shape
+        height, width, _ = image.shape
 
         # figure out if we are upscaling or downscaling
         # if downscaling, do anti_aliasing
@@ -173,10 +310,10 @@ class ImageManipulatorSKI(ImageManipulator):
         if height == new_height or width == new_width:
             new_image = self._even_image(image)
         else:
-            new_image = transform.resize(
+            new_image = self.resampler.resize(
                 image,
-                (new_height, new_width, depth),
-                preserve_range=True,
+                new_height,
+                new_width,
                 anti_aliasing=downscaling
             )
             new_image = self._even_image(new_image)
@@ -187,6 +324,670 @@ class ImageManipulatorSKI(ImageManipulator):
         """Divides `image` by a divisor and returns it."""
         return image / divisor
 
+    @staticmethod
+    def _shard_metadata(metadata_list, num_shards):
+        """Splits `metadata_list` into `num_shards` contiguous shards, returning
+        each shard along with the image index it starts at."""
+        shard_size, remainder = divmod(len(metadata_list), num_shards)
+        shards = []
+        start = 0
+        start_index = 0
+        for shard_number in range(num_shards):
+            stop = start + shard_size + (1 if shard_number < remainder else 0)
+            shard = metadata_list[start:stop]
+            shards.append((shard, start_index))
+            start_index += len(shard)
+            start = stop
+        return shards
+
+    def new_accumulator(self, output_dimension: int,
+                        accumulator_type: str = None):
+        """Makes an empty accumulator of `accumulator_type`, by default the
+        type in `self.accumulator_type`."""
+        accumulator_type = accumulator_type or self.accumulator_type
+        kwargs = {}
+        if accumulator_type in (FLOAT32, MEMMAP):
+            kwargs['directory'] = self.memmap_dir
+        return make_accumulator(
+            accumulator_type,
+            output_dimension,
+            **kwargs
+        )
+
+    def estimate_accumulator_memory(self, output_dimension: int,
+                                    accumulator_type: str = None):
+        """Memory of an accumulator at `output_dimension`, of
+        `accumulator_type` or `self.accumulator_type`."""
+        accumulator_class = ACCUMULATORS[
+            accumulator_type or self.accumulator_type
+        ]
+        return accumulator_class.estimate_nbytes(output_dimension)
+
+    def estimate_stretch_memory(self, output_dimension: int):
+        """Roughly estimates the memory of contrast stretching an average at
+        `output_dimension`, on top of the average and the 8 bit output: a
+        sorted copy of its pixels for exact bounds, otherwise the histogram,
+        whose 2 ** 16 bins take a few MB at any size, and the temporaries of
+        a strip."""
+        samples = output_dimension * output_dimension * 3
+        if self.exact_stretch:
+            return 17 * samples
+        strip_samples = min(STRIP_ROWS, output_dimension) * \
+            output_dimension * 3
+        return 5 * 8 * HISTOGRAM_BINS + 40 * strip_samples
+
+    def estimate_memory(self, output_dimension: int,
+                        accumulator_type: str = None, num_workers: int = 1):
+        """Roughly estimates the peak memory of summing and writing one
+        average at `output_dimension`: the accumulator, the images being
+        read and prepared (counted at twice the output size, as decoded
+        photos are larger than the crop), the 8 bit output image and the
+        contrast stretch. With several workers, each has its own
+        accumulator and images."""
+        samples = output_dimension * output_dimension * 3
+        accumulator_bytes = self.estimate_accumulator_memory(
+            output_dimension,
+            accumulator_type
+        )
+        images_in_flight = self.prefetch_depth + 1
+        worker_bytes = accumulator_bytes + 2 * samples * images_in_flight
+        output_bytes = samples + self.estimate_stretch_memory(
+            output_dimension
+        )
+        if num_workers > 1:
+            # the workers' partial sums are merged into one more
+            return accumulator_bytes + num_workers * worker_bytes + \
+                output_bytes
+        return worker_bytes + output_bytes
+
+    def estimate_sum_memory(self, output_dimension: int,
+                            accumulator_type: str = None):
+        """Roughly estimates the memory of a running sum at `output_dimension`
+        that averages are written from: the accumulator, a float64 mean, the
+        8 bit output image and the contrast stretch."""
+        samples = output_dimension * output_dimension * 3
+        accumulator_bytes = self.estimate_accumulator_memory(
+            output_dimension,
+            accumulator_type
+        )
+        return accumulator_bytes + 9 * samples + \
+            self.estimate_stretch_memory(output_dimension)
+
+    def prepares_uint8(self, combination_method: str):
+        """Whether images prepared with `combination_method` are 8 bit, so a
+        uint32 sum of them is exact: crops and pads always are, resizes are
+        when Pillow does them."""
+        return combination_method in (CROP, PAD) or \
+            isinstance(self.resampler, PillowResampler)
+
+    def sum_types(self, combination_method: str = None):
+        """Accumulator types a sum can fall back to, from the configured one
+        to the one that needs the least memory: if the images of
+        `combination_method` are 8 bit, a uint32 sum, which takes half the
+        memory of float64 in RAM, and last a memory mapped sum, which keeps
+        the float64 precision. Types that don't need less memory than the
+        one before are left out."""
+        candidates = [self.accumulator_type]
+        if combination_method is not None and \
+                self.prepares_uint8(combination_method):
+            candidates.append(UINT32)
+        candidates.append(MEMMAP)
+        sum_types = []
+        for accumulator_type in candidates:
+            memory = self.estimate_accumulator_memory(1024, accumulator_type)
+            if not sum_types or memory < \
+                    self.estimate_accumulator_memory(1024, sum_types[-1]):
+                sum_types.append(accumulator_type)
+        return sum_types
+
+    def strategies(self, combination_method: str = None):
+        """Ways to run a sum, as (accumulator type, number of processes),
+        from the configured one to the one that needs the least memory: in
+        a single process, then with each of `sum_types` in turn."""
+        fallbacks = []
+        for accumulator_type in self.sum_types(combination_method):
+            fallbacks.extend([(accumulator_type, self.num_workers),
+                              (accumulator_type, 1)])
+        strategies = []
+        for accumulator_type, num_workers in fallbacks:
+            if (accumulator_type, num_workers) not in strategies:
+                strategies.append((accumulator_type, num_workers))
+        return strategies
+
+    def __getstate__(self):
+        # worker processes get the manipulator but not the pool
+        state = self.__dict__.copy()
+        state["executor"] = None
+        return state
+
+    @contextmanager
+    def worker_pool(self, num_workers: int = None):
+        """Keeps one pool of `num_workers` (by default `self.num_workers`)
+        processes open for all the parallel sums made in the block, by this
+        manipulator and the copies `with_strategy` makes of it in the block,
+        instead of starting a pool for each."""
+        if num_workers is None:
+            num_workers = self.num_workers
+        if num_workers <= 1 or self.executor is not None:
+            yield self
+            return
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            self.executor = executor
+            try:
+                yield self
+            finally:
+                self.executor = None
+
+    @contextmanager
+    def _pool(self, num_workers):
+        """The pool opened by `worker_pool`, or a new pool of `num_workers`
+        processes for a single sum."""
+        if self.executor is not None:
+            yield self.executor
+            return
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            yield executor
+
+    def with_strategy(self, accumulator_type: str, num_workers: int):
+        """A copy of this manipulator that sums with `accumulator_type` in
+        `num_workers` processes. Caches, metrics and a pool opened by
+        `worker_pool` are shared."""
+        if (accumulator_type, num_workers) == \
+                (self.accumulator_type, self.num_workers):
+            return self
+        manipulator = copy.copy(self)
+        manipulator.accumulator_type = accumulator_type
+        manipulator.num_workers = num_workers
+        return manipulator
+
+    def _get_prepared_image(self,
+                            fname,
+                            combination_method: str,
+                            output_dimension: int,
+                            pad_on_add: bool = False,
+                            use_cache: bool = True):
+        """Reads and prepares an image, or loads it from
+        `self.prepared_cache`. With `pad_on_add`, pad mode images are only
+        evened; they're padded as they are added to an accumulator."""
+        return self._get_prepared_images(
+            fname,
+            combination_method,
+            [output_dimension],
+            pad_on_add,
+            use_cache
+        )[0]
+
+    def _get_prepared_images(self,
+                             fname,
+                             combination_method: str,
+                             output_dimensions: list,
+                             pad_on_add: bool = False,
+                             use_cache: bool = True):
+        """Like `_get_prepared_image`, but returns the image prepared to each
+        of `output_dimensions`. The image is read at most once, and only if
+        one of the dimensions isn't in the cache."""
+        prepared_cache = self.prepared_cache if use_cache else None
+        variant = ""
+        if combination_method == RESIZE:
+            variant = type(self.resampler).__name__
+        # evened images don't depend on the dimension they'll be padded to
+        if pad_on_add:
+            cache_dimensions = [None] * len(output_dimensions)
+        else:
+            cache_dimensions = output_dimensions
+        images = {}
+        image = None
+        for cache_dimension in cache_dimensions:
+            if cache_dimension in images:
+                continue
+            if prepared_cache:
+                with self.metrics.stage(CACHE_READ) as counts:
+                    prepared = prepared_cache.get(fname, combination_method,
+                                                  cache_dimension, variant)
+                    counts["bytes"] = getattr(prepared, "nbytes", 0)
+                if prepared is not None:
+                    images[cache_dimension] = prepared
+                    continue
+            if image is None:
+                # resizing only needs the shortest side to cover the largest
+                # output, so jpegs can be decoded at a reduced scale. crops
+                # are taken 1:1 from the full resolution image.
+                min_dimension = None
+                if combination_method == RESIZE:
+                    min_dimension = max(output_dimensions)
+                with self.metrics.stage(DECODE) as counts:
+                    image = self._read_image(fname, min_dimension)
+                    counts["bytes"] = image.nbytes
+                if pad_on_add:
+                    with self.metrics.stage(PREPARE, image.nbytes):
+                        image = self._even_image(image)
+            if pad_on_add:
+                prepared = image
+            else:
+                with self.metrics.stage(PREPARE) as counts:
+                    prepared = self.prepare_image(
+                        image,
+                        combination_method,
+                        cache_dimension
+                    )
+                    counts["bytes"] = prepared.nbytes
+            if prepared_cache:
+                with self.metrics.stage(CACHE_WRITE, prepared.nbytes):
+                    prepared_cache.put(fname, combination_method,
+                                       cache_dimension, prepared, variant)
+            images[cache_dimension] = prepared
+        return [images[cache_dimension]
+                for cache_dimension in cache_dimensions]
+
+    def _accumulate_images(self,
+                           metadata_list: list,
+                           output_dimension: int,
+                           num_images: int,
+                           combination_method: str,
+                           start_index: int = 0,
+                           individual_path: Path = None,
+                           accumulator: Accumulator = None):
+        """Reads and prepares every image in `metadata_list` and adds it to
+        `accumulator`, or to a new accumulator if none is given. Returns the
+        accumulator."""
+        if accumulator is None:
+            accumulator = self.new_accumulator(output_dimension)
+        # pad while adding, so the padded image is never built
+        pad_on_add = combination_method == PAD and not individual_path
+        if pad_on_add:
+            add_image = accumulator.add_padded
+        else:
+            add_image = accumulator.add
+
+        # the next images are read and prepared while this one is added
+        def load(metadata):
+            return self._get_prepared_image(
+                metadata['SourceFile'],
+                combination_method,
+                output_dimension,
+                pad_on_add,
+                # individual crops bypass the cache
+                use_cache=not individual_path
+            )
+
+        index = start_index
+        for metadata, current_image in prefetch(load,
+                                                metadata_list,
+                                                self.prefetch_depth,
+                                                self.prefetch_bytes):
+            self.print_status(metadata['SourceFile'], index + 1, num_images)
+            if individual_path:
+                # write out the image before it gets added
+                io.imsave(str(individual_path / f'{index}.jpg'),
+                          current_image.astype('uint8'))
+            with self.metrics.stage(ACCUMULATE, current_image.nbytes):
+                add_image(current_image)
+            index += 1
+        return accumulator
+
+    def start_worker(self):
+        """Called first in a worker process, on its copy of the manipulator,
+        so it only reports what it does itself."""
+        self.metrics = RunMetrics()
+        if self.prepared_cache is not None:
+            self.prepared_cache.reset_counts()
+
+    def _run_shard(self, method_name, *args):
+        """Runs one of the accumulation methods in a worker process and
+        returns its result along with the metrics and prepared image cache
+        used there."""
+        self.start_worker()
+        return (getattr(self, method_name)(*args), self.metrics,
+                self.prepared_cache)
+
+    def merge_worker(self, metrics, prepared_cache, group=None):
+        """Adds the metrics and prepared image cache stats of a worker
+        process, see `_run_shard`."""
+        self.metrics.merge(metrics, group=group)
+        if self.prepared_cache is not None and prepared_cache is not None:
+            self.prepared_cache.merge(prepared_cache)
+
+    def _accumulate_images_parallel(self,
+                                    metadata_list: list,
+                                    output_dimension: int,
+                                    num_images: int,
+                                    combination_method: str,
+                                    start_index: int = 0,
+                                    individual_path: Path = None,
+                                    accumulator: Accumulator = None):
+        """Splits `metadata_list` into one shard per worker, accumulates each
+        shard in a separate process and merges the partial sums."""
+        num_workers = min(self.num_workers, len(metadata_list))
+        if accumulator is None:
+            accumulator = self.new_accumulator(output_dimension)
+        with self._pool(num_workers) as executor:
+            futures = [
+                executor.submit(
+                    self._run_shard,
+                    "_accumulate_images",
+                    shard,
+                    output_dimension,
+                    num_images,
+                    combination_method,
+                    start_index + shard_index,
+                    individual_path
+                )
+                for shard, shard_index in self._shard_metadata(
+                    metadata_list,
+                    num_workers
+                )
+            ]
+            for future in as_completed(futures):
+                partial, metrics, prepared_cache = future.result()
+                accumulator.merge(partial)
+                self.merge_worker(metrics, prepared_cache)
+        return accumulator
+
+    def _accumulate_images_multi(self,
+                                 metadata_list: list,
+                                 output_dimensions: list,
+                                 num_images: int,
+                                 combination_method: str,
+                                 start_index: int = 0,
+                                 accumulators: list = None,
+                                 accumulator_types: list = None):
+        """Reads every image in `metadata_list` once, prepares it to the
+        dimension of each accumulator in `accumulators` (or of new
+        accumulators at `output_dimensions`, of `accumulator_types`) and
+        adds it to all of them. Returns the accumulators."""
+        if accumulators is None:
+            accumulator_types = accumulator_types or \
+                [None] * len(output_dimensions)
+            accumulators = [
+                self.new_accumulator(output_dimension, accumulator_type)
+                for output_dimension, accumulator_type in
+                zip(output_dimensions, accumulator_types)
+            ]
+        pad_on_add = combination_method == PAD
+
+        def load(metadata):
+            return self._get_prepared_images(
+                metadata['SourceFile'],
+                combination_method,
+                output_dimensions,
+                pad_on_add
+            )
+
+        index = start_index
+        for metadata, images in prefetch(load,
+                                         metadata_list,
+                                         self.prefetch_depth,
+                                         self.prefetch_bytes):
+            self.print_status(metadata['SourceFile'], index + 1, num_images)
+            for accumulator, image in zip(accumulators, images):
+                with self.metrics.stage(ACCUMULATE, image.nbytes):
+                    if pad_on_add:
+                        accumulator.add_padded(image)
+                    else:
+                        accumulator.add(image)
+            index += 1
+        return accumulators
+
+    def accumulate_images_multi(self,
+                                metadata_list: list,
+                                accumulators: list,
+                                num_images: int,
+                                combination_method: str = RESIZE):
+        """Adds the images in `metadata_list` to every accumulator in
+        `accumulators`, which may have different dimensions. Each image is
+        read once and prepared once per dimension, so a photo that's part of
+        several averages is only decoded once. With `self.num_workers`
+        processes, each sums a shard of the images into its own set of
+        accumulators, of the same types, which are merged in. `num_images`
+        is only used for status messages. Returns the accumulators."""
+        output_dimensions = [accumulator.dimension
+                             for accumulator in accumulators]
+        if self.num_workers <= 1 or len(metadata_list) <= 1:
+            return self._accumulate_images_multi(
+                metadata_list,
+                output_dimensions,
+                num_images,
+                combination_method,
+                accumulators=accumulators
+            )
+        num_workers = min(self.num_workers, len(metadata_list))
+        with self._pool(num_workers) as executor:
+            futures = [
+                executor.submit(
+                    self._run_shard,
+                    "_accumulate_images_multi",
+                    shard,
+                    output_dimensions,
+                    num_images,
+                    combination_method,
+                    shard_index,
+                    None,
+                    [accumulator.accumulator_type
+                     for accumulator in accumulators]
+                )
+                for shard, shard_index in self._shard_metadata(
+                    metadata_list,
+                    num_workers
+                )
+            ]
+            for future in as_completed(futures):
+                partials, metrics, prepared_cache = future.result()
+                for accumulator, partial in zip(accumulators, partials):
+                    accumulator.merge(partial)
+                self.merge_worker(metrics, prepared_cache)
+        return accumulators
+
+    def load_cached_sum(self,
+                        cached_item: dict,
+                        output_dimension: int,
+                        combination_method: str = RESIZE,
+                        accumulator: Accumulator = None,
+                        accumulator_type: str = None):
+        """Adds the sum stored by an `AverageCache` entry to `accumulator`.
+        Without an accumulator, a new one of `accumulator_type` is started
+        from the stored sum. Returns the accumulator."""
+        with self.metrics.stage(CACHE_READ) as counts:
+            # copy on write, the stored sum is never modified
+            cached_sum = np.load(cached_item["SourceFile"], mmap_mode='c')
+            counts["bytes"] = cached_sum.nbytes
+            if accumulator is None:
+                accumulator = self.new_accumulator(
+                    output_dimension,
+                    accumulator_type
+                )
+                if cached_sum.shape[0] == output_dimension:
+                    accumulator.start_from(cached_sum)
+                    return accumulator
+            self.add_sum(
+                accumulator,
+                cached_sum,
+                cached_item["num_images"],
+                combination_method
+            )
+        return accumulator
+
+    def accumulate_images(self,
+                          metadata_list: list,
+                          output_dimension: int,
+                          num_images: int,
+                          combination_method: str = RESIZE,
+                          individual_path: Path = None,
+                          accumulator: Accumulator = None):
+        """Adds the images in `metadata_list`, each prepared to
+        `output_dimension`, to `accumulator` (or a new accumulator) using
+        `self.num_workers` processes. A cached sum at the start of the list
+        is added as a whole, see `load_cached_sum`. `num_images` is only used
+        for status messages. Returns the accumulator."""
+        start_index = 0
+        if metadata_list and metadata_list[0].get("cached", False):
+            accumulator = self.load_cached_sum(
+                metadata_list[0],
+                output_dimension,
+                combination_method,
+                accumulator
+            )
+            start_index = metadata_list[0]["num_images"]
+            metadata_list = metadata_list[1:]
+        if accumulator is None:
+            accumulator = self.new_accumulator(output_dimension)
+        if not metadata_list:
+            return accumulator
+        if self.num_workers > 1 and len(metadata_list) > 1:
+            accumulate = self._accumulate_images_parallel
+        else:
+            accumulate = self._accumulate_images
+        return accumulate(
+            metadata_list,
+            output_dimension,
+            num_images,
+            combination_method,
+            start_index=start_index,
+            individual_path=individual_path,
+            accumulator=accumulator
+        )
+
+    @staticmethod
+    def _histogram_percentiles(composite_image, percentiles,
+                               strip_rows=STRIP_ROWS):
+        """Estimates percentiles of the pixels of `composite_image` that aren't
+        255 from a fine histogram built one strip of rows at a time."""
+        counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        for start in range(0, composite_image.shape[0], strip_rows):
+            rows = composite_image[start:start + strip_rows]
+            counts += np.histogram(
+                rows[rows != 255],
+                bins=HISTOGRAM_BINS,
+                range=(0, 255)
+            )[0]
+        cumulative = np.cumsum(counts)
+        if cumulative[-1] == 0:
+            return 0, 255
+        bin_width = 255 / HISTOGRAM_BINS
+        bounds = []
+        for percentile in percentiles:
+            rank = percentile / 100 * (cumulative[-1] - 1)
+            index = np.searchsorted(cumulative, rank, side='right')
+            below = cumulative[index - 1] if index > 0 else 0
+            # interpolate within the bin
+            bounds.append(bin_width * (index + (rank - below) / counts[index]))
+        return tuple(bounds)
+
+    def contrast_bounds(self, composite_image, percentiles=(0.5, 99.5)):
+        """Finds the contrast stretch bounds of a composite: the percentiles of
+        its pixels that aren't 255. Exact bounds need a sorted copy of the
+        pixels; otherwise they're estimated from a histogram."""
+        if self.exact_stretch:
+            data_mask = composite_image != 255
+            return tuple(np.percentile(composite_image[data_mask],
+                                       percentiles))
+        return self._histogram_percentiles(composite_image, percentiles)
+
+    @staticmethod
+    def _stretch_strips(composite_image, output_image, lower_bound,
+                        upper_bound, strip_rows=STRIP_ROWS):
+        """Rescales `composite_image` from (lower_bound, upper_bound) to 0-255
+        and writes it straight into the 8 bit `output_image`, one strip of
+        rows at a time. Pixels equal to 255 are left at 255."""
+        height, width, depth = composite_image.shape
+        scratch = np.empty((min(strip_rows, height), width, depth))
+        for start in range(0, height, strip_rows):
+            rows = composite_image[start:start + strip_rows]
+            output_rows = output_image[start:start + strip_rows]
+            stretched = scratch[:rows.shape[0]]
+            np.clip(rows, lower_bound, upper_bound, out=stretched)
+            if lower_bound != upper_bound:
+                np.subtract(stretched, lower_bound, out=stretched)
+                np.divide(stretched, upper_bound - lower_bound, out=stretched)
+                np.multiply(stretched, 255, out=stretched)
+            else:
+                np.clip(stretched, 0, 255, out=stretched)
+            output_rows[...] = 255
+            np.copyto(output_rows, stretched, casting='unsafe',
+                      where=rows != 255)
+
+    def merge_accumulator(self,
+                          accumulator: Accumulator,
+                          partial: Accumulator,
+                          num_images: int,
+                          combination_method: str = RESIZE):
+        """Adds the sum of `num_images` images held by `partial` to
+        `accumulator`. If their dimensions differ, the partial sum is brought
+        to the accumulator's dimension the way single images are prepared:
+        centre cropped, padded with 255 per image, or resampled. Cropping and
+        padding give exactly the sum of the individually prepared images;
+        resampling a sum is an approximation."""
+        if partial.dimension == accumulator.dimension:
+            accumulator.merge(partial)
+            return
+        self.add_sum(
+            accumulator,
+            partial.total(),
+            num_images,
+            combination_method
+        )
+
+    def add_sum(self,
+                accumulator: Accumulator,
+                partial_sum: np.ndarray,
+                num_images: int,
+                combination_method: str = RESIZE):
+        """Adds `partial_sum`, the sum of `num_images` prepared images, to
+        `accumulator`, bringing it to the accumulator's dimension like
+        `merge_accumulator` does."""
+        if partial_sum.shape[0] == accumulator.dimension:
+            accumulator.add(partial_sum)
+        elif combination_method == PAD:
+            accumulator.add_padded(partial_sum, fill=255 * num_images)
+        elif combination_method == CROP:
+            accumulator.add(
+                self._square_image(partial_sum, accumulator.dimension)
+            )
+        else:
+            accumulator.add(
+                self._resize_image(partial_sum, accumulator.dimension)
+            )
+
+    def save_composite(self, composite_image: np.ndarray, out_name: Path,
+                       metadata: dict = None):
+        """Contrast stretches an averaged image and writes it to `out_name`.
+        `composite_image` itself is left untouched. The stretch is done in
+        strips; memory mapped composites are also encoded from a memory
+        map. `metadata` holds exif and IPTC segments to write with the JPEG,
+        see `photomanip.metadata.ImageExif.jpeg_metadata`."""
+        height, width, _ = composite_image.shape
+        if not isinstance(composite_image, np.memmap):
+            with self.metrics.stage(CONTRAST_STRETCH, composite_image.nbytes):
+                lower_bound, upper_bound = \
+                    self.contrast_bounds(composite_image)
+                output_image = np.empty(composite_image.shape,
+                                        dtype=np.uint8)
+                self._stretch_strips(composite_image, output_image,
+                                     lower_bound, upper_bound)
+            with self.metrics.stage(JPEG_ENCODE) as counts:
+                if metadata:
+                    if output_image.shape[2] == 1:
+                        output_image = output_image[:, :, 0]
+                    Image.fromarray(output_image).save(str(out_name), 'JPEG',
+                                                       **metadata)
+                else:
+                    io.imsave(str(out_name), output_image)
+                counts["bytes"] = Path(out_name).stat().st_size
+            return
+        with tempfile.TemporaryFile(dir=self.memmap_dir) as fp:
+            with self.metrics.stage(CONTRAST_STRETCH, composite_image.nbytes):
+                lower_bound, upper_bound = \
+                    self.contrast_bounds(composite_image)
+                # RGBX is the 8 bit layout Pillow can share without a copy
+                output_image = np.memmap(fp, dtype=np.uint8, mode='w+',
+                                         shape=(height, width, 4))
+                self._stretch_strips(composite_image, output_image[:, :, :3],
+                                     lower_bound, upper_bound)
+            with self.metrics.stage(JPEG_ENCODE) as counts:
+                pil_image = Image.frombuffer('RGBX', (width, height),
+                                             output_image, 'raw', 'RGBX', 0, 1)
+                pil_image.save(str(out_name), 'JPEG', **(metadata or {}))
+                counts["bytes"] = Path(out_name).stat().st_size
+
     def combine_images(self,
                        metadata_list: list,
                        output_dimension: int,
@@ -195,60 +996,23 @@ class ImageManipulatorSKI(ImageManipulator):
                        combination_method: str = RESIZE,
                        write_crops: bool = False):
         """Uses OpenCV and associated methods to "average" a list of photographs.
+        If `self.num_workers` is greater than 1, images are read and summed in
+        that many processes.
         """
-        # preallocate
-        composite_image = np.zeros((output_dimension, output_dimension, 3),
-                                   dtype=float)
-
+        individual_path = None
         if write_crops:
             # split off the filename and use that to make a dir
             individual_path = out_name.parent / out_name.stem
             individual_path.mkdir(exist_ok=True)
 
         # now loop through the images, crop or expand them, and then combine.
-        index = 0
-        for metadata in metadata_list:
-            fname = metadata['SourceFile']
-            self.print_status(fname, index + 1, num_images)
-            current_image = self._read_image(fname)
-            current_image = self.prepare_image(
-                current_image,
-                combination_method,
-                output_dimension
-            )
-            if write_crops:
-                # write out the image before it gets scaled
-                io.imsave(str(individual_path / f'{index}.jpg'),
-                          current_image.astype('uint8'))
-            if "cached" in metadata:
-                if metadata["cached"]:
-                    previous_num_images = metadata["num_images"]
-                    current_image *= previous_num_images
-                    index += previous_num_images
-                else:
-                    scaled_image = self.split_scale_image(
-                        current_image,
-                        num_images
-                    )
-                    index += 1
-            else:
-                index += 1
-            scaled_image = self.split_scale_image(
-                current_image,
-                num_images
-            )
-            composite_image += scaled_image
-
-        composite_float = np.copy(composite_image)
-        # Contrast stretching
-        data_mask = composite_image != 255
-        lower_bound, upper_bound = \
-            np.percentile(composite_image[data_mask], (0.5, 99.5))
-        composite_image[data_mask] = \
-            exposure.rescale_intensity(composite_image[data_mask],
-                                       in_range=(lower_bound, upper_bound),
-                                       out_range='uint8')
-
-        # write the image
-        io.imsave(str(out_name), composite_image.astype('uint8'))
-        return composite_float
+        accumulator = self.accumulate_images(
+            metadata_list,
+            output_dimension,
+            num_images,
+            combination_method,
+            individual_path
+        )
+        composite_image = accumulator.finalize(num_images)
+        self.save_composite(composite_image, out_name)
+        return composite_image
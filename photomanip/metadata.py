@@ -1,4 +1,204 @@
+import json
+import os
+import queue
+import re
+import struct
+import threading
+
 import exiftool
+from PIL import Image
+
+# exif pointer to the Exif sub-IFD
+EXIF_IFD = 0x8769
+# IPTC tag in a Photoshop image resource block
+IPTC_RESOURCE_ID = 0x0404
+# IPTC record and dataset of keywords
+IPTC_KEYWORDS = (2, 25)
+# tag exiftool reports an unreadable file in, also used for files it
+# returns nothing for
+ERROR_KEY = "ExifTool:Error"
+# files sent to an exiftool process at a time by `get_metadata_batch`
+EXIFTOOL_CHUNK_SIZE = 256
+# exif tags read by `read_jpeg_header`
+EXPOSURE_TIME_TAG = 0x829A
+DATE_TIME_ORIGINAL_TAG = 0x9003
+# start of frame markers, which hold the image size
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# values exiftool writes to json as numbers rather than strings
+JSON_NUMBER = re.compile(r"-?(\d|[1-9]\d{1,14})(\.\d{1,16})?(e[-+]?\d{1,3})?",
+                         re.IGNORECASE)
+
+
+class HeaderError(ValueError):
+    """a JPEG header `read_jpeg_header` can't parse"""
+
+
+def _json_value(text):
+    """a tag value as exiftool's json has it"""
+    if JSON_NUMBER.fullmatch(text):
+        return json.loads(text)
+    return text
+
+
+def _read_ifd(tiff, offset, byte_order):
+    """the entries of a TIFF IFD as {tag: (type, count, value or offset
+    field)}"""
+    (num_entries,) = struct.unpack_from(byte_order + "H", tiff, offset)
+    entries = dict()
+    for index in range(num_entries):
+        tag, tag_type, count = struct.unpack_from(
+            byte_order + "HHI",
+            tiff,
+            offset + 2 + 12 * index
+        )
+        field = offset + 2 + 12 * index + 8
+        entries[tag] = (tag_type, count, field)
+    return entries
+
+
+def _parse_exif(tiff):
+    """ExposureTime and DateTimeOriginal from the TIFF data of an APP1
+    segment"""
+    byte_order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if byte_order is None:
+        raise HeaderError("bad TIFF byte order")
+    (ifd0_offset,) = struct.unpack_from(byte_order + "I", tiff, 4)
+    ifd0 = _read_ifd(tiff, ifd0_offset, byte_order)
+    metadata = dict()
+    if EXIF_IFD not in ifd0:
+        return metadata
+    (exif_offset,) = struct.unpack_from(byte_order + "I", tiff,
+                                        ifd0[EXIF_IFD][2])
+    exif_ifd = _read_ifd(tiff, exif_offset, byte_order)
+    if EXPOSURE_TIME_TAG in exif_ifd:
+        tag_type, count, field = exif_ifd[EXPOSURE_TIME_TAG]
+        # unsigned or signed rational
+        if tag_type not in (5, 10) or count != 1:
+            raise HeaderError("unexpected ExposureTime type")
+        (value_offset,) = struct.unpack_from(byte_order + "I", tiff, field)
+        rational_format = byte_order + ("II" if tag_type == 5 else "ii")
+        numerator, denominator = struct.unpack_from(rational_format, tiff,
+                                                    value_offset)
+        if denominator == 0:
+            raise HeaderError("ExposureTime divides by zero")
+        # exiftool prints 10 significant digits
+        metadata["EXIF:ExposureTime"] = _json_value(
+            "%.10g" % (numerator / denominator)
+        )
+    if DATE_TIME_ORIGINAL_TAG in exif_ifd:
+        tag_type, count, field = exif_ifd[DATE_TIME_ORIGINAL_TAG]
+        if tag_type != 2:
+            raise HeaderError("unexpected DateTimeOriginal type")
+        if count > 4:
+            (field,) = struct.unpack_from(byte_order + "I", tiff, field)
+        value = tiff[field:field + count]
+        if len(value) != count:
+            raise HeaderError("truncated DateTimeOriginal")
+        metadata["EXIF:DateTimeOriginal"] = _json_value(
+            value.split(b"\x00")[0].decode("utf-8").strip()
+        )
+    return metadata
+
+
+def _parse_iptc_keywords(resources):
+    """IPTC keywords from the Photoshop image resources of APP13 segments,
+    as exiftool has them: a string for one keyword, a list for more"""
+    iptc = None
+    offset = 0
+    while offset + 12 <= len(resources) and \
+            resources[offset:offset + 4] == b"8BIM":
+        (resource_id, name_length) = struct.unpack_from(">HB", resources,
+                                                        offset + 4)
+        # pascal string name, padded to an even length
+        offset += 6 + name_length + 1 + (name_length + 1) % 2
+        (size,) = struct.unpack_from(">I", resources, offset)
+        offset += 4
+        if resource_id == IPTC_RESOURCE_ID:
+            iptc = resources[offset:offset + size]
+        offset += size + size % 2
+    if iptc is None:
+        return None
+    encoding = "latin-1"
+    keywords = []
+    offset = 0
+    while offset + 5 <= len(iptc) and iptc[offset] == 0x1C:
+        record, dataset, length = struct.unpack_from(">BBH", iptc,
+                                                     offset + 1)
+        if length & 0x8000:
+            raise HeaderError("extended IPTC dataset")
+        value = iptc[offset + 5:offset + 5 + length]
+        offset += 5 + length
+        if (record, dataset) == (1, 90) and value == b"\x1b%G":
+            encoding = "utf-8"
+        elif (record, dataset) == IPTC_KEYWORDS:
+            keywords.append(value)
+    if not keywords:
+        return None
+    keywords = [_json_value(keyword.decode(encoding)) for keyword in keywords]
+    return keywords[0] if len(keywords) == 1 else keywords
+
+
+def read_jpeg_header(filename):
+    """reads the size, exposure time, date taken and IPTC keywords of a JPEG
+    from its header, without exiftool. only the segments up to the start of
+    the frame are read, and of those only APP1, APP13 and the frame header
+    itself.
+
+    Parameters
+    ----------
+    filename : string
+        path of the image
+
+    Returns
+    -------
+    dict
+        the same tags exiftool returns for `ImageExif.GET_EXIF_TAG_SET`
+
+    Raises
+    ------
+    HeaderError
+        if the file isn't a JPEG this can parse
+    """
+    metadata = {"SourceFile": filename}
+    resources = b""
+    with open(filename, "rb") as fp:
+        if fp.read(2) != b"\xff\xd8":
+            raise HeaderError("not a JPEG")
+        while True:
+            marker = fp.read(2)
+            # fill bytes may come before a marker
+            while marker[:1] == b"\xff" and marker[1:] == b"\xff":
+                marker = marker[1:] + fp.read(1)
+            if len(marker) != 2 or marker[0] != 0xFF:
+                raise HeaderError("no frame header")
+            length_bytes = fp.read(2)
+            if len(length_bytes) != 2:
+                raise HeaderError("truncated segment")
+            (length,) = struct.unpack(">H", length_bytes)
+            if marker[1] == 0xDA:
+                raise HeaderError("no frame header")
+            if marker[1] not in SOF_MARKERS and marker[1] not in (0xE1, 0xED):
+                fp.seek(length - 2, os.SEEK_CUR)
+                continue
+            segment = fp.read(length - 2)
+            if len(segment) != length - 2:
+                raise HeaderError("truncated segment")
+            if marker[1] in SOF_MARKERS:
+                height, width = struct.unpack_from(">HH", segment, 1)
+                metadata["File:ImageWidth"] = width
+                metadata["File:ImageHeight"] = height
+                break
+            if marker[1] == 0xE1 and segment.startswith(b"Exif\x00\x00") \
+                    and "EXIF:DateTimeOriginal" not in metadata:
+                metadata.update(_parse_exif(segment[6:]))
+            elif marker[1] == 0xED and \
+                    segment.startswith(b"Photoshop 3.0\x00"):
+                # resources can be split across segments
+                resources += segment[14:]
+    keywords = _parse_iptc_keywords(resources)
+    if keywords is not None:
+        metadata["IPTC:Keywords"] = keywords
+    return metadata
 
 
 class SetExifTool(exiftool.ExifTool):
@@ -62,6 +262,22 @@ class ImageExif:
         "copyright_exif",
         "copyright_iptc",
     }
+    # tags that can be written in process, as (IFD or None for IFD0, tag)
+    # for exif and (record, dataset, longest value) for IPTC. exiftool
+    # truncates IPTC values to the same lengths.
+    EXIF_TAGS = {
+        "software": (None, 0x0131),
+        "artist": (None, 0x013B),
+        "copyright_exif": (None, 0x8298),
+        "date_created": (EXIF_IFD, 0x9003),
+    }
+    IPTC_DATASETS = {
+        "name": (2, 5, 64),
+        "keywords": (2, 25, 64),
+        "byline": (2, 80, 32),
+        "copyright_iptc": (2, 116, 128),
+        "caption": (2, 120, 2000),
+    }
 
     def __init__(self, *args, **kwargs):
         self.artist = ""
@@ -76,6 +292,19 @@ class ImageExif:
         else:
             self.get_list = self.GET_EXIF_TAG_SET
 
+        # exiftool processes run at once by `get_metadata_batch`
+        if "num_workers" in kwargs:
+            self.num_workers = kwargs["num_workers"]
+        else:
+            self.num_workers = os.cpu_count() or 1
+
+        # read JPEG headers in process where possible, see
+        # `read_jpeg_header`
+        if "read_headers" in kwargs:
+            self.read_headers = kwargs["read_headers"]
+        else:
+            self.read_headers = True
+
     def _generate_tag_list(self, tag_iterable=None, set_tags=False):
         if set_tags:
             return {item: self.metadata_map[item] + "={}"
@@ -88,9 +317,52 @@ class ImageExif:
             "+={}"
         return [keyword_set_string.format(item) for item in keyword_iterable]
 
-    def get_metadata_batch(self, filename_list, get_list=None):
+    @staticmethod
+    def _read_chunk(et, tag_list, filename_list):
+        """reads the tags of a chunk of files with a running exiftool. files
+        exiftool fails on, or returns nothing for, get a dict with just
+        their name and the error under `ERROR_KEY`.
+
+        Parameters
+        ----------
+        et : SetExifTool
+            running exiftool process
+        tag_list : list
+            contains exiftool tag names
+        filename_list : list
+            contains paths of images as strings
+
+        Returns
+        -------
+        list
+            contains dictionaries of image metadata, in the order of
+            filename_list
+        """
+        try:
+            read_list = et.get_tags_batch(tag_list, filename_list)
+        except ValueError as error:
+            # no json at all, e.g. none of the files could be read
+            if len(filename_list) == 1:
+                return [{"SourceFile": filename_list[0],
+                         ERROR_KEY: str(error) or "no metadata returned"}]
+            # find out which files are to blame
+            return [metadata
+                    for filename in filename_list
+                    for metadata in ImageExif._read_chunk(et, tag_list,
+                                                          [filename])]
+        by_name = {metadata.get("SourceFile"): metadata
+                   for metadata in read_list}
+        return [by_name.get(filename, {"SourceFile": filename,
+                                       ERROR_KEY: "no metadata returned"})
+                for filename in filename_list]
+
+    def get_metadata_batch(self, filename_list, get_list=None,
+                           num_workers=None, chunk_size=EXIFTOOL_CHUNK_SIZE):
         """gets all metadata specified in get_list or self.get_list from all
-        files in filename_list
+        files in filename_list. if only tags in GET_EXIF_TAG_SET are asked
+        for, JPEG headers are read in process with `read_jpeg_header`. the
+        other files are read in chunks by up to num_workers exiftool
+        processes, each kept running until every chunk is done.
 
         Parameters
         ----------
@@ -98,20 +370,83 @@ class ImageExif:
             contains path-like objects for images
         get_list : list or set, optional
             contains metadata type keys, by default None
+        num_workers : int, optional
+            number of exiftool processes, by default self.num_workers
+        chunk_size : int, optional
+            number of files sent to a process at a time
 
         Returns
         -------
         list
-            contains dictionaries of image metadata
+            contains dictionaries of image metadata, in the order of
+            filename_list. a file that couldn't be read has just its
+            SourceFile and an error message under `ERROR_KEY`.
         """
         # handle case where filenames are path objects
         filename_list = [str(item) for item in filename_list]
-        if get_list:
-            get_list = self._generate_tag_list(get_list)
-        else:
-            get_list = self._generate_tag_list(self.get_list)
-        with SetExifTool() as et:
-            metadata_list = et.get_tags_batch(get_list, filename_list)
+        get_list = get_list or self.get_list
+        tag_list = self._generate_tag_list(get_list)
+        metadata_list = [None] * len(filename_list)
+        if self.read_headers and set(get_list) <= self.GET_EXIF_TAG_SET:
+            for index, filename in enumerate(filename_list):
+                try:
+                    metadata = read_jpeg_header(filename)
+                except (OSError, HeaderError, struct.error,
+                        UnicodeDecodeError):
+                    # left to exiftool
+                    continue
+                metadata_list[index] = {
+                    key: value for key, value in metadata.items()
+                    if key == "SourceFile" or key in tag_list
+                }
+        fallback = [index for index, metadata in enumerate(metadata_list)
+                    if metadata is None]
+        if fallback:
+            read_list = self._read_with_exiftool(
+                [filename_list[index] for index in fallback],
+                tag_list,
+                num_workers or self.num_workers,
+                chunk_size
+            )
+            for index, metadata in zip(fallback, read_list):
+                metadata_list[index] = metadata
+        return metadata_list
+
+    def _read_with_exiftool(self, filename_list, tag_list, num_workers,
+                            chunk_size):
+        """reads the tags in tag_list from filename_list with a pool of
+        exiftool processes, see `get_metadata_batch`"""
+        # ask for exiftool's own errors too
+        tag_list = tag_list + [ERROR_KEY]
+        chunks = queue.Queue()
+        for start in range(0, len(filename_list), chunk_size):
+            chunks.put((start, filename_list[start:start + chunk_size]))
+        num_workers = min(num_workers, chunks.qsize())
+        metadata_list = [None] * len(filename_list)
+        failures = []
+
+        def read_chunks():
+            try:
+                with SetExifTool() as et:
+                    while True:
+                        try:
+                            start, chunk = chunks.get_nowait()
+                        except queue.Empty:
+                            return
+                        metadata_list[start:start + len(chunk)] = \
+                            self._read_chunk(et, tag_list, chunk)
+            except Exception as error:
+                failures.append(error)
+
+        workers = [threading.Thread(target=read_chunks)
+                   for _ in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if failures:
+            # e.g. exiftool couldn't be started
+            raise failures[0]
         return metadata_list
 
     def set_image_metadata(self, fname, meta_dict):
@@ -147,6 +482,74 @@ class ImageExif:
             result = et.set_tags(set_list, fname)
         return result  # i guess
 
+    @staticmethod
+    def _iptc_dataset(record, dataset, value):
+        return struct.pack(">BBBH", 0x1C, record, dataset, len(value)) + \
+            value
+
+    def _build_iptc(self, meta_dict):
+        """IPTC-IIM datasets in UTF-8, wrapped in a Photoshop image resource
+        block in an APP13 segment"""
+        # coded character set: UTF-8
+        datasets = [self._iptc_dataset(1, 90, b"\x1b%G")]
+        # datasets go in order of their numbers
+        for key, (record, dataset, max_length) in self.IPTC_DATASETS.items():
+            if key not in meta_dict:
+                continue
+            values = meta_dict[key]
+            if isinstance(values, str):
+                values = [values]
+            for value in values:
+                value = str(value).encode("utf-8")[:max_length]
+                datasets.append(self._iptc_dataset(record, dataset, value))
+        iptc = b"".join(datasets)
+        # resource with an empty, padded name; data padded to even length
+        resource = b"8BIM" + struct.pack(">HHI", IPTC_RESOURCE_ID, 0,
+                                         len(iptc)) + iptc
+        if len(iptc) % 2:
+            resource += b"\x00"
+        segment = b"Photoshop 3.0\x00" + resource
+        return b"\xff\xed" + struct.pack(">H", len(segment) + 2) + segment
+
+    def _build_exif(self, meta_dict):
+        exif = Image.Exif()
+        for key, (ifd, tag) in self.EXIF_TAGS.items():
+            if key not in meta_dict:
+                continue
+            if ifd is None:
+                exif[tag] = str(meta_dict[key])
+            else:
+                exif.get_ifd(ifd)[tag] = str(meta_dict[key])
+        return exif.tobytes()
+
+    def can_embed(self, meta_dict):
+        """whether `jpeg_metadata` can write every tag in meta_dict"""
+        return all(key in self.EXIF_TAGS or key in self.IPTC_DATASETS
+                   for key in meta_dict)
+
+    def jpeg_metadata(self, meta_dict):
+        """builds the exif (APP1) and IPTC (APP13) segments for the metadata in
+        meta_dict, so they can be written along with the image by a single
+        JPEG encode instead of by exiftool afterwards
+
+        Parameters
+        ----------
+        meta_dict : dict
+            contains the metadata to be added, as for `set_image_metadata`
+
+        Returns
+        -------
+        dict or None
+            keyword arguments for Pillow's JPEG encoder, or None if meta_dict
+            has tags that only exiftool can write
+        """
+        if not self.can_embed(meta_dict):
+            return None
+        return {
+            "exif": self._build_exif(meta_dict),
+            "extra": self._build_iptc(meta_dict),
+        }
+
     def get_tags_containing(self, keyword_list, search_term):
         """searches for kewords containing search_term in a list of keywords
 
@@ -0,0 +1,186 @@
+import json
+import threading
+
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+# stages of a run timed by `RunMetrics`, in the order they happen
+SCAN = "scan"
+INDEX_READ = "index_read"
+EXIF_READ = "exif_read"
+DECODE = "decode"
+PREPARE = "prepare"
+ACCUMULATE = "accumulate"
+CONTRAST_STRETCH = "contrast_stretch"
+JPEG_ENCODE = "jpeg_encode"
+EXIF_WRITE = "exif_write"
+CACHE_READ = "cache_read"
+CACHE_WRITE = "cache_write"
+UPLOAD = "upload"
+STAGES = [
+    SCAN,
+    INDEX_READ,
+    EXIF_READ,
+    DECODE,
+    PREPARE,
+    ACCUMULATE,
+    CONTRAST_STRETCH,
+    JPEG_ENCODE,
+    EXIF_WRITE,
+    CACHE_READ,
+    CACHE_WRITE,
+    UPLOAD,
+]
+
+# name of the report written next to the averages
+METRICS_NAME = "avg_metrics.json"
+
+
+def _add_stage(totals, stage, seconds, nbytes, items):
+    stage_totals = totals.setdefault(
+        stage,
+        {"seconds": 0.0, "bytes": 0, "items": 0}
+    )
+    stage_totals["seconds"] += seconds
+    stage_totals["bytes"] += nbytes
+    stage_totals["items"] += items
+
+
+def _summarise(totals):
+    """stage totals with their throughput, in the order of `STAGES`"""
+    summary = {}
+    for stage in sorted(totals, key=lambda stage: (
+            STAGES.index(stage) if stage in STAGES else len(STAGES), stage)):
+        stage_totals = dict(totals[stage])
+        seconds = stage_totals["seconds"]
+        stage_totals["items_per_second"] = \
+            stage_totals["items"] / seconds if seconds else None
+        stage_totals["bytes_per_second"] = \
+            stage_totals["bytes"] / seconds if seconds else None
+        summary[stage] = stage_totals
+    return summary
+
+
+class RunMetrics:
+    """wall time, bytes and number of items of every stage of a run, for the
+    whole run and for each group of photos averaged.
+
+    stages run in prefetch threads are timed in those threads, so the times
+    of overlapping stages can add up to more than the elapsed time. a worker
+    process records into a new instance, which is sent back and added with
+    `merge`.
+
+    hooks added with `add_hook` are called as
+    `hook(stage, seconds, nbytes, items, group)` every time a stage is
+    recorded, from whichever thread ran it. `group` is the name of the
+    current group, or None."""
+
+    def __init__(self):
+        self.start = timer()
+        self.totals = dict()
+        # (name, elapsed seconds or None, stage totals) for every group
+        self.groups = []
+        self.hooks = []
+        self._group = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # locks and hooks don't cross process boundaries
+        with self._lock:
+            return {
+                "start": self.start,
+                "totals": self.totals,
+                "groups": self.groups,
+            }
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def record(self, stage, seconds, nbytes=0, items=1):
+        with self._lock:
+            _add_stage(self.totals, stage, seconds, nbytes, items)
+            group = self._group
+            if group is not None:
+                _add_stage(group[2], stage, seconds, nbytes, items)
+        for hook in self.hooks:
+            hook(stage, seconds, nbytes, items,
+                 group[0] if group is not None else None)
+
+    @contextmanager
+    def stage(self, stage, nbytes=0, items=1):
+        """times the body of a `with` block as `stage`. the number of bytes
+        and items can also be set on the yielded dict once they're known."""
+        counts = {"bytes": nbytes, "items": items}
+        start = timer()
+        try:
+            yield counts
+        finally:
+            self.record(stage, timer() - start, counts["bytes"],
+                        counts["items"])
+
+    @contextmanager
+    def group(self, name):
+        """stages recorded in the body of a `with` block are also counted
+        for the group `name`"""
+        group = [name, None, dict()]
+        with self._lock:
+            self.groups.append(group)
+            outer, self._group = self._group, group
+        start = timer()
+        try:
+            yield
+        finally:
+            group[1] = timer() - start
+            with self._lock:
+                self._group = outer
+
+    def merge(self, other, group=None):
+        """adds the stages recorded by `other`, e.g. in a worker process, to
+        the current group, or to a new group `group`. the groups `other`
+        recorded itself are added as they are."""
+        with self._lock:
+            for name, elapsed, totals in other.groups:
+                self.groups.append([
+                    name,
+                    elapsed,
+                    {stage: dict(stage_totals)
+                     for stage, stage_totals in totals.items()}
+                ])
+            target = self._group
+            if group is not None:
+                target = [group, None, dict()]
+                self.groups.append(target)
+            for stage, stage_totals in other.totals.items():
+                for totals in [self.totals] + \
+                        ([target[2]] if target is not None else []):
+                    _add_stage(
+                        totals,
+                        stage,
+                        stage_totals["seconds"],
+                        stage_totals["bytes"],
+                        stage_totals["items"]
+                    )
+
+    def report(self):
+        """the metrics as a json serialisable dict"""
+        with self._lock:
+            return {
+                "elapsed": timer() - self.start,
+                "stages": _summarise(self.totals),
+                "groups": [
+                    {
+                        "name": name,
+                        "elapsed": elapsed,
+                        "stages": _summarise(totals),
+                    }
+                    for name, elapsed, totals in self.groups
+                ],
+            }
+
+    def write_json(self, filename):
+        with open(filename, "w") as json_fp:
+            json.dump(self.report(), json_fp, indent=2)
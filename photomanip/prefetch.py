@@ -0,0 +1,63 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# number of images read ahead of the one being accumulated
+PREFETCH_DEPTH = 4
+# upper bound on the memory held by read-ahead images, in bytes
+PREFETCH_BYTES = 2 ** 30
+
+
+def _nbytes(result):
+    """memory held by a loaded item: an array, or a list of arrays"""
+    if isinstance(result, (list, tuple)):
+        return sum(_nbytes(part) for part in result)
+    return getattr(result, "nbytes", 0)
+
+
+def prefetch(load, items, depth=PREFETCH_DEPTH, max_bytes=PREFETCH_BYTES):
+    """yields `(item, load(item))` for every item in `items`, in order, while
+    up to `depth` of the following items are loaded in background threads.
+
+    decoding and numpy release the gil, so reading the next images overlaps
+    with whatever the caller does with the current one. `max_bytes` caps the
+    memory of the images held in the queue: the size of an image isn't known
+    until it's loaded, so the largest one seen so far is used as the
+    estimate, and only one is read ahead until the first has arrived. one
+    image is always loaded, whatever the cap. a `depth` of 0 loads every
+    item in the calling thread."""
+    if depth < 1:
+        for item in items:
+            yield item, load(item)
+        return
+
+    items = iter(items)
+    queue = deque()
+    # unknown until the first image is loaded
+    largest_bytes = None
+
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        def fill():
+            while len(queue) < depth and \
+                    (not queue or
+                     (largest_bytes is not None and
+                      (len(queue) + 1) * largest_bytes <= max_bytes)):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                queue.append((item, executor.submit(load, item)))
+
+        try:
+            fill()
+            while queue:
+                item, future = queue.popleft()
+                result = future.result()
+                largest_bytes = max(largest_bytes or 0, _nbytes(result))
+                # queue the next reads before handing this one over
+                fill()
+                yield item, result
+        finally:
+            # the caller stopped early or an image couldn't be read, don't
+            # wait for reads nobody will use
+            for _, future in queue:
+                future.cancel()
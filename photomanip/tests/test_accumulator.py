@@ -0,0 +1,92 @@
+import pickle
+
+import numpy as np
+
+from nose import tools
+
+from photomanip import FLOAT64, FLOAT32, UINT32, MEMMAP
+from photomanip.accumulator import STRIP_ROWS, make_accumulator
+
+
+class TestAccumulator:
+    @classmethod
+    def setup_class(cls):
+        random_state = np.random.RandomState(365)
+        cls.image_list = [
+            random_state.randint(0, 256, (10, 10, 3)).astype(np.uint8)
+            for _ in range(50)
+        ]
+        cls.expected_mean = np.mean(
+            np.array(cls.image_list, dtype=np.float64),
+            axis=0
+        )
+
+    def test_accumulator_types(self):
+        for accumulator_type in [FLOAT64, FLOAT32, UINT32, MEMMAP]:
+            accumulator = make_accumulator(accumulator_type, 10)
+            for image in self.image_list:
+                accumulator.add(image)
+            result = accumulator.mean(len(self.image_list))
+            tools.eq_(np.allclose(result, self.expected_mean), True)
+            # finalizing gives the same result as the mean
+            result = accumulator.finalize(len(self.image_list))
+            tools.eq_(np.allclose(result, self.expected_mean), True)
+
+    def test_accumulator_weight_merge(self):
+        for accumulator_type in [FLOAT64, FLOAT32, UINT32, MEMMAP]:
+            first = make_accumulator(accumulator_type, 10)
+            second = make_accumulator(accumulator_type, 10)
+            for image in self.image_list[:20]:
+                first.add(image)
+            # a cached average counts as many images
+            cached_mean = np.mean(
+                np.array(self.image_list[20:], dtype=np.float64),
+                axis=0
+            )
+            second.add(cached_mean, len(self.image_list) - 20)
+            # partial sums come back from worker processes pickled
+            first.merge(pickle.loads(pickle.dumps(second)))
+            result = first.mean(len(self.image_list))
+            # uint32 rounds the weighted average to whole numbers
+            tools.eq_(np.allclose(result, self.expected_mean, atol=0.5), True)
+
+    def test_float32_flushes(self):
+        # 100k additions of a value float32 can't represent exactly stay
+        # accurate, as they're flushed into float64
+        accumulator = make_accumulator(FLOAT32, 2, 1)
+        image = np.full((2, 2, 1), 0.1)
+        for _ in range(100000):
+            accumulator.add(image)
+        tools.eq_(np.allclose(accumulator.total(), 10000, rtol=1e-6), True)
+
+    def test_nbytes(self):
+        dimension = 1000
+        for accumulator_type in [FLOAT64, FLOAT32, UINT32]:
+            accumulator = make_accumulator(accumulator_type, dimension)
+            # every array is counted, and estimated before it's built
+            tools.eq_(accumulator.nbytes,
+                      type(accumulator).estimate_nbytes(dimension))
+        float64_bytes = make_accumulator(FLOAT64, dimension).nbytes
+        tools.eq_(make_accumulator(UINT32, dimension).nbytes,
+                  float64_bytes // 2)
+        # float32 holds half as much, plus a strip of its flushed float64 sum
+        strip_bytes = STRIP_ROWS * dimension * 3 * 8
+        tools.eq_(make_accumulator(FLOAT32, dimension).nbytes,
+                  float64_bytes // 2 + strip_bytes)
+        tools.eq_(make_accumulator(FLOAT32, dimension).nbytes <
+                  0.8 * float64_bytes, True)
+
+    def test_add_padded(self):
+        image = self.image_list[0][:6, :4]
+        expected = np.full((10, 10, 3), 255, dtype=np.uint8)
+        expected[2:8, 3:7] = image
+        for accumulator_type in [FLOAT64, FLOAT32, UINT32, MEMMAP]:
+            # strips of 3 rows don't line up with the image
+            accumulator = make_accumulator(accumulator_type, 10,
+                                           strip_rows=3)
+            accumulator.add_padded(image, 2)
+            tools.eq_(np.allclose(accumulator.total(), 2 * expected), True)
+
+    @tools.raises(ValueError)
+    def test_invalid_accumulator(self):
+        make_accumulator('float16', 10)
@@ -0,0 +1,519 @@
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+
+from pathlib import Path
+
+import numpy as np
+
+from nose import tools
+from PIL import Image, IptcImagePlugin
+from skimage import io
+
+from photomanip import CROP, PAD, RESIZE, accumulator, manipulator
+from photomanip.averager import AverageCache, Averager, ConstructMetadata
+from photomanip.manipulator import PillowResampler, SKIResampler
+
+
+class TestAverager:
+    @classmethod
+    def setup_class(cls):
+        cls.output_path_list = []
+        # count how many times each image is decoded
+        cls.read_list = []
+
+    @classmethod
+    def teardown_class(cls):
+        for output_path in cls.output_path_list:
+            shutil.rmtree(output_path)
+
+    def make_averager(self):
+        output_path = Path(tempfile.mkdtemp())
+        self.output_path_list.append(output_path)
+        averager = Averager(
+            Path('photomanip/tests/'),
+            output_path,
+            ConstructMetadata("test author", "all rights reserved"),
+            grouping_tag='faceit365:date=',
+            comb_method=CROP
+        )
+        read_image = averager.manipulator._read_image
+
+        def counting_read_image(filename, *args, **kwargs):
+            self.read_list.append(filename)
+            return read_image(filename, *args, **kwargs)
+        averager.manipulator._read_image = counting_read_image
+        del self.read_list[:]
+        return averager
+
+    def test_average_by_month_progressive(self):
+        averager = self.make_averager()
+        image_list = averager.average_by_month(progressive=True)
+        # the first day of each month only has one photo
+        tools.eq_(len(image_list), 2)
+        for fname in image_list:
+            tools.eq_(fname.exists(), True)
+        # every photo is decoded exactly once
+        tools.eq_(len(self.read_list), 7)
+        tools.eq_(len(set(self.read_list)), 7)
+        # and the run is reported next to the averages
+        with open(averager.output_path / "avg_metrics.json") as json_fp:
+            report = json.load(json_fp)
+        tools.eq_(report["stages"]["decode"]["items"], 7)
+
+    def test_average_all(self):
+        averager = self.make_averager()
+        daily_list, monthly_list, yearly_list = averager.average_all(
+            progressive=True
+        )
+        tools.eq_(len(daily_list), 2)
+        tools.eq_(len(monthly_list), 2)
+        tools.eq_(len(yearly_list), 3)
+        for fname in daily_list + monthly_list + yearly_list:
+            tools.eq_(fname.exists(), True)
+        # every photo is decoded exactly once for all three kinds of average
+        tools.eq_(len(self.read_list), 7)
+        tools.eq_(len(set(self.read_list)), 7)
+        # and the run is reported next to the averages
+        with open(averager.output_path / "avg_metrics.json") as json_fp:
+            report = json.load(json_fp)
+        tools.eq_(report["stages"]["decode"]["items"], 7)
+        tools.eq_(report["stages"]["exif_write"]["items"], 7)
+        # one group per day
+        tools.eq_(len(report["groups"]), 4)
+        # the tags are written with the jpeg
+        with Image.open(daily_list[0]) as image:
+            keywords = IptcImagePlugin.getiptcinfo(image)[(2, 25)]
+        tools.eq_(b"avgday:count=2" in keywords, True)
+
+        # nothing left to do on a second run
+        del self.read_list[:]
+        daily_list, monthly_list, yearly_list = averager.average_all(
+            progressive=True
+        )
+        tools.eq_(daily_list + monthly_list + yearly_list, [])
+        tools.eq_(len(self.read_list), 0)
+
+    def test_average_all_resize(self):
+        averager = self.make_averager()
+        averager.comb_method = RESIZE
+        _, monthly_list, yearly_list = averager.average_all()
+        tools.eq_(len(self.read_list), 7)
+        # the same as the monthly and yearly averages made on their own
+        separate_averager = self.make_averager()
+        separate_averager.comb_method = RESIZE
+        separate_list = separate_averager.average_by_month() + \
+            separate_averager.average_by_year()
+        tools.eq_([fname.name for fname in monthly_list + yearly_list],
+                  [fname.name for fname in separate_list])
+        for fname, separate_fname in zip(monthly_list + yearly_list,
+                                         separate_list):
+            tools.eq_(
+                np.array_equal(io.imread(fname), io.imread(separate_fname)),
+                True
+            )
+
+    def test_average_cache(self):
+        averager = self.make_averager()
+        cache_path = Path(tempfile.mkdtemp())
+        self.output_path_list.append(cache_path)
+        year_list = [
+            item
+            for year_list in averager.fs_grouper.group_by_year().values()
+            for item in year_list
+        ]
+        image = np.zeros((10, 10, 3), dtype=np.float32)
+        for length in [2, 4, 3]:
+            cache = AverageCache(year_list[:length], cache_path,
+                                 averager.fs_grouper)
+            cache.write_cache(image, 10, 1.0, length)
+
+        # the longest cached prefix wins, whatever order it was written in
+        cache = AverageCache(year_list, cache_path, averager.fs_grouper)
+        cached_list = cache.search()
+        tools.eq_(cached_list[0]["num_images"], 4)
+        tools.eq_(cached_list[1:], year_list[4:])
+        cached_list = cache.search(prefix_lengths=[2, 3])
+        tools.eq_(cached_list[0]["num_images"], 3)
+        # a crop can't grow the cached average
+        cached_list = cache.search(comb_method=CROP, dimension=20)
+        tools.eq_(cached_list, year_list)
+        # no prefix of a different list is cached
+        cache = AverageCache(year_list[1:], cache_path, averager.fs_grouper)
+        tools.eq_(cache.search(), year_list[1:])
+
+        # over budget, the least valuable entries go until the rest fit
+        entry_bytes = next(cache_path.glob("*.npy")).stat().st_size
+        cache = AverageCache(year_list[:5], cache_path, averager.fs_grouper,
+                             max_bytes=int(2.5 * entry_bytes))
+        cache.write_cache(image, 10, 1.0, 5)
+        tools.eq_(len(cache.cache_info), 2)
+        tools.eq_(cache.cached_lengths, [4, 5])
+        tools.eq_(len(list(cache_path.glob("*.npy"))), 2)
+
+        # sums written without an entry are deleted by the next cache opened
+        AverageCache.write_sum(cache_path / "0000000000000.npy", image)
+        (cache_path / "partial.npy.tmp").write_bytes(b"partial")
+        cache = AverageCache(year_list, cache_path, averager.fs_grouper)
+        tools.eq_(sorted(path.name for path in cache_path.glob("*.npy*")),
+                  sorted(Path(cache_item["SourceFile"]).name
+                         for cache_item in cache.cache_info.values()))
+
+    def test_average_cache_fingerprints(self):
+        averager = self.make_averager()
+        cache_path = Path(tempfile.mkdtemp())
+        self.output_path_list.append(cache_path)
+        # copies of the photos under the same names in two directories
+        copy_lists = []
+        for copy_name in ["a", "b"]:
+            copy_path = cache_path / copy_name
+            copy_path.mkdir()
+            copy_list = []
+            for year_list in averager.fs_grouper.group_by_year().values():
+                for item in year_list:
+                    source_path = Path(item["SourceFile"])
+                    shutil.copy(source_path, copy_path / source_path.name)
+                    copy_item = dict(item)
+                    copy_item["SourceFile"] = \
+                        str(copy_path / source_path.name)
+                    copy_list.append(copy_item)
+            copy_lists.append(copy_list)
+        image = np.zeros((10, 10, 3), dtype=np.float32)
+        cache = AverageCache(copy_lists[0][:3], cache_path / "cache",
+                             averager.fs_grouper)
+        cache.write_cache(image, 10, 1.0, 3)
+        # prefix hashes are consistent however long the list is
+        cache = AverageCache(copy_lists[0], cache_path / "cache",
+                             averager.fs_grouper)
+        tools.eq_(cache.search()[0]["num_images"], 3)
+        # same names, different photos
+        cache = AverageCache(copy_lists[1], cache_path / "cache",
+                             averager.fs_grouper)
+        tools.eq_(cache.search(), copy_lists[1])
+        # an edited photo invalidates the entry
+        Path(copy_lists[0][1]["SourceFile"]).write_bytes(b"edited")
+        cache = AverageCache(copy_lists[0], cache_path / "cache",
+                             averager.fs_grouper)
+        tools.eq_(cache.search(), copy_lists[0])
+
+    def test_average_photos_parallel(self):
+        serial_averager = self.make_averager()
+        serial_list = serial_averager.average_by_month()
+        averager = self.make_averager()
+        # reads in worker processes can't be counted
+        del averager.manipulator._read_image
+        averager.num_workers = 2
+        cache_path = averager.output_path / "cache"
+        # the groups don't all fit in the budget, but one always runs
+        averager.memory_budget = 1
+        image_list = averager.average_by_month(cache_path)
+        tools.eq_([fname.name for fname in image_list],
+                  [fname.name for fname in serial_list])
+        # what the workers did is reported
+        tools.eq_(averager.metrics.totals["decode"]["items"], 7)
+        for fname, serial_fname in zip(image_list, serial_list):
+            tools.eq_(
+                np.array_equal(io.imread(fname), io.imread(serial_fname)),
+                True
+            )
+        # the sums written by the workers are in the cache index
+        cache = AverageCache([], cache_path, averager.fs_grouper)
+        tools.eq_(len(cache.cache_info), 2)
+        for cache_item in cache.cache_info.values():
+            tools.eq_(Path(cache_item["SourceFile"]).exists(), True)
+
+    def test_average_all_parallel(self):
+        serial_lists = self.make_averager().average_all()
+        averager = self.make_averager()
+        del averager.manipulator._read_image
+        averager.num_workers = 2
+        averager.manipulator.num_workers = 2
+        plan = averager.plan_all()
+        summary = plan.summary()
+        tools.eq_([strategy["workers"] for strategy in
+                   summary["strategies"]], [2])
+        # count the worker pools started, and the sums made and merged here
+        pools = []
+        sums = []
+        merges = []
+        executor_class = manipulator.ProcessPoolExecutor
+        allocate = accumulator.Accumulator._allocate
+        merge = accumulator.Float64Accumulator.merge
+
+        def counting_executor(*args, **kwargs):
+            pools.append(kwargs)
+            return executor_class(*args, **kwargs)
+
+        def counting_allocate(accumulator_self):
+            sums.append(accumulator_self.dimension)
+            return allocate(accumulator_self)
+
+        def counting_merge(accumulator_self, other):
+            merges.append(accumulator_self.dimension)
+            return merge(accumulator_self, other)
+        manipulator.ProcessPoolExecutor = counting_executor
+        accumulator.Accumulator._allocate = counting_allocate
+        accumulator.Float64Accumulator.merge = counting_merge
+        tracemalloc.start()
+        try:
+            fname_lists = averager.average_all(plan=plan)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            manipulator.ProcessPoolExecutor = executor_class
+            accumulator.Accumulator._allocate = allocate
+            accumulator.Float64Accumulator.merge = merge
+        # whole months are summed side by side in one pool. the days' and
+        # months' sums stay in the workers, and each month hands its share
+        # of the year's sum over once
+        tools.eq_(pools, [{"max_workers": 2}])
+        year_dimension = plan.years[0].dimension
+        tools.eq_(sums, [year_dimension])
+        tools.eq_(merges, [year_dimension] * 2)
+        # so this process never holds more than the plan allows for
+        tools.eq_(peak_memory <= summary["peak_memory"], True)
+        tools.eq_(averager.metrics.totals["decode"]["items"], 7)
+        for fname_list, serial_list in zip(fname_lists, serial_lists):
+            tools.eq_([fname.name for fname in fname_list],
+                      [fname.name for fname in serial_list])
+            for fname, serial_fname in zip(fname_list, serial_list):
+                tools.eq_(
+                    np.array_equal(io.imread(fname), io.imread(serial_fname)),
+                    True
+                )
+
+    def test_plan_all(self):
+        averager = self.make_averager()
+        plan = averager.plan_all(progressive=True)
+        summary = plan.summary()
+        tools.eq_(summary["written"], 7)
+        tools.eq_(summary["decodes"], 7)
+        # each photo would be read 26 times for separate averages
+        tools.eq_(summary["shared_decodes"], 19)
+        tools.eq_(summary["cache_hits"], [])
+        tools.eq_(summary["peak_memory"] > 0, True)
+        # planning reads and writes nothing
+        tools.eq_(len(self.read_list), 0)
+        tools.eq_(list(averager.output_path.iterdir()), [])
+        # the plan is what gets done
+        daily_list, monthly_list, yearly_list = averager.average_all(
+            plan=plan
+        )
+        written = [output["path"] for output in summary["outputs"]
+                   if output["action"] == "write"]
+        tools.eq_(sorted(written),
+                  sorted(str(fname) for fname in
+                         daily_list + monthly_list + yearly_list))
+        tools.eq_(len(self.read_list), 7)
+
+    def test_dry_plan(self):
+        run_path = Path(tempfile.mkdtemp())
+        self.output_path_list.append(run_path)
+        month_cache = run_path / "months"
+        year_cache = run_path / "years"
+
+        def make_run_averager(read_only):
+            return Averager(
+                Path('photomanip/tests/'),
+                run_path / "output",
+                ConstructMetadata("test author", "all rights reserved"),
+                grouping_tag='faceit365:date=',
+                comb_method=CROP,
+                prepared_cache_dir=run_path / "prepared",
+                metadata_index_file=run_path / "index" / "metadata.sqlite",
+                read_only=read_only
+            )
+
+        def snapshot():
+            return {
+                path: (path.stat().st_size, path.stat().st_mtime_ns)
+                for path in run_path.rglob("*")
+            }
+        # a dry run before anything exists makes nothing
+        summary = make_run_averager(True).plan_all(
+            month_cache,
+            year_cache
+        ).summary()
+        tools.eq_(summary["written"], 5)
+        tools.eq_(list(run_path.iterdir()), [])
+        # nor does one with caches and an index, one of them from an older
+        # version and with a sum it never indexed
+        make_run_averager(False).average_all(month_cache, year_cache)
+        cache_file = month_cache / AverageCache.CACHE_NAME
+        with open(cache_file) as json_fp:
+            cache_json = json.load(json_fp)
+        cache_json["version"] -= 1
+        with open(cache_file, "w") as json_fp:
+            json.dump(cache_json, json_fp)
+        (year_cache / "0000000000000.npy").write_bytes(b"unindexed")
+        before = snapshot()
+        averager = make_run_averager(True)
+        summary = averager.plan_all(month_cache, year_cache).summary()
+        tools.eq_(snapshot(), before)
+        tools.eq_(summary["written"], 0)
+        tools.eq_(averager.fs_grouper.metadata_index.hits, 7)
+
+    def test_memory_budget(self):
+        averager = self.make_averager()
+        summary = averager.plan_all().summary()
+        tools.eq_([strategy["accumulator"]
+                   for strategy in summary["strategies"]],
+                  ["float64"])
+        # the photos are cropped, so a uint32 sum is tried before going to
+        # disk
+        strategies = averager.manipulator.strategies(CROP)
+        tools.eq_([accumulator_type for accumulator_type, _ in strategies],
+                  ["float64", "uint32", "memmap"])
+        tools.eq_(averager.manipulator.strategies(RESIZE)[1][0], "uint32")
+        averager.manipulator.resampler = SKIResampler()
+        tools.eq_(averager.manipulator.strategies(RESIZE)[1][0], "memmap")
+        averager.manipulator.resampler = PillowResampler()
+        # float64 doesn't fit, so the biggest sum becomes uint32 and the
+        # rest stay as they are
+        uint32_averager = self.make_averager()
+        uint32_averager.memory_budget = \
+            summary["strategies"][0]["memory"] - 1
+        summary = uint32_averager.plan_all().summary()
+        tools.eq_(summary["strategies"][0]["fits"], True)
+        accumulators = [group["accumulator"] for group in summary["groups"]
+                        if group["accumulator"]]
+        tools.eq_(accumulators.count("uint32"), 1)
+        tools.eq_(accumulators.count("float64"), len(accumulators) - 1)
+        # nothing fits, so every sum takes the leanest type in a single
+        # process. a memory mapped sum is no leaner than uint32 for sums
+        # this small
+        low_averager = self.make_averager()
+        low_averager.memory_budget = 1
+        summary = low_averager.plan_all().summary()
+        for strategy in summary["strategies"]:
+            tools.eq_(strategy["workers"], 1)
+            tools.eq_(strategy["fits"], False)
+        tools.eq_({group["accumulator"] for group in summary["groups"]},
+                  {"uint32", None})
+        # and the averages are the same
+        fname_lists = averager.average_all()
+        for other_averager in [uint32_averager, low_averager]:
+            other_fname_lists = other_averager.average_all()
+            for fname_list, other_fname_list in zip(fname_lists,
+                                                    other_fname_lists):
+                tools.eq_(len(fname_list), len(other_fname_list))
+                for fname, other_fname in zip(fname_list, other_fname_list):
+                    tools.eq_(fname.name, other_fname.name)
+                    tools.eq_(
+                        np.array_equal(io.imread(fname),
+                                       io.imread(other_fname)),
+                        True
+                    )
+
+    def test_sum_types_per_period(self):
+        averager = self.make_averager()
+        averager.comb_method = PAD
+        memory = averager.plan_all().summary()["strategies"][0]["memory"]
+        # padded, the year's sum is the biggest, so it's made leaner first
+        # and the days' sums stay float64
+        averager.memory_budget = memory - 1
+        summary = averager.plan_all().summary()
+        tools.eq_(summary["strategies"][0]["fits"], True)
+        accumulators = {(group["kind"], group["accumulator"])
+                        for group in summary["groups"]
+                        if group["accumulator"]}
+        tools.eq_(accumulators,
+                  {("yearly", "uint32"), ("monthly", "float64"),
+                   ("daily", "float64")})
+        daily_list, monthly_list, yearly_list = averager.average_all()
+        tools.eq_(len(yearly_list), 1)
+
+    def test_manifest(self):
+        photo_path = Path(tempfile.mkdtemp())
+        self.output_path_list.append(photo_path)
+        shutil.copytree(
+            Path('photomanip/tests/'),
+            photo_path / "photos",
+            ignore=shutil.ignore_patterns("*.py", "__pycache__")
+        )
+        output_path = photo_path / "output"
+        output_path.mkdir()
+
+        def make_averager(use_manifest=True):
+            return Averager(
+                photo_path / "photos",
+                output_path,
+                ConstructMetadata("test author", "all rights reserved"),
+                grouping_tag='faceit365:date=',
+                comb_method=CROP,
+                use_manifest=use_manifest
+            )
+        averager = make_averager()
+        averager.average_all(progressive=True)
+        # a photo of the last day is edited
+        edited = photo_path / "photos" / "test_photo_0.jpg"
+        stat = edited.stat()
+        os.utime(edited, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        # without the manifest the old averages look done
+        daily_list, monthly_list, yearly_list = \
+            make_averager(use_manifest=False).average_all(progressive=True)
+        tools.eq_(daily_list + monthly_list + yearly_list, [])
+        # only the averages with the edited photo are made again
+        plan = make_averager().plan_all(progressive=True)
+        tools.eq_(plan.summary()["written"], 3)
+        daily_list, monthly_list, yearly_list = \
+            make_averager().average_all(progressive=True)
+        tools.eq_([fname.name for fname in daily_list], ["20190308.jpg"])
+        tools.eq_(len(monthly_list), 1)
+        tools.eq_(len(yearly_list), 1)
+        tools.eq_(yearly_list[0].name.endswith("_03-08.jpg"), True)
+        # and are up to date again
+        daily_list, monthly_list, yearly_list = \
+            make_averager().average_all(progressive=True)
+        tools.eq_(daily_list + monthly_list + yearly_list, [])
+
+    def test_superseded(self):
+        photo_path = Path(tempfile.mkdtemp())
+        self.output_path_list.append(photo_path)
+        shutil.copytree(
+            Path('photomanip/tests/'),
+            photo_path / "photos",
+            ignore=shutil.ignore_patterns("*.py", "__pycache__")
+        )
+        # the photos of the last day are added later
+        later_path = photo_path / "later"
+        later_path.mkdir()
+        for index in range(3):
+            fname = f"test_photo_{index}.jpg"
+            shutil.move(str(photo_path / "photos" / fname),
+                        str(later_path / fname))
+        output_path = photo_path / "output"
+        output_path.mkdir()
+
+        def make_averager():
+            return Averager(
+                photo_path / "photos",
+                output_path,
+                ConstructMetadata("test author", "all rights reserved"),
+                grouping_tag='faceit365:date=',
+                comb_method=CROP
+            )
+        _, _, yearly_list = make_averager().average_all()
+        tools.eq_([fname.name for fname in yearly_list],
+                  ["2019_02-18_03-06.jpg"])
+        old_yearly = yearly_list[0]
+        for fname in later_path.iterdir():
+            shutil.move(str(fname), str(photo_path / "photos" / fname.name))
+        # the plan says which averages are replaced
+        summary = make_averager().plan_all().summary()
+        replaces = [output for output in summary["outputs"]
+                    if "replaces" in output]
+        tools.eq_(len(replaces), 1)
+        tools.eq_(replaces[0]["kind"], "yearly")
+        tools.eq_(replaces[0]["replaces"], [str(old_yearly)])
+        averager = make_averager()
+        _, _, yearly_list = averager.average_all()
+        tools.eq_([fname.name for fname in yearly_list],
+                  ["2019_02-18_03-08.jpg"])
+        # the old yearly average and its entry are gone
+        tools.eq_(old_yearly.exists(), False)
+        tools.eq_(sorted(averager.manifest.entries),
+                  sorted(str(fname.relative_to(output_path))
+                         for fname in output_path.rglob("*.jpg")))
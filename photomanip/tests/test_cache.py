@@ -0,0 +1,87 @@
+import os
+import pickle
+import shutil
+import tempfile
+
+from pathlib import Path
+
+import numpy as np
+
+from nose import tools
+
+from photomanip import CROP, PAD
+from photomanip.cache import PreparedImageCache
+
+ORIGINAL_PHOTO_FILENAME = 'photomanip/tests/test_photo_0.jpg'
+
+
+class TestPreparedImageCache:
+    @classmethod
+    def setup_class(cls):
+        cls.cache_path = Path(tempfile.mkdtemp())
+        cls.photo_path = cls.cache_path / 'photo.jpg'
+        shutil.copyfile(ORIGINAL_PHOTO_FILENAME, cls.photo_path)
+        cls.image = np.arange(300, dtype=np.uint8).reshape((10, 10, 3))
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.cache_path)
+
+    def test_get_put(self):
+        prepared_cache = PreparedImageCache(self.cache_path / 'get_put')
+        tools.eq_(prepared_cache.get(self.photo_path, CROP, 10), None)
+        prepared_cache.put(self.photo_path, CROP, 10, self.image)
+        result = prepared_cache.get(self.photo_path, CROP, 10)
+        tools.eq_(isinstance(result, np.memmap), True)
+        tools.eq_(np.array_equal(result, self.image), True)
+        # other methods and dimensions are different entries
+        tools.eq_(prepared_cache.get(self.photo_path, PAD, 10), None)
+        tools.eq_(prepared_cache.get(self.photo_path, CROP, 12), None)
+        tools.eq_(prepared_cache.hits, 1)
+        tools.eq_(prepared_cache.misses, 3)
+
+        # changing the file invalidates the entry
+        file_stat = self.photo_path.stat()
+        os.utime(self.photo_path, ns=(file_stat.st_atime_ns,
+                                      file_stat.st_mtime_ns + 10 ** 9))
+        tools.eq_(prepared_cache.get(self.photo_path, CROP, 10), None)
+
+    def test_eviction(self):
+        entry_bytes = self.image.nbytes + 128
+        prepared_cache = PreparedImageCache(
+            self.cache_path / 'eviction',
+            max_bytes=int(3.5 * entry_bytes)
+        )
+        for dimension in range(3):
+            prepared_cache.put(self.photo_path, CROP, dimension, self.image)
+            # make sure the entries have distinct ages
+            entry_path = prepared_cache._entry_path(
+                self.photo_path, CROP, dimension, "")
+            os.utime(entry_path, ns=(dimension * 10 ** 9,
+                                     dimension * 10 ** 9))
+        # a fourth entry pushes out the oldest one
+        prepared_cache.put(self.photo_path, CROP, 3, self.image)
+        tools.eq_(prepared_cache.get(self.photo_path, CROP, 0), None)
+        for dimension in range(1, 4):
+            result = prepared_cache.get(self.photo_path, CROP, dimension)
+            tools.eq_(result is None, False)
+        tools.eq_(prepared_cache.total_bytes <= prepared_cache.max_bytes,
+                  True)
+
+    def test_counts(self):
+        prepared_cache = PreparedImageCache(self.cache_path / 'counts')
+        prepared_cache.put(self.photo_path, CROP, 10, self.image)
+        entry_bytes = prepared_cache.total_bytes
+        # writing an entry over doesn't count it twice
+        prepared_cache.put(self.photo_path, CROP, 10, self.image)
+        tools.eq_(prepared_cache.total_bytes, entry_bytes)
+        # a copy in a worker process counts from zero and is merged back
+        worker_cache = pickle.loads(pickle.dumps(prepared_cache))
+        worker_cache.reset_counts()
+        worker_cache.get(self.photo_path, CROP, 10)
+        worker_cache.get(self.photo_path, CROP, 12)
+        worker_cache.put(self.photo_path, CROP, 12, self.image)
+        prepared_cache.merge(pickle.loads(pickle.dumps(worker_cache)))
+        tools.eq_(prepared_cache.hits, 1)
+        tools.eq_(prepared_cache.misses, 1)
+        tools.eq_(prepared_cache.total_bytes, 2 * entry_bytes)
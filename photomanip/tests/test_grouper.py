@@ -1,7 +1,16 @@
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+
+from contextlib import closing
+from pathlib import Path
+
 from nose import tools
 
-from photomanip import PAD, CROP
-from photomanip.grouper import FileSystemGrouper
+from photomanip import PAD, CROP, RESIZE
+from photomanip.grouper import FileSystemGrouper, PrefixView
 
 
 class TestFileSystemGrouper:
@@ -64,6 +73,52 @@ class TestFileSystemGrouper:
         tools.eq_(len(result_list), 1)
         tools.eq_(len(result_list[0]), 7)
 
+    def test_lazy_grouper(self):
+        fs_grouper = FileSystemGrouper(
+            'photomanip/tests/',
+            'faceit365:date=',
+            lazy=True
+        )
+        # nothing is scanned or read until the photos are needed
+        tools.eq_(fs_grouper.metrics.totals, {})
+        day_list = list(fs_grouper.iter_by_day())
+        tools.eq_("scan" in fs_grouper.metrics.totals, True)
+        # the generators give the same groups, in date order
+        for groups, grouped in [
+            (day_list, self.fs_grouper_tag.group_by_day()),
+            (fs_grouper.iter_by_month(),
+             self.fs_grouper_tag.group_by_month()),
+            (fs_grouper.iter_by_year(), self.fs_grouper_tag.group_by_year()),
+        ]:
+            groups = list(groups)
+            tools.eq_(groups, list(grouped.items()))
+            tools.eq_([key for key, _ in groups],
+                      sorted(key for key, _ in groups))
+
+    def test_progressive_grouper(self):
+        sorted_metadata = self.fs_grouper_tag.sorted_metadata
+        for views, grouped, lengths in [
+            (self.fs_grouper_tag.progressive_by_month(),
+             self.fs_grouper_tag.group_by_month_progressive(),
+             [1, 3, 1, 4]),
+            (self.fs_grouper_tag.progressive_by_year(),
+             self.fs_grouper_tag.group_by_year_progressive(),
+             [1, 3, 4, 7]),
+        ]:
+            tools.eq_([len(view) for view in views.values()], lengths)
+            tools.eq_(list(views), list(grouped))
+            shared = next(iter(views.values())).metadata
+            tools.eq_(shared, sorted_metadata)
+            for day, view in views.items():
+                # every view is a prefix of its period in one shared list
+                tools.eq_(view.metadata is shared, True)
+                tools.eq_(view, sorted_metadata[view.start:view.stop])
+                tools.eq_(view, grouped[day])
+                tools.eq_(view[-1], grouped[day][-1])
+                tools.eq_(view[1:], grouped[day][1:])
+        view = PrefixView(sorted_metadata, None, 1, 3)
+        tools.eq_(pickle.loads(pickle.dumps(view)), sorted_metadata[1:3])
+
     def test_get_common_dimension(self):
         # test starting with an instance grouped by tag
         day_grouped = self.fs_grouper_tag.group_by_day()
@@ -92,3 +147,76 @@ class TestFileSystemGrouper:
         for index, (_, meta_list) in enumerate(day_grouped.items()):
             dim = self.fs_grouper.get_common_dimension(CROP, meta_list)
             tools.eq_(dim, dim_list[index])
+
+        # test resize, with and without a maximum dimension
+        for _, meta_list in day_grouped.items():
+            dim = self.fs_grouper.get_common_dimension(RESIZE, meta_list)
+            tools.eq_(dim, 200)
+            dim = self.fs_grouper.get_common_dimension(
+                RESIZE,
+                meta_list,
+                max_dimension=101
+            )
+            tools.eq_(dim, 100)
+
+    def test_metadata_index(self):
+        photo_path = Path(tempfile.mkdtemp())
+        try:
+            shutil.copytree(
+                Path('photomanip/tests/'),
+                photo_path / "photos",
+                ignore=shutil.ignore_patterns("*.py", "__pycache__")
+            )
+            index_file = photo_path / "index" / "metadata.sqlite"
+
+            def make_grouper(read_only=False):
+                return FileSystemGrouper(
+                    photo_path / "photos",
+                    'faceit365:date=',
+                    index_file=index_file,
+                    read_only=read_only
+                )
+            # a read only index isn't created
+            fs_grouper = make_grouper(read_only=True)
+            tools.eq_(len(fs_grouper.photo_list) > 0, True)
+            tools.eq_(index_file.parent.exists(), False)
+            fs_grouper = make_grouper()
+            num_photos = len(fs_grouper.photo_list)
+            tools.eq_(fs_grouper.metadata_index.misses, num_photos)
+            # the groups are the same as without the index
+            tools.eq_(
+                [len(meta) for meta in fs_grouper.group_by_day().values()],
+                [1, 2, 1, 3]
+            )
+            # nothing is read again
+            fs_grouper = make_grouper()
+            tools.eq_(fs_grouper.metadata_index.hits, num_photos)
+            tools.eq_(fs_grouper.metadata_index.misses, 0)
+            tools.eq_(
+                [len(meta) for meta in fs_grouper.group_by_day().values()],
+                [1, 2, 1, 3]
+            )
+            tools.eq_(fs_grouper.metrics.totals["index_read"]["items"],
+                      num_photos)
+            tools.eq_("exif_read" in fs_grouper.metrics.totals, False)
+            # a changed photo is read again and a removed one dropped
+            edited = photo_path / "photos" / "test_photo_0.jpg"
+            stat = edited.stat()
+            os.utime(edited,
+                     ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            (photo_path / "photos" / "test_photo_1.jpg").unlink()
+            # and isn't changed
+            index_bytes = index_file.read_bytes()
+            fs_grouper = make_grouper(read_only=True)
+            tools.eq_(fs_grouper.metadata_index.misses, 1)
+            tools.eq_(index_file.read_bytes(), index_bytes)
+            fs_grouper = make_grouper()
+            tools.eq_(fs_grouper.metadata_index.misses, 1)
+            tools.eq_(fs_grouper.metadata_index.hits, num_photos - 2)
+            with closing(sqlite3.connect(str(index_file))) as connection:
+                count = connection.execute(
+                    "SELECT COUNT(*) FROM photos"
+                ).fetchone()[0]
+            tools.eq_(count, num_photos - 1)
+        finally:
+            shutil.rmtree(photo_path)
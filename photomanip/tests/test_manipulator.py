@@ -1,12 +1,16 @@
 import os
+import tempfile
 
 from pathlib import Path
 
 import numpy as np
 
 from nose import tools
+from skimage import exposure
 
-from photomanip import PAD, CROP
+from photomanip import (
+    PAD, CROP, RESIZE, FLOAT32, PILLOW, SKIMAGE, MEMMAP
+)
 from photomanip.grouper import FileSystemGrouper
 from photomanip.manipulator import ImageManipulatorSKI
 
@@ -22,11 +26,13 @@ class TestIMKSI:
         cls.bw_test_image_1 = np.ones((111, 131), dtype=np.bool)
         cls.ski_pad_fname = Path('photomanip/tests/year_pad_ski.jpeg')
         cls.ski_crop_fname = Path('photomanip/tests/year_crop_ski.jpeg')
+        cls.ski_memmap_fname = Path('photomanip/tests/year_memmap_ski.jpeg')
 
     @classmethod
     def teardown_class(cls):
         os.unlink(cls.ski_pad_fname)
         os.unlink(cls.ski_crop_fname)
+        os.unlink(cls.ski_memmap_fname)
 
     def test_even_image(self):
         # color image
@@ -123,3 +129,234 @@ class TestIMKSI:
         )
         image_result = self.im_ski._read_image(str(self.ski_crop_fname))
         tools.eq_(image_result.shape, (132, 132, 3))
+
+    def test_accumulate_images_parallel(self):
+        meta_list = list(self.fs_grouper.group_by_year().values())[0]
+        comb_method = CROP
+        common_dimension = self.fs_grouper.get_common_dimension(
+            comb_method,
+            meta_list
+        )
+        serial_result = self.im_ski._accumulate_images(
+            meta_list,
+            common_dimension,
+            len(meta_list),
+            comb_method
+        )
+        im_ski_parallel = ImageManipulatorSKI(num_workers=3)
+        parallel_result = im_ski_parallel._accumulate_images_parallel(
+            meta_list,
+            common_dimension,
+            len(meta_list),
+            comb_method
+        )
+        tools.eq_(
+            np.allclose(serial_result.total(), parallel_result.total()),
+            True
+        )
+
+    def test_read_image_reduced(self):
+        fname = 'photomanip/tests/test_photo_0.jpg'
+        full_image = self.im_ski._read_image(fname)
+        tools.eq_(full_image.shape, (133, 200, 3))
+
+        # half scale still covers 60 pixels
+        reduced_image = self.im_ski._read_image(fname, 60)
+        tools.eq_(reduced_image.shape, (67, 100, 3))
+
+        # no reduction is possible without going under 100 pixels
+        reduced_image = self.im_ski._read_image(fname, 100)
+        tools.eq_(reduced_image.shape, (133, 200, 3))
+
+    def test_resize_image_resamplers(self):
+        image = self.im_ski._even_image(
+            self.im_ski._read_image('photomanip/tests/test_photo_0.jpg')
+        )
+        skimage_image = ImageManipulatorSKI(
+            resampler=SKIMAGE
+        )._resize_image(image, 100)
+        tools.eq_(skimage_image.shape, (100, 100, 3))
+        pillow_image = ImageManipulatorSKI(
+            resampler=PILLOW
+        )._resize_image(image, 100)
+        tools.eq_(pillow_image.shape, (100, 100, 3))
+        tools.eq_(pillow_image.dtype, np.uint8)
+        # the backends should agree to within a few grey levels on average
+        mean_error = np.mean(np.abs(pillow_image - skimage_image))
+        tools.eq_(mean_error < 5, True)
+
+    @tools.raises(ValueError)
+    def test_invalid_resampler(self):
+        ImageManipulatorSKI(resampler='nearest')
+
+    def test_combine_images_memmap(self):
+        meta_list = list(self.fs_grouper.group_by_year().values())[0]
+        comb_method = PAD
+        common_dimension = self.fs_grouper.get_common_dimension(
+            comb_method,
+            meta_list
+        )
+        im_ski_memmap = ImageManipulatorSKI(accumulator_type=MEMMAP)
+        memmap_result = im_ski_memmap.combine_images(
+            meta_list,
+            common_dimension,
+            len(meta_list),
+            self.ski_memmap_fname,
+            comb_method
+        )
+        tools.eq_(isinstance(memmap_result, np.memmap), True)
+        float_result = self.im_ski.accumulate_images(
+            meta_list,
+            common_dimension,
+            len(meta_list),
+            comb_method
+        ).mean(len(meta_list))
+        tools.eq_(np.allclose(memmap_result, float_result), True)
+        image_result = self.im_ski._read_image(str(self.ski_memmap_fname))
+        tools.eq_(image_result.shape, (200, 200, 3))
+
+    def test_histogram_percentiles(self):
+        random_state = np.random.RandomState(365)
+        image = random_state.uniform(0, 255, (300, 300, 3))
+        image[:50] = 255
+        expected = np.percentile(image[image != 255], (0.5, 99.5))
+        result = self.im_ski._histogram_percentiles(image, (0.5, 99.5), 70)
+        tools.eq_(np.allclose(result, expected, atol=0.01), True)
+
+    def test_stretch_strips(self):
+        random_state = np.random.RandomState(365)
+        image = random_state.uniform(0, 255, (30, 20, 3))
+        image[:5] = 255
+        data_mask = image != 255
+        # exact bounds match the percentiles of the pixels that aren't 255
+        im_ski_exact = ImageManipulatorSKI(exact_stretch=True)
+        bounds = im_ski_exact.contrast_bounds(image)
+        expected_bounds = np.percentile(image[data_mask], (0.5, 99.5))
+        tools.eq_(np.allclose(bounds, expected_bounds), True)
+        # stretching in strips matches stretching the whole image
+        expected = np.full(image.shape, 255, dtype=np.uint8)
+        expected[data_mask] = exposure.rescale_intensity(
+            image[data_mask],
+            in_range=tuple(expected_bounds),
+            out_range='uint8'
+        )
+        result = np.empty(image.shape, dtype=np.uint8)
+        im_ski_exact._stretch_strips(image, result, *bounds, strip_rows=7)
+        tools.eq_(np.array_equal(result, expected), True)
+
+    def test_merge_accumulator(self):
+        meta_list = list(self.fs_grouper.group_by_year().values())[0]
+        for comb_method in [PAD, CROP]:
+            common_dimension = self.fs_grouper.get_common_dimension(
+                comb_method,
+                meta_list
+            )
+            expected = self.im_ski.accumulate_images(
+                meta_list,
+                common_dimension,
+                len(meta_list),
+                comb_method
+            )
+            # sum the first three images at their own dimension, then merge
+            partial_dimension = self.fs_grouper.get_common_dimension(
+                comb_method,
+                meta_list[:3]
+            )
+            partial = self.im_ski.accumulate_images(
+                meta_list[:3],
+                partial_dimension,
+                3,
+                comb_method
+            )
+            result = self.im_ski.accumulate_images(
+                meta_list[3:],
+                common_dimension,
+                len(meta_list),
+                comb_method
+            )
+            self.im_ski.merge_accumulator(result, partial, 3, comb_method)
+            tools.eq_(np.allclose(result.total(), expected.total()), True)
+
+    def test_accumulate_images_multi(self):
+        year_list = list(self.fs_grouper.group_by_year().values())[0]
+        # the first days of a year, summed at their own dimension and the
+        # year's
+        meta_list = year_list[:3]
+        for comb_method in [PAD, CROP, RESIZE]:
+            dimensions = [
+                self.fs_grouper.get_common_dimension(comb_method, meta_list),
+                self.fs_grouper.get_common_dimension(comb_method, year_list),
+            ]
+            im_ski = ImageManipulatorSKI()
+            read_list = []
+            read_image = im_ski._read_image
+
+            def counting_read_image(filename, *args, **kwargs):
+                read_list.append(filename)
+                return read_image(filename, *args, **kwargs)
+            im_ski._read_image = counting_read_image
+            accumulators = im_ski.accumulate_images_multi(
+                meta_list,
+                [im_ski.new_accumulator(dimension)
+                 for dimension in dimensions],
+                len(meta_list),
+                comb_method
+            )
+            # one read per image, whatever the number of dimensions
+            tools.eq_(len(read_list), len(meta_list))
+            for accumulator, dimension in zip(accumulators, dimensions):
+                expected = self.im_ski.accumulate_images(
+                    meta_list,
+                    dimension,
+                    len(meta_list),
+                    comb_method
+                )
+                tools.eq_(np.allclose(accumulator.total(), expected.total()),
+                          True)
+
+    def test_load_cached_sum(self):
+        meta_list = list(self.fs_grouper.group_by_year().values())[0]
+        common_dimension = self.fs_grouper.get_common_dimension(
+            CROP,
+            meta_list
+        )
+        expected = self.im_ski.accumulate_images(
+            meta_list,
+            common_dimension,
+            len(meta_list),
+            CROP
+        )
+        partial = self.im_ski.accumulate_images(
+            meta_list[:3],
+            common_dimension,
+            3,
+            CROP
+        )
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cached_item = {
+                "SourceFile": str(Path(cache_dir) / "sum.npy"),
+                "num_images": 3,
+                "cached": True,
+            }
+            np.save(cached_item["SourceFile"],
+                    partial.total().astype(np.float32))
+            im_ski_float32 = ImageManipulatorSKI(accumulator_type=FLOAT32)
+            for manipulator in [self.im_ski, im_ski_float32]:
+                result = manipulator.accumulate_images(
+                    [cached_item] + meta_list[3:],
+                    common_dimension,
+                    len(meta_list),
+                    CROP
+                )
+                tools.eq_(np.allclose(result.total(), expected.total()),
+                          True)
+            # a float32 sum reads the stored sum straight into its float64
+            # sum on disk
+            result = im_ski_float32.load_cached_sum(
+                cached_item,
+                common_dimension,
+                CROP
+            )
+            tools.eq_(result.pending, 0)
+            tools.eq_(isinstance(result.total(), np.memmap), True)
+            tools.eq_(np.allclose(result.total(), partial.total()), True)
@@ -2,7 +2,17 @@ import os
 
 from shutil import copyfile
 
-from photomanip.metadata import ImageExif, SetExifTool
+import numpy as np
+from PIL import Image, IptcImagePlugin
+
+from photomanip.metadata import (
+    ERROR_KEY,
+    EXIF_IFD,
+    HeaderError,
+    ImageExif,
+    SetExifTool,
+    read_jpeg_header
+)
 
 from nose import tools
 
@@ -11,6 +21,7 @@ TEST_IMAGE_FILENAME = 'photomanip/tests/image_exif_test.jpg'
 ORIGINAL_PHOTO_FILENAME = 'photomanip/tests/test_photo_0.jpg'
 TEST_PHOTO_01_FILENAME = 'photomanip/tests/image_exposure_test_01.jpg'
 TEST_PHOTO_02_FILENAME = 'photomanip/tests/image_exposure_test_02.jpg'
+TEST_EMBED_FILENAME = 'photomanip/tests/image_embed_test.jpg'
 
 
 class TestImageExif:
@@ -26,6 +37,8 @@ class TestImageExif:
         os.remove(TEST_IMAGE_FILENAME)
         os.remove(TEST_PHOTO_01_FILENAME)
         os.remove(TEST_PHOTO_02_FILENAME)
+        if os.path.exists(TEST_EMBED_FILENAME):
+            os.remove(TEST_EMBED_FILENAME)
 
     def get_stored_tags(self, tag_list, filename):
         with SetExifTool() as et:
@@ -86,3 +99,82 @@ class TestImageExif:
         meta_list[0].pop('SourceFile')
         meta_list[1].pop('SourceFile')
         tools.eq_(meta_list[0], meta_list[1])
+
+    def test_get_metadata_batch_workers(self):
+        fname_list = [
+            TEST_PHOTO_01_FILENAME,
+            'photomanip/tests/no_such_photo.jpg',
+            TEST_PHOTO_02_FILENAME,
+            ORIGINAL_IMAGE_FILENAME,
+        ]
+        meta_list = self.image_exif.get_metadata_batch(
+            fname_list,
+            num_workers=2,
+            chunk_size=1
+        )
+        # in order, with the missing file reported on its own
+        tools.eq_([meta["SourceFile"] for meta in meta_list], fname_list)
+        tools.eq_(ERROR_KEY in meta_list[1], True)
+        tools.eq_(ERROR_KEY in meta_list[0], False)
+        meta_list[0].pop('SourceFile')
+        meta_list[2].pop('SourceFile')
+        tools.eq_(meta_list[0], meta_list[2])
+
+    def test_read_jpeg_header(self):
+        metadata = read_jpeg_header(ORIGINAL_PHOTO_FILENAME)
+        tools.eq_(metadata["SourceFile"], ORIGINAL_PHOTO_FILENAME)
+        tools.eq_(metadata["File:ImageWidth"], 200)
+        tools.eq_(metadata["File:ImageHeight"], 133)
+        tools.eq_(metadata["EXIF:ExposureTime"], 0.001333333333)
+        tools.eq_(metadata["EXIF:DateTimeOriginal"], "2019:03:08 16:23:27")
+        tools.eq_(
+            self.image_exif.get_tags_containing(metadata["IPTC:Keywords"],
+                                                "faceit365"),
+            "faceit365:date=20190308"
+        )
+        # numbers are numbers, like in exiftool's json
+        tools.eq_(2019 in metadata["IPTC:Keywords"], True)
+        # tags that aren't there are left out
+        metadata = read_jpeg_header(ORIGINAL_IMAGE_FILENAME)
+        tools.eq_(set(metadata),
+                  {"SourceFile", "File:ImageWidth", "File:ImageHeight"})
+        # anything else is for exiftool
+        tools.assert_raises(HeaderError, read_jpeg_header,
+                            'photomanip/tests/test_metadata.py')
+
+    def test_read_jpeg_header_matches_exiftool(self):
+        fname_list = [ORIGINAL_IMAGE_FILENAME, ORIGINAL_PHOTO_FILENAME,
+                      'photomanip/tests/another_image/test_photo_6.jpg']
+        exiftool_reader = ImageExif(read_headers=False)
+        meta_list = exiftool_reader.get_metadata_batch(fname_list)
+        for fname, meta in zip(fname_list, meta_list):
+            tools.eq_(read_jpeg_header(fname), meta)
+
+    def test_jpeg_metadata(self):
+        output_meta = {
+            "name": "Terd Ferguson",
+            "keywords": ["one", "two", "thr\u00e9e"],
+            "caption": "suck it, trebeck\r" + "x" * 3000,
+            "software": "photomanip",
+            "date_created": "2019:03:08 12:00:00",
+            "artist": "andrew catellier",
+            "copyright_iptc": "all rights reserved",
+        }
+        jpeg_metadata = self.image_exif.jpeg_metadata(output_meta)
+        image = np.zeros((16, 16, 3), dtype=np.uint8)
+        Image.fromarray(image).save(TEST_EMBED_FILENAME, 'JPEG',
+                                    **jpeg_metadata)
+        with Image.open(TEST_EMBED_FILENAME) as stored_image:
+            exif = stored_image.getexif()
+            iptc = IptcImagePlugin.getiptcinfo(stored_image)
+        tools.eq_(exif[0x0131], "photomanip")
+        tools.eq_(exif[0x013B], "andrew catellier")
+        tools.eq_(exif.get_ifd(EXIF_IFD)[0x9003], "2019:03:08 12:00:00")
+        tools.eq_(iptc[(2, 5)], b"Terd Ferguson")
+        tools.eq_([keyword.decode("utf-8") for keyword in iptc[(2, 25)]],
+                  output_meta["keywords"])
+        tools.eq_(iptc[(2, 116)], b"all rights reserved")
+        # values are cut to the IPTC length limits, as exiftool does
+        tools.eq_(len(iptc[(2, 120)]), 2000)
+        # tags without an in-process writer are left to exiftool
+        tools.eq_(self.image_exif.jpeg_metadata({"exposure_time": 1}), None)
@@ -0,0 +1,70 @@
+import json
+import pickle
+import tempfile
+
+from pathlib import Path
+
+from nose import tools
+
+from photomanip.metrics import DECODE, PREPARE, RunMetrics
+
+
+class TestRunMetrics:
+    def test_stages_and_groups(self):
+        metrics = RunMetrics()
+        calls = []
+        metrics.add_hook(lambda *args: calls.append(args))
+        with metrics.stage(DECODE, 100):
+            pass
+        with metrics.group("20190308.jpg"):
+            with metrics.stage(DECODE) as counts:
+                counts["bytes"] = 50
+                counts["items"] = 2
+            metrics.record(PREPARE, 0.5, 10)
+        report = metrics.report()
+        tools.eq_(list(report["stages"]), [DECODE, PREPARE])
+        tools.eq_(report["stages"][DECODE]["bytes"], 150)
+        tools.eq_(report["stages"][DECODE]["items"], 3)
+        tools.eq_(report["stages"][PREPARE]["items_per_second"], 2.0)
+        tools.eq_(report["stages"][PREPARE]["bytes_per_second"], 20.0)
+        # only what happened in the group is counted for it
+        group = report["groups"][0]
+        tools.eq_(group["name"], "20190308.jpg")
+        tools.eq_(group["stages"][DECODE]["bytes"], 50)
+        tools.eq_(group["elapsed"] >= 0, True)
+        tools.eq_([call[0] for call in calls], [DECODE, DECODE, PREPARE])
+        tools.eq_([call[4] for call in calls],
+                  [None, "20190308.jpg", "20190308.jpg"])
+
+    def test_merge(self):
+        metrics = RunMetrics()
+        metrics.record(DECODE, 1.0, 100)
+        metrics.add_hook(lambda *args: None)
+        # a worker records into its own instance, which comes back pickled
+        worker_metrics = RunMetrics()
+        worker_metrics.add_hook(lambda *args: None)
+        worker_metrics.record(DECODE, 2.0, 200)
+        worker_metrics = pickle.loads(pickle.dumps(worker_metrics))
+        tools.eq_(worker_metrics.hooks, [])
+        metrics.merge(worker_metrics, group="2019.jpg")
+        report = metrics.report()
+        tools.eq_(report["stages"][DECODE]["seconds"], 3.0)
+        tools.eq_(report["groups"][0]["stages"][DECODE]["bytes"], 200)
+        # groups the worker recorded come along
+        worker_metrics = RunMetrics()
+        with worker_metrics.group("20190308.jpg"):
+            worker_metrics.record(DECODE, 1.0, 50)
+        metrics.merge(pickle.loads(pickle.dumps(worker_metrics)))
+        report = metrics.report()
+        tools.eq_(report["groups"][1]["name"], "20190308.jpg")
+        tools.eq_(report["groups"][1]["stages"][DECODE]["bytes"], 50)
+        tools.eq_(report["stages"][DECODE]["bytes"], 350)
+
+    def test_write_json(self):
+        metrics = RunMetrics()
+        metrics.record(DECODE, 1.0, 100)
+        with tempfile.TemporaryDirectory() as report_dir:
+            report_file = Path(report_dir) / "metrics.json"
+            metrics.write_json(report_file)
+            with open(report_file) as json_fp:
+                tools.eq_(json.load(json_fp)["stages"][DECODE]["bytes"], 100)
@@ -0,0 +1,62 @@
+import threading
+
+import numpy as np
+
+from nose import tools
+
+from photomanip.prefetch import prefetch
+
+
+class TestPrefetch:
+    @classmethod
+    def setup_class(cls):
+        cls.items = list(range(10))
+
+    @staticmethod
+    def _tracking_load(started, nbytes=8):
+        lock = threading.Lock()
+
+        def load(item):
+            with lock:
+                started.append(item)
+            return np.zeros(nbytes, dtype=np.uint8)
+        return load
+
+    def test_order(self):
+        for depth in [0, 1, 3]:
+            results = [
+                item for item, _ in
+                prefetch(lambda item: item * 2, self.items, depth)
+            ]
+            tools.eq_(results, self.items)
+            values = [
+                value for _, value in
+                prefetch(lambda item: item * 2, self.items, depth)
+            ]
+            tools.eq_(values, [item * 2 for item in self.items])
+
+    def test_depth(self):
+        started = []
+        load = self._tracking_load(started)
+        for index, (item, _) in enumerate(prefetch(load, self.items, 3)):
+            # never more than `depth` images past the current one
+            tools.eq_(len(started) <= index + 1 + 3, True)
+            tools.eq_(item, index)
+        tools.eq_(sorted(started), self.items)
+
+    def test_memory_cap(self):
+        started = []
+        load = self._tracking_load(started, nbytes=100)
+        # room for two images in the queue, whatever the depth
+        for index, _ in enumerate(prefetch(load, self.items, 5, 250)):
+            tools.eq_(len(started) <= index + 1 + 2, True)
+        tools.eq_(sorted(started), self.items)
+
+    @tools.raises(IOError)
+    def test_error(self):
+        def load(item):
+            if item == 4:
+                raise IOError("unreadable")
+            return item
+        for _ in prefetch(load, self.items, 3):
+            pass